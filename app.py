@@ -1,9 +1,43 @@
-from flask import Flask, request,  jsonify,render_template, session , redirect, url_for
+from flask import Flask, request,  jsonify,render_template, session , redirect, url_for, Response, stream_with_context
+from flask import g, has_request_context, before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
-import pandas as pd
+from markupsafe import Markup
+import click
+import numpy as np
+import orjson
 import os
+import secrets
 import json
-from sqlalchemy import inspect
+import hashlib
+import functools
+import bisect
+import itertools
+import collections
+import csv
+import io
+import tempfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import cProfile
+import gzip
+import threading
+import time
+import unicodedata
+import pathlib
+import sqlite3
+from datetime import datetime, timezone
+from sqlalchemy import event, select, create_engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from nutrition import (
+    nutrient_labels, NUTRIENT_KEYS, NUTRIENT_POSITION,
+    STATUS_OK, STATUS_DEFICIENT, STATUS_EXCESS, STATUS_LABELS,
+    BASES, DEFAULT_BASIS, normalize_totals, nutrient_totals_dict, CompiledStandards,
+    recipe_totals, evaluate_recipes, suggest_ingredients_for_deficiencies,
+)
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
@@ -11,10 +45,25 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 app.secret_key = 'your_secret_key_here' 
 
+# X-Profile ヘッダーによるリクエスト単位のプロファイルを許可するか（本番では必要な時だけ有効にする）
+app.config['PROFILING_ENABLED'] = os.environ.get('DOGFOOD_PROFILING') == '1'
+
+# /recipe-events のライブ評価を使うか。SSE の接続は同期ワーカーを 1 つ占有するため、
+# gunicorn の sync ワーカーでは無効にし（gunicorn.conf.py で設定）、画面は /recipe-delta の応答で更新する
+app.config['LIVE_EVENTS'] = os.environ.get('DOGFOOD_LIVE_EVENTS', '1') == '1'
+
+# 本番向けの SQLite 設定（WAL・mmap などのプラグマと、読み取り専用接続のプール）を使うか
+app.config['SQLITE_PRODUCTION'] = os.environ.get('DOGFOOD_SQLITE_PRODUCTION') == '1'
+
+# 提案食材の計算に使う基準タイプ（リクエストで指定がない場合）
+app.config['DEFAULT_STANDARD'] = os.environ.get('DOGFOOD_DEFAULT_STANDARD', 'puppy')
+
 db = SQLAlchemy(app)
 
-# グローバル変数としてAAFCO基準値を定義
-aafco_standards = {}
+# ブロックタグの前後の空白・改行は出力しない（ループの中の空白行で HTML が大きくならないように）
+app.jinja_env.trim_blocks = True
+app.jinja_env.lstrip_blocks = True
+
 
 # 食材モデルの定義
 class Ingredient(db.Model):
@@ -69,217 +118,1732 @@ class Ingredient(db.Model):
         """Ingredientオブジェクトを辞書形式で返す"""
         return {col.name: getattr(self, col.name) for col in self.__table__.columns if col.name not in ['id', 'food_code', 'name']}
 
+# 取り込み済みデータファイルの内容ハッシュ
+class DataSource(db.Model):
+    __tablename__ = 'data_source'
+    name = db.Column(db.String(80), primary_key=True)  # ファイル名
+    content_hash = db.Column(db.String(64), nullable=False)
+    imported_at = db.Column(db.DateTime, nullable=True)
+
+# 保存済みレシピのモデル（セッションにはレシピ ID だけを持たせる）
+class Recipe(db.Model):
+    __tablename__ = 'recipe'
+    id = db.Column(db.String(16), primary_key=True)  # 短いランダム ID
+    version = db.Column(db.Integer, nullable=False, default=1)  # 更新のたびに 1 増える
+    selected_list = db.Column(db.Text, nullable=False)  # JSON
+    suggestions = db.Column(db.Text, nullable=True)  # JSON
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+# バックグラウンドジョブ（flask run-jobs のワーカーが処理する）
+class Job(db.Model):
+    __tablename__ = 'job'
+    id = db.Column(db.String(16), primary_key=True)  # 短いランダム ID
+    kind = db.Column(db.String(32), nullable=False)  # JOB_KINDS のいずれか
+    status = db.Column(db.String(16), nullable=False, default='queued', index=True)  # queued / running / done / failed / cancelled
+    params = db.Column(db.Text, nullable=False)  # JSON
+    total = db.Column(db.Integer, nullable=False, default=0)  # 対象のレシピ数
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    checkpoint = db.Column(db.String(16), nullable=True)  # 処理済みの最後のレシピ ID（再開時はこの次から）
+    summary = db.Column(db.Text, nullable=True)  # JSON（処理済み分の集計）
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, index=True)  # 待機中のジョブの取得順・一覧の並び順
+    started_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # ワーカーが最後に進捗を書き込んだ時刻
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+# ジョブのレシピごとの結果
+class JobResult(db.Model):
+    __tablename__ = 'job_result'
+    __table_args__ = (
+        # 結果の一覧を判定で絞り込んでレシピ ID 順にページ送りする
+        db.Index('ix_job_result_job_id_status', 'job_id', 'status', 'recipe_id'),
+    )
+    job_id = db.Column(db.String(16), primary_key=True)
+    recipe_id = db.Column(db.String(16), primary_key=True)
+    status = db.Column(db.String(16), nullable=False)  # ok / fail / error
+    deficiencies = db.Column(db.Text, nullable=True)  # JSON
+    excesses = db.Column(db.Text, nullable=True)  # JSON
+    error = db.Column(db.Text, nullable=True)
+
+def create_tables():
+    """テーブルを作成し、既存のデータベースにも後から追加したインデックスを作る"""
+    db.create_all()
+    for model in (Job, JobResult):
+        for index in model.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+# 本番モードで接続ごとに設定するプラグマ
+#   WAL にすると読み取りが書き込みを待たなくなり、synchronous=NORMAL でコミットごとの fsync を減らす。
+#   mmap_size はデータベースファイルをメモリマップで読む上限、cache_size は接続ごとのページキャッシュ（KiB）。
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16384",
+    "PRAGMA temp_store=MEMORY",
+)
+
+# ワーカーごとの読み取り専用接続のプールの大きさ
+READ_POOL_SIZE = int(os.environ.get('DOGFOOD_READ_POOL_SIZE', 5))
+READ_POOL_OVERFLOW = 10
+
+@event.listens_for(Engine, 'connect')
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    if not app.config['SQLITE_PRODUCTION'] or not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+_read_engine = None
+_read_engine_lock = threading.Lock()
+
+def read_engine():
+    """
+    読み取りだけのクエリに使うエンジン。
+    本番モードではデータベースファイルを読み取り専用（mode=ro）で開く接続のプールをワーカーごとに作り、
+    同時に来た読み取りが書き込み用の接続やセッションを待たないようにする。それ以外は db.engine を使う。
+    """
+    global _read_engine
+    if not app.config['SQLITE_PRODUCTION']:
+        return db.engine
+    with _read_engine_lock:
+        if _read_engine is None:
+            uri = pathlib.Path(db.engine.url.database).resolve().as_uri() + '?mode=ro'
+            _read_engine = create_engine(
+                'sqlite://',
+                creator=lambda: sqlite3.connect(uri, uri=True, check_same_thread=False),
+                poolclass=QueuePool,
+                pool_size=READ_POOL_SIZE,
+                max_overflow=READ_POOL_OVERFLOW,
+            )
+    return _read_engine
+
+def dispose_engines():
+    """データベース接続を閉じる（フォークしたワーカーに引き継がない）"""
+    global _read_engine
+    db.session.remove()
+    db.engine.dispose()
+    with _read_engine_lock:
+        if _read_engine is not None:
+            _read_engine.dispose()
+            _read_engine = None
+
+# リクエストの計測
+# 処理時間をフェーズ（db / compute / suggest / render / other）ごとに重複なく集計し、
+# ルートごとの処理時間・SQL 実行回数とあわせて /metrics で公開する。
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_HEADER = 'X-Profile'
+
+class RequestMetrics:
+    """ルートごとの処理時間・フェーズ別時間・SQL 実行回数の集計（ワーカープロセスごと）"""
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.requests = collections.Counter()  # {(ルート, メソッド, ステータス): 件数}
+        self.durations = {}  # {ルート: [バケットごとの件数..., 件数, 合計秒数]}
+        self.phases = collections.Counter()  # {(ルート, フェーズ): 合計秒数}
+        self.statements = collections.Counter()  # {ルート: SQL 実行回数}
+
+    def observe(self, route, method, status, elapsed, phases, statements):
+        with self._lock:
+            self.requests[(route, method, status)] += 1
+            histogram = self.durations.setdefault(route, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += elapsed
+            for phase, seconds in phases.items():
+                self.phases[(route, phase)] += seconds
+            self.statements[route] += statements
+
+    def render(self, caches=None):
+        """Prometheus のテキスト形式に変換する"""
+        lines = [
+            "# HELP dogfood_requests_total Requests handled by this worker.",
+            "# TYPE dogfood_requests_total counter",
+        ]
+        with self._lock:
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append(f'dogfood_requests_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+
+            lines += [
+                "# HELP dogfood_request_duration_seconds Request latency by route.",
+                "# TYPE dogfood_request_duration_seconds histogram",
+            ]
+            for route, histogram in sorted(self.durations.items()):
+                count = histogram[-2]
+                for bound, n in zip(self.buckets, histogram):
+                    lines.append(f'dogfood_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} {n}')
+                lines.append(f'dogfood_request_duration_seconds_bucket{{route="{route}",le="+Inf"}} {count}')
+                lines.append(f'dogfood_request_duration_seconds_sum{{route="{route}"}} {histogram[-1]:.6f}')
+                lines.append(f'dogfood_request_duration_seconds_count{{route="{route}"}} {count}')
+
+            lines += [
+                "# HELP dogfood_request_phase_seconds_total Time spent per phase (db, compute, suggest, render, other).",
+                "# TYPE dogfood_request_phase_seconds_total counter",
+            ]
+            for (route, phase), seconds in sorted(self.phases.items()):
+                lines.append(f'dogfood_request_phase_seconds_total{{route="{route}",phase="{phase}"}} {seconds:.6f}')
+
+            lines += [
+                "# HELP dogfood_sql_statements_total SQL statements issued while handling requests.",
+                "# TYPE dogfood_sql_statements_total counter",
+            ]
+            for route, count in sorted(self.statements.items()):
+                lines.append(f'dogfood_sql_statements_total{{route="{route}"}} {count}')
+
+        for name, stats in (caches or {}).items():
+            for key in ("hits", "misses", "evictions", "expirations"):
+                lines.append(f'dogfood_cache_{key}_total{{cache="{name}"}} {stats[key]}')
+            lines.append(f'dogfood_cache_entries{{cache="{name}"}} {stats["size"]}')
+        return "\n".join(lines) + "\n"
+
+request_metrics = RequestMetrics()
+
+def _enter_phase(name):
+    """フェーズ name を開始する（実行中の外側のフェーズはその間止める）"""
+    if not has_request_context() or 'phase_stack' not in g:
+        return
+    now = time.perf_counter()
+    stack = g.phase_stack
+    if stack:
+        outer = stack[-1]
+        g.phase_times[outer[0]] += now - outer[1]
+    stack.append([name, now])
+
+def _exit_phase():
+    """実行中のフェーズを終了し、外側のフェーズを再開する"""
+    if not has_request_context() or not g.get('phase_stack'):
+        return
+    now = time.perf_counter()
+    name, start = g.phase_stack.pop()
+    g.phase_times[name] += now - start
+    if g.phase_stack:
+        g.phase_stack[-1][1] = now
+
+@contextlib.contextmanager
+def timed_phase(name):
+    """with ブロックの処理時間をリクエストのフェーズ name に加算する（リクエスト外では何もしない）"""
+    _enter_phase(name)
+    try:
+        yield
+    finally:
+        _exit_phase()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'phase_stack' in g:
+        g.sql_statements += 1
+        _enter_phase('db')
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and g.get('phase_stack') and g.phase_stack[-1][0] == 'db':
+        _exit_phase()
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_sql_error(exception_context):
+    if has_request_context() and g.get('phase_stack') and g.phase_stack[-1][0] == 'db':
+        _exit_phase()
+
+@before_render_template.connect_via(app)
+def _before_render(sender, template, context, **extra):
+    _enter_phase('render')
+
+@template_rendered.connect_via(app)
+def _after_render(sender, template, context, **extra):
+    _exit_phase()
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.phase_times = collections.Counter()
+    g.phase_stack = []
+    g.sql_statements = 0
+
+    # 許可されている場合、X-Profile ヘッダー付きのリクエストをプロファイルする
+    mode = request.headers.get(PROFILE_HEADER)
+    if mode and app.config['PROFILING_ENABLED']:
+        if mode == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+                g.profiler = ('pyinstrument', Profiler())
+            except ImportError:
+                print("pyinstrument がインストールされていないため cProfile を使います")
+        if 'profiler' not in g:
+            g.profiler = ('cprofile', cProfile.Profile())
+        if g.profiler[0] == 'pyinstrument':
+            g.profiler[1].start()
+        else:
+            g.profiler[1].enable()
+
+@app.after_request
+def finish_request_metrics(response):
+    if 'request_started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    phase_times = g.phase_times
+    phase_times['other'] += max(elapsed - sum(phase_times.values()), 0.0)
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request_metrics.observe(route, request.method, response.status_code, elapsed, phase_times, g.sql_statements)
+
+    timings = [f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in phase_times.items()]
+    timings.append(f"total;dur={elapsed * 1000:.2f}")
+    response.headers['Server-Timing'] = ", ".join(timings)
+    response.headers['X-SQL-Statements'] = str(g.sql_statements)
+
+    if 'profiler' in g:
+        response.headers['X-Profile-File'] = dump_request_profile(route, *g.pop('profiler'))
+    return response
+
+def dump_request_profile(route, kind, profiler):
+    """プロファイル結果を instance/profiles に保存し、ファイル名を返す"""
+    directory = os.path.join(app.instance_path, 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    name = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}{route.replace('/', '_') or '_'}"
+    if kind == 'pyinstrument':
+        profiler.stop()
+        name += '.html'
+        with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.disable()
+        name += '.prof'
+        profiler.dump_stats(os.path.join(directory, name))
+    return name
+
+# AAFCO 基準値の元ファイルと、追加の基準プロファイル（猫・妊娠授乳期・獣医師の指定など）を置くフォルダ
+STANDARDS_FILE = 'aafco_standards.xlsx'
+STANDARDS_DIR = 'standards'
+STANDARDS_EXTENSIONS = ('.xlsx', '.csv')
+
+def standards_sources():
+    """
+    基準値の元ファイルのパス。aafco_standards.xlsx、standards/ フォルダの *.xlsx・*.csv、
+    環境変数 DOGFOOD_STANDARDS（os.pathsep 区切り）の順で、同じ基準タイプは後のファイルが優先される。
+    """
+    base = os.path.dirname(__file__)
+    paths = [os.path.join(base, STANDARDS_FILE)]
+    directory = os.path.join(base, STANDARDS_DIR)
+    if os.path.isdir(directory):
+        paths += sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.lower().endswith(STANDARDS_EXTENSIONS) and not name.startswith('~$')
+        )
+    paths += [path for path in os.environ.get('DOGFOOD_STANDARDS', '').split(os.pathsep) if path]
+    return [path for path in paths if os.path.exists(path)]
+
 # AAFCO基準値をロードする関数
-def load_aafco_standards():
-    aafco_path = os.path.join(os.path.dirname(__file__), 'aafco_standards.xlsx')
-    if not os.path.exists(aafco_path):
+def load_aafco_standards(paths=None):
+    """
+    基準値のファイル（standard, nutrient, minimum, maximum 列）を読み込み、
+    {基準タイプ: {栄養素: {"minimum", "maximum"}}} を返す。
+    最小値がない栄養素は 0、最大値がない栄養素は None にする。
+    """
+    paths = standards_sources() if paths is None else paths
+    if not paths:
         print("AAFCO基準値のExcelファイルがありません")
         return {}
 
-    # Excelファイルをロード
-    df = pd.read_excel(aafco_path, engine='openpyxl')
-
-    # NaN を None に変換
-    df['maximum'] = df['maximum'].where(df['maximum'].notna(), None)
+    # pandas は起動を速くするため必要な時だけ読み込む
+    import pandas as pd
 
-    # データを変換
     standards = {}
-    for _, row in df.iterrows():
-        nutrient = row["nutrient"]
-        standard_type = row["standard"].lower().replace(" ", "_")  # 'Adult Dog' → 'adult_dog'
-
-        # 基準タイプが辞書にない場合は初期化
-        if standard_type not in standards:
-            standards[standard_type] = {}
-
-        # 栄養素の基準値を追加
-        standards[standard_type][nutrient] = {
-            "minimum": row["minimum"],
-            "maximum": row.get("maximum", None)  # 最大値がない場合はNoneを設定
-        }
+    for path in paths:
+        if path.lower().endswith('.csv'):
+            df = pd.read_csv(path)
+        else:
+            df = pd.read_excel(path, engine='openpyxl')
+        if 'maximum' not in df.columns:
+            df['maximum'] = None
+
+        # データを変換
+        file_standards = {}
+        for standard, nutrient, minimum, maximum in zip(df['standard'], df['nutrient'], df['minimum'], df['maximum']):
+            if pd.isna(standard) or pd.isna(nutrient):
+                continue
+            standard_type = str(standard).strip().lower().replace(" ", "_")  # 'Adult Dog' → 'adult_dog'
 
-    return standards
+            # 基準タイプが辞書にない場合は初期化
+            if standard_type not in file_standards:
+                file_standards[standard_type] = {}
 
-# 栄養素の合計を計算する関数
-def calculate_totals(selected_list):
-    nutrient_totals = {nutrient: 0 for nutrient in aafco_standards.keys()}
-    for item in selected_list:
-        food_code = item['food_code']
-        grams = item['grams']
-        nutrients = food_database.get(food_code, {})
-        for nutrient, value in nutrients.items():
-            nutrient_totals[nutrient] += value * (grams / 100)
-    return nutrient_totals
-
-# 不足栄養素に基づく提案食材を生成する関数
-def suggest_ingredients_for_deficiencies(deficiencies, excesses):
-    suggestions = {}
-    for nutrient in deficiencies:
-        # 過剰栄養素を含まない食材を選択
-        ingredients = (
-            Ingredient.query.filter(getattr(Ingredient, nutrient) > 0)
-            .filter(~Ingredient.food_code.in_(
-                [item.food_code for item in Ingredient.query if item.food_code in excesses]
-            ))
-            .order_by(getattr(Ingredient, nutrient).desc())
-            .limit(5)
-            .all()
-        )
-        suggestions[nutrient] = [
-            {
-                "food_code": ing.food_code,
-                "name": ing.name,
-                "value": getattr(ing, nutrient, 0)
+            # 栄養素の基準値を追加（NaN は JSON やテンプレートに渡せないので数値か None にそろえる）
+            file_standards[standard_type][str(nutrient).strip()] = {
+                "minimum": 0.0 if pd.isna(minimum) else float(minimum),
+                "maximum": None if pd.isna(maximum) else float(maximum),
             }
-            for ing in ingredients
-        ]
-    return suggestions
+        standards.update(file_standards)
+
+    # 基準値が読み込み直されたので計算結果のキャッシュを捨てる
+    evaluation_cache.clear()
+    return standards
+
+# Excel の列名 → Ingredient の属性名
+INGREDIENT_COLUMNS = {
+    "食品群": "category",
+    "食品番号": "food_code",
+    "食品名": "name",
+    "水分": "WATER",
+    "エネルギー": "ENERC_KCAL",
+    "タンパク質": "PROT",
+    "アルギニン": "ARG",
+    "ヒスチジン": "HIS",
+    "イソロイシン": "ILE",
+    "ロイシン": "LEU",
+    "リジン": "LYS",
+    "メチオニン": "MET",
+    "シスチン": "CYS",
+    "フェニルアラニン": "PHE",
+    "チロシン": "TYR",
+    "スレオニン": "THR",
+    "トリプトファン": "TRP",
+    "バリン": "VAL",
+    "リノール酸": "F18D2N6",
+    "αリノレン酸": "F18D3N3",
+    "エイコサペンタエン酸": "F20D5N3",
+    "ドコサヘキサエン酸": "F22D6N3",
+    "脂肪": "FAT",
+    "カルシウム": "CA",
+    "リン": "P",
+    "カリウム": "K",
+    "ナトリウム": "NAT",
+    "マグネシウム": "MG",
+    "鉄": "FE",
+    "銅": "CU",
+    "マンガン": "MN",
+    "亜鉛": "ZN",
+    "ヨウ素": "YO",
+    "セレン": "SE",
+    "ビタミンA": "RETOL",
+    "ビタミンD": "VITD",
+    "ビタミンE": "TOCPHA",
+    "ビタミンB1": "THIA",
+    "ビタミンB2": "RIBF",
+    "パントテン酸": "PANTAC",
+    "ナイアシン": "NIA",
+    "ビタミンB6": "VITB6A",
+    "葉酸": "FOL",
+    "ビタミンB12": "VITB12",
+}
+
+# 一度の executemany で書き込む行数
+IMPORT_CHUNK_SIZE = 500
+
+def file_sha256(path):
+    """ファイル内容の SHA-256 を返す"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def clean_ingredient_sheet(df):
+    """
+    ingredients.xlsx のシートを列単位でクレンジング・検証する。
+    (正常な行の DataFrame, 行ごとのエラーのリスト) を返す。エラーの "row" は Excel の行番号（見出しが 1 行目）。
+    """
+    import pandas as pd
+
+    missing = [column for column in INGREDIENT_COLUMNS if column not in df.columns]
+    if missing:
+        raise ValueError(f"ingredients.xlsx に必要な列がありません: {missing}")
+    df = df[list(INGREDIENT_COLUMNS)].rename(columns=INGREDIENT_COLUMNS)
+
+    # データクレンジング: Tr, N/A, Undefined, 空欄を 0 に置き換える
+    nutrients = list(NUTRIENT_KEYS)
+    raw_values = df[nutrients].replace(['Tr', 'N/A', 'Undefined'], 0).fillna(0)
+    values = raw_values.apply(pd.to_numeric, errors='coerce')
+    food_codes = pd.to_numeric(df['food_code'], errors='coerce')
+    names = df['name'].astype(object).where(df['name'].notna(), None)
+    categories = [None if pd.isna(category) else str(category) for category in df['category']]
+
+    # 行ごとの検証（エラーの行だけを除外する）
+    errors = []
+    invalid = pd.Series(False, index=df.index)
+
+    def reject(mask, describe):
+        nonlocal invalid
+        mask = mask & ~invalid
+        for index in df.index[mask]:
+            code = food_codes[index]
+            errors.append({
+                "row": int(index) + 2,
+                "food_code": None if pd.isna(code) else int(code) if code % 1 == 0 else float(code),
+                "error": describe(index),
+            })
+        invalid = invalid | mask
+
+    reject(food_codes.isna() | (food_codes % 1 != 0), lambda index: "食品番号が整数ではありません")
+    reject(names.isna() | (names.astype(str).str.strip() == ''), lambda index: "食品名がありません")
+    bad_values = values.isna()
+    reject(
+        bad_values.any(axis=1),
+        lambda index: f"数値に変換できない値があります: {list(bad_values.columns[bad_values.loc[index]])}",
+    )
+    reject(food_codes.where(~invalid).duplicated(keep='first'), lambda index: "食品番号が重複しています")
+
+    cleaned = values.astype(float)
+    cleaned.insert(0, 'name', names)
+    cleaned.insert(0, 'food_code', food_codes.where(~invalid, 0).astype(np.int64))
+    cleaned.insert(0, 'category', categories)
+    return cleaned[~invalid].reset_index(drop=True), errors
+
+def import_ingredients(cleaned, rejected_codes=()):
+    """
+    クレンジング済みの行をデータベースとの差分だけ 1 トランザクションで反映する。
+    食品番号をキーに追加・更新し、シートからなくなった食品番号は削除する。
+    検証で除外された行の食品番号（rejected_codes）は、シートに残っているので削除せず既存の行をそのまま残す。
+    """
+    import pandas as pd
+
+    columns = ['category', 'food_code', 'name'] + list(NUTRIENT_KEYS)
+    existing = pd.DataFrame(
+        db.session.query(*[getattr(Ingredient, column) for column in columns]).all(),
+        columns=columns,
+    ).set_index('food_code')
+    incoming = cleaned.set_index('food_code')
+
+    # 追加・変更された行を列単位の比較で抽出（Excel 書き出し時の丸め誤差は無視する）
+    common = incoming.index.intersection(existing.index)
+    old, new = existing.loc[common, columns[3:]], incoming.loc[common, columns[3:]]
+    changed = ~np.isclose(old.to_numpy(), new.to_numpy(), rtol=1e-12, atol=0).all(axis=1)
+    changed |= (existing.loc[common, 'name'] != incoming.loc[common, 'name']).to_numpy()
+    changed |= (existing.loc[common, 'category'].fillna('') != incoming.loc[common, 'category'].fillna('')).to_numpy()
+    added = incoming.index.difference(existing.index)
+    upserts = incoming.loc[added.append(common[changed])].reset_index()
+    removed = existing.index.difference(incoming.index).difference(pd.Index(list(rejected_codes), dtype=existing.index.dtype))
+
+    report = {"inserted": len(added), "updated": int(changed.sum()), "deleted": len(removed), "errors": []}
+    records = upserts[columns].to_dict('records')
+    statement = sqlite_insert(Ingredient.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=['food_code'],
+        set_={column: statement.excluded[column] for column in columns if column != 'food_code'},
+    )
+    for start in range(0, len(records), IMPORT_CHUNK_SIZE):
+        chunk = records[start:start + IMPORT_CHUNK_SIZE]
+        try:
+            with db.session.begin_nested():
+                db.session.execute(statement, chunk)
+        except Exception:
+            # チャンク内でエラーが出た場合は 1 行ずつ書き込んでエラーの行を特定する
+            for record in chunk:
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(statement, [record])
+                except Exception as e:
+                    report["errors"].append({"row": None, "food_code": int(record['food_code']), "error": str(e)})
+    if len(removed):
+        db.session.execute(Ingredient.__table__.delete().where(Ingredient.food_code.in_(removed.tolist())))
+    return report
 
 # 初期データベースの処理
 def process_excel():
+    """
+    ingredients.xlsx をデータベースに取り込む。
+    ファイルの内容ハッシュが前回の取り込みと同じ場合は何もせずに None を返し、
+    それ以外は差分を反映して件数と行ごとのエラーをまとめたレポートを返す。
+    """
     excel_path = os.path.join(os.path.dirname(__file__), 'ingredients.xlsx')
     if not os.path.exists(excel_path):
         print("Excelファイル(ingredients.xlsx)が存在しません")
         return
 
-    # Excelファイルの読み込み
+    # テーブルが存在しない場合に作成
+    create_tables()
+
+    # 内容が変わっていない場合はスキップ
+    content_hash = file_sha256(excel_path)
+    source = db.session.get(DataSource, 'ingredients.xlsx')
+    if source is not None and source.content_hash == content_hash:
+        print("ingredients.xlsx に変更はありません。処理をスキップします。")
+        return
+
+    # Excelファイルの読み込みとクレンジング
+    import pandas as pd
     df = pd.read_excel(excel_path, engine='openpyxl')
+    cleaned, errors = clean_ingredient_sheet(df)
 
-    # データクレンジング: Tr, N/A, Undefined を 0 に置き換える
-    df = df.replace(['Tr', 'N/A', 'Undefined', None], 0)
+    # 差分の反映とハッシュの記録を 1 トランザクションで行う
+    try:
+        rejected_codes = {error["food_code"] for error in errors if isinstance(error["food_code"], int)}
+        report = import_ingredients(cleaned, rejected_codes)
+        report["errors"] = errors + report["errors"]
+        if source is None:
+            source = DataSource(name='ingredients.xlsx')
+            db.session.add(source)
+        source.content_hash = content_hash
+        source.imported_at = datetime.now(timezone.utc)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    for error in report["errors"]:
+        print(f"行 {error['row']} (食品番号 {error['food_code']}) でエラーが発生しました: {error['error']}")
+    print(
+        f"ingredients.xlsx を取り込みました: 追加 {report['inserted']} 件, "
+        f"更新 {report['updated']} 件, 削除 {report['deleted']} 件, エラー {len(report['errors'])} 件"
+    )
+
+    # 食材データが変わったのでストアを再構築し、計算結果のキャッシュを捨てる
+    if ingredient_store is not None:
+        load_ingredient_store()
+    evaluation_cache.clear()
+    return report
+
+
+# 検索用の文字正規化（ひらがな → カタカナ）
+_HIRAGANA_TO_KATAKANA = {code: code + 0x60 for code in range(0x3041, 0x3097)}
+
+def normalize_search_text(text):
+    """全角/半角（NFKC）・大文字/小文字・ひらがな/カタカナを同一視できる形に正規化する"""
+    return unicodedata.normalize('NFKC', str(text)).casefold().translate(_HIRAGANA_TO_KATAKANA)
+
+# ローマ字 → カタカナの変換表
+_ROMAJI_TABLE = dict(pair.split(':') for pair in (
+    "a:ア i:イ u:ウ e:エ o:オ ka:カ ki:キ ku:ク ke:ケ ko:コ sa:サ si:シ shi:シ su:ス se:セ so:ソ "
+    "ta:タ ti:チ chi:チ tu:ツ tsu:ツ te:テ to:ト na:ナ ni:ニ nu:ヌ ne:ネ no:ノ "
+    "ha:ハ hi:ヒ hu:フ fu:フ he:ヘ ho:ホ ma:マ mi:ミ mu:ム me:メ mo:モ ya:ヤ yu:ユ yo:ヨ "
+    "ra:ラ ri:リ ru:ル re:レ ro:ロ wa:ワ wo:ヲ ga:ガ gi:ギ gu:グ ge:ゲ go:ゴ "
+    "za:ザ zi:ジ ji:ジ zu:ズ ze:ゼ zo:ゾ da:ダ di:ヂ du:ヅ de:デ do:ド "
+    "ba:バ bi:ビ bu:ブ be:ベ bo:ボ pa:パ pi:ピ pu:プ pe:ペ po:ポ "
+    "fa:ファ fi:フィ fe:フェ fo:フォ va:ヴァ vi:ヴィ vu:ヴ ve:ヴェ vo:ヴォ -:ー"
+).split())
+for _prefix, _kana in {
+    'ky': 'キ', 'sh': 'シ', 'sy': 'シ', 'ch': 'チ', 'cy': 'チ', 'ty': 'チ', 'ny': 'ニ', 'hy': 'ヒ',
+    'my': 'ミ', 'ry': 'リ', 'gy': 'ギ', 'j': 'ジ', 'jy': 'ジ', 'zy': 'ジ', 'dy': 'ヂ', 'by': 'ビ', 'py': 'ピ',
+}.items():
+    for _vowel, _small in zip('auoe', 'ャュョェ'):
+        _ROMAJI_TABLE.setdefault(_prefix + _vowel, _kana + _small)
+
+def romaji_to_katakana(text):
+    """ローマ字の文字列をカタカナに変換する（変換できない文字があれば None）"""
+    result, i = [], 0
+    while i < len(text):
+        c = text[i]
+        following = text[i + 1:i + 2]
+        if c == 'n' and following not in ('a', 'i', 'u', 'e', 'o', 'y'):
+            # n + 子音 / 末尾 / nn はン
+            result.append('ン')
+            i += 2 if following == 'n' and text[i + 2:i + 3] not in ('a', 'i', 'u', 'e', 'o', 'y') else 1
+            continue
+        if c == following and c not in 'aiueon-' or (c == 't' and text[i + 1:i + 3] == 'ch'):
+            # 子音の重ねは促音
+            result.append('ッ')
+            i += 1
+            continue
+        for length in (3, 2, 1):
+            kana = _ROMAJI_TABLE.get(text[i:i + length])
+            if kana is not None:
+                result.append(kana)
+                i += length
+                break
+        else:
+            return None
+    return ''.join(result)
 
-    # テーブルが存在しない場合に作成
-    inspector = inspect(db.engine)
-    if not inspector.has_table('ingredient'):
-        db.create_all()
+# 並べ替え済みの結果を持っておく数字の検索語の最大桁数
+SEARCH_CODE_PREFIX_LENGTH = 2
 
-    # 既存データがある場合はスキップ
-    if Ingredient.query.count() > 0:
-        print("既存のデータがあります。処理をスキップします。")
-        return
+class SearchIndex:
+    """
+    食材名の文字 bigram による転置索引と、食品番号の前方一致用のソート済みリスト。
+    1 文字の検索語は出現位置・食材名の長さ順に並べた unigram の転置リストをそのまま返す。
+    短い数字の検索語は関連度順に並べた結果を前もって作っておき、切り出して返す。
+    スナップショットから読んだ正規化済みの食材名と転置リスト（postings）を渡した場合は作り直さない。
+    """
+
+    def __init__(self, food_codes, names, postings=None):
+        self.codes = [str(code) for code in food_codes]
+        order = sorted(range(len(self.codes)), key=self.codes.__getitem__)
+        self.sorted_codes = [self.codes[row] for row in order]
+        self.code_rows = np.array(order, dtype=np.intp)
+
+        if postings is not None:
+            self.names = postings["names"]
+            self.unigrams = postings["unigrams"]
+            self.bigrams = postings["bigrams"]
+            self.ranked_digits = postings["ranked_digits"]
+            return
+
+        self.names = [normalize_search_text(name) for name in names]
+        unigrams, bigrams = {}, {}
+        for row, name in enumerate(self.names):
+            seen = set()
+            for position, char in enumerate(name):
+                if char not in seen:
+                    seen.add(char)
+                    unigrams.setdefault(char, []).append((position, len(name), row))
+            for position in range(len(name) - 1):
+                bigrams.setdefault(name[position:position + 2], set()).add(row)
+        self.unigrams = {char: np.array([row for _, _, row in sorted(entries)], dtype=np.intp) for char, entries in unigrams.items()}
+        self.bigrams = {gram: np.array(sorted(rows), dtype=np.intp) for gram, rows in bigrams.items()}
+
+        # SEARCH_CODE_PREFIX_LENGTH 桁以下の数字の検索語は並べ替え済みの結果を持っておく
+        prefixes = {code[:length] for code in self.codes for length in range(1, SEARCH_CODE_PREFIX_LENGTH + 1)}
+        prefixes.update(gram for gram in itertools.chain(self.unigrams, self.bigrams) if gram.isdigit())
+        self.ranked_digits = {}
+        for term in prefixes:
+            rows = self._match_term(term)
+            if len(rows):
+                self.ranked_digits[term] = np.array(self._rank(term, rows.tolist()), dtype=np.intp)
+
+    def _match_name(self, term):
+        """正規化済みの検索語を部分一致で含む行番号の配列"""
+        if len(term) == 1:
+            return self.unigrams.get(term, np.empty(0, dtype=np.intp))
+        postings = []
+        for position in range(len(term) - 1):
+            posting = self.bigrams.get(term[position:position + 2])
+            if posting is None:
+                return np.empty(0, dtype=np.intp)
+            postings.append(posting)
+        postings.sort(key=len)
+        rows = postings[0]
+        for posting in postings[1:]:
+            rows = np.intersect1d(rows, posting, assume_unique=True)
+        if len(term) > 2:
+            # bigram がすべて含まれていても連続していない場合があるので確認する
+            rows = np.array([row for row in rows.tolist() if term in self.names[row]], dtype=np.intp)
+        return rows
+
+    def _match_code(self, term):
+        """食品番号が term で始まる行番号の配列（食品番号の文字列順）"""
+        start = bisect.bisect_left(self.sorted_codes, term)
+        end = bisect.bisect_left(self.sorted_codes, term + '\U0010ffff')
+        return self.code_rows[start:end]
+
+    def _match_term(self, term):
+        variants = [self._match_name(term)]
+        if term.isascii() and term.isalpha():
+            kana = romaji_to_katakana(term)
+            if kana:
+                variants.append(self._match_name(kana))
+        if term.isdigit():
+            variants.append(self._match_code(term))
+        return variants[0] if len(variants) == 1 else np.unique(np.concatenate(variants))
+
+    def search(self, query, limit, offset=0):
+        """
+        空白区切りのすべての語を含む食材を関連度順に並べ、(offset から limit 件の行番号, 総件数) を返す。
+        並び順: 食品番号の完全一致 → 食品番号の前方一致 → 最初の語が食材名の前にある順 → 食材名の短い順。
+        """
+        terms = normalize_search_text(query).split()
+        if not terms:
+            return [], 0
+
+        # 1 文字の食材名検索は並べ替え済みの転置リストをそのまま使う
+        first = terms[0]
+        if len(terms) == 1 and len(first) == 1 and not first.isdigit() and not (first.isascii() and first.isalpha()):
+            rows = self.unigrams.get(first, np.empty(0, dtype=np.intp))
+            return rows[offset:offset + limit].tolist(), len(rows)
+
+        # 短い数字の検索語は並べ替え済みの結果をそのまま使う
+        if len(terms) == 1 and first in self.ranked_digits:
+            rows = self.ranked_digits[first]
+            return rows[offset:offset + limit].tolist(), len(rows)
+
+        rows = self._match_term(first)
+        for term in terms[1:]:
+            if not len(rows):
+                break
+            rows = np.intersect1d(rows, self._match_term(term), assume_unique=True)
+        if not len(rows):
+            return [], 0
+
+        ranked = self._rank(first, rows.tolist())
+        return ranked[offset:offset + limit], len(ranked)
+
+    def _rank(self, first, candidates):
+        """最初の検索語 first に対する関連度順に行番号を並べる"""
+        kana = romaji_to_katakana(first) if first.isascii() and first.isalpha() else None
+        keys = []
+        for row in candidates:
+            code = self.codes[row]
+            if first.isdigit() and code.startswith(first):
+                # 食品番号の一致は桁数の少ない順・番号順
+                keys.append((0 if code == first else 1, len(code), int(code), row))
+                continue
+            name = self.names[row]
+            position = name.find(first)
+            if position < 0 and kana:
+                position = name.find(kana)
+            keys.append((2, position if position >= 0 else len(name), len(name), row))
+        keys.sort()
+        return [key[3] for key in keys]
+
+# 件数上限付きキャッシュ
+class LRUCache:
+    """
+    件数上限付きの LRU キャッシュ（スレッド間で共有できる）。
+    ttl を指定すると、登録から ttl 秒を過ぎたエントリは見つからなかったものとして扱う。
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # {キー: (有効期限, 値)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, value = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """件数とヒット・ミス・追い出し・期限切れの回数"""
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def __len__(self):
+        return len(self._entries)
 
-    # データベースへの登録
-    for index, row in df.iterrows():
-        ingredient = Ingredient(
-            category=row["食品群"],  # Excelからカテゴリを読み取る
-            food_code=int(row["食品番号"]),
-            name=row["食品名"],
-            WATER=float(row["水分"]),
-            ENERC_KCAL=float(row["エネルギー"]),
-            PROT=float(row["タンパク質"]),
-            ARG=float(row["アルギニン"]),
-            HIS=float(row["ヒスチジン"]),
-            ILE=float(row["イソロイシン"]),
-            LEU=float(row["ロイシン"]),
-            LYS=float(row["リジン"]),
-            MET=float(row["メチオニン"]),
-            CYS=float(row["シスチン"]),
-            PHE=float(row["フェニルアラニン"]),
-            TYR=float(row["チロシン"]),
-            THR=float(row["スレオニン"]),
-            TRP=float(row["トリプトファン"]),
-            VAL=float(row["バリン"]),
-            F18D2N6=float(row["リノール酸"]),
-            F18D3N3=float(row["αリノレン酸"]),
-            F20D5N3=float(row["エイコサペンタエン酸"]),
-            F22D6N3=float(row["ドコサヘキサエン酸"]),
-            FAT=float(row["脂肪"]),
-            CA=float(row["カルシウム"]),
-            P=float(row["リン"]),
-            K=float(row["カリウム"]),
-            NAT=float(row["ナトリウム"]),
-            MG=float(row["マグネシウム"]),
-            FE=float(row["鉄"]),
-            CU=float(row["銅"]),
-            MN=float(row["マンガン"]),
-            ZN=float(row["亜鉛"]),
-            YO=float(row["ヨウ素"]),
-            SE=float(row["セレン"]),
-            RETOL=float(row["ビタミンA"]),
-            VITD=float(row["ビタミンD"]),
-            TOCPHA=float(row["ビタミンE"]),
-            THIA=float(row["ビタミンB1"]),
-            RIBF=float(row["ビタミンB2"]),
-            PANTAC=float(row["パントテン酸"]),
-            NIA=float(row["ナイアシン"]),
-            VITB6A=float(row["ビタミンB6"]),
-            FOL=float(row["葉酸"]),
-            VITB12=float(row["ビタミンB12"]),
+# 食品番号 → 行番号の対応表
+class FoodCodeIndex:
+    """
+    食品番号をソートした配列の二分探索で行番号を引く読み取り専用のマップ。
+    配列はスナップショットのメモリマップをそのまま使えるため、ワーカーごとに辞書を持たずに済む。
+    """
+
+    def __init__(self, food_codes, order=None):
+        if order is None:
+            order = np.argsort(food_codes, kind='stable')
+        self.order = order
+        self.sorted_codes = np.asarray(food_codes)[order]
+
+    def rows(self, codes):
+        """食品番号の配列を行番号の配列に変換する（存在しない食品番号は -1）"""
+        codes = np.asarray(codes, dtype=np.int64)
+        if not len(self.sorted_codes):
+            return np.full(codes.shape, -1, dtype=np.intp)
+        positions = np.minimum(np.searchsorted(self.sorted_codes, codes), len(self.sorted_codes) - 1)
+        found = self.sorted_codes[positions] == codes
+        return np.where(found, self.order[positions], -1).astype(np.intp)
+
+    def get(self, code, default=None):
+        if not isinstance(code, (int, np.integer)):
+            return default
+        row = int(self.rows([code])[0])
+        return default if row < 0 else row
+
+    def __contains__(self, code):
+        return self.get(code) is not None
+
+    def __getitem__(self, code):
+        row = self.get(code)
+        if row is None:
+            raise KeyError(code)
+        return row
+
+    def __len__(self):
+        return len(self.sorted_codes)
+
+    def __iter__(self):
+        return iter(self.sorted_codes.tolist())
+
+# 代替食材の索引で食材ごとに前もって計算しておく近傍の数と、近傍表を作る時に一度に計算する行数
+SUBSTITUTE_TABLE_SIZE = 50
+SUBSTITUTE_BLOCK_ROWS = 1024
+
+class SubstituteIndex:
+    """
+    栄養素ベクトルのコサイン類似度による代替食材の索引。
+    単位の大きい栄養素だけで類似度が決まらないよう、各栄養素を全食材での標準偏差で割ってから
+    行ごとに長さ 1 に正規化し、食材ごとに類似度の高い食材を SUBSTITUTE_TABLE_SIZE 件ずつ
+    近傍表（neighbors, similarity）に並べておく。
+    スナップショットから読んだ (vectors, neighbors, similarity) を tables に渡した場合は計算し直さない。
+    """
+
+    def __init__(self, matrix, categories, size=SUBSTITUTE_TABLE_SIZE, tables=None):
+        self.categories = categories
+        rows_by_category = {}
+        for row, category in enumerate(categories):
+            rows_by_category.setdefault(category, []).append(row)
+        self.category_rows = {category: np.array(rows, dtype=np.intp) for category, rows in rows_by_category.items()}
+        if tables is not None:
+            self.vectors, self.neighbors, self.similarity = tables
+            return
+
+        scale = matrix.std(axis=0)
+        scale[scale == 0] = 1
+        vectors = matrix / scale
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self.vectors = (vectors / norms).astype(np.float32)
+
+        n = len(self.vectors)
+        size = max(min(size, n - 1), 0)
+        self.neighbors = np.empty((n, size), dtype=np.int32)
+        self.similarity = np.empty((n, size), dtype=np.float32)
+        if size:
+            for start in range(0, n, SUBSTITUTE_BLOCK_ROWS):
+                block = self.vectors[start:start + SUBSTITUTE_BLOCK_ROWS] @ self.vectors.T
+                block[np.arange(len(block)), np.arange(start, start + len(block))] = -np.inf  # 自分自身は除く
+                top = np.argpartition(-block, size - 1, axis=1)[:, :size]
+                values = np.take_along_axis(block, top, axis=1)
+                order = np.argsort(-values, axis=1, kind='stable')
+                self.neighbors[start:start + len(block)] = np.take_along_axis(top, order, axis=1)
+                self.similarity[start:start + len(block)] = np.take_along_axis(values, order, axis=1)
+
+    def nearest(self, row, k, same_category=False, exclude=()):
+        """
+        row の食材に似た食材を類似度の高い順に最大 k 件、(行番号, 類似度) のリストで返す。
+        近傍表に k 件そろえば表だけで答え、足りない時は候補全体との類似度を計算する。
+        """
+        category = self.categories[row]
+        result = [
+            (neighbor, similarity)
+            for neighbor, similarity in zip(self.neighbors[row].tolist(), self.similarity[row].tolist())
+            if neighbor not in exclude and (not same_category or self.categories[neighbor] == category)
+        ]
+        if len(result) >= k or len(result) == len(self.vectors) - 1 - len(exclude):
+            return result[:k]
+
+        candidates = self.category_rows[category] if same_category else np.arange(len(self.vectors))
+        scores = self.vectors[candidates] @ self.vectors[row]
+        result = []
+        for i in np.argsort(-scores, kind='stable').tolist():
+            candidate = int(candidates[i])
+            if candidate != row and candidate not in exclude:
+                result.append((candidate, float(scores[i])))
+                if len(result) == k:
+                    break
+        return result
+
+# 食材データのインメモリストア
+class IngredientStore:
+    """
+    食材テーブル全体を保持する読み取り専用ストア。
+    matrix[i, j] は i 行目の食材 100g あたりの NUTRIENT_KEYS[j] の値。
+    """
+
+    def __init__(self, food_codes, names, categories, matrix, ranking=None, code_order=None, version=None):
+        self.food_codes = np.asarray(food_codes, dtype=np.int64)
+        self.names = tuple(names)
+        self.categories = tuple(categories)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float64).reshape(len(self.names), len(NUTRIENT_KEYS))
+        self.food_codes.setflags(write=False)
+        self.matrix.setflags(write=False)
+
+        # 食品番号 → 行番号
+        self.index = FoodCodeIndex(self.food_codes, code_order)
+
+        # 栄養素ごとに値の大きい順に並べた行番号 (栄養素数, 行数)
+        if ranking is None:
+            ranking = np.argsort(-self.matrix, axis=0, kind='stable').T.copy()
+        self.ranking = ranking
+        self.ranking.setflags(write=False)
+
+        # データ内容から計算したバージョン
+        if version is None:
+            digest = hashlib.sha1(self.food_codes.tobytes())
+            digest.update(self.matrix.tobytes())
+            version = digest.hexdigest()[:12]
+        self.version = version
+
+    @functools.cached_property
+    def search_index(self):
+        """食材名・食品番号の検索インデックス（最初に使われた時に作る）"""
+        return SearchIndex(self.food_codes.tolist(), self.names)
+
+    @functools.cached_property
+    def substitute_index(self):
+        """栄養素ベクトルの類似度による代替食材の索引（最初に使われた時に作る）"""
+        return SubstituteIndex(self.matrix, self.categories)
+
+    @classmethod
+    def from_database(cls):
+        """Ingredient テーブルを 1 回のクエリで読み込む"""
+        columns = [Ingredient.food_code, Ingredient.name, Ingredient.category]
+        columns += [getattr(Ingredient, nutrient) for nutrient in NUTRIENT_KEYS]
+        rows = db.session.query(*columns).order_by(Ingredient.id).all()
+
+        matrix = np.array([row[3:] for row in rows], dtype=np.float64)
+        return cls(
+            food_codes=[row[0] for row in rows],
+            names=[row[1] for row in rows],
+            categories=[row[2] for row in rows],
+            matrix=np.nan_to_num(matrix),
         )
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, selected_list):
+        """
+        selected_list を (行番号の配列, グラム数の配列) に変換する。
+        ストアに存在しない食品番号は除外する。
+        """
+        codes = [int(item['food_code']) for item in selected_list]
+        grams = np.array([float(item.get('grams') or 0) for item in selected_list], dtype=np.float64)
+        rows = self.index.rows(codes)
+        found = rows >= 0
+        for position in np.flatnonzero(~found):
+            print(f"Warning: Ingredient with food_code {codes[position]} not found")
+        return rows[found], grams[found]
+
+    def lookup_many(self, recipes):
+        """
+        複数の selected_list を疎行列（CSR 形式: indptr, 行番号, グラム数）に変換する。
+        解釈できないレシピは errors に {レシピ番号: メッセージ} として記録し、空のレシピとして扱う。
+        """
+        codes, grams, counts, errors = [], [], [], {}
+        for position, selected_list in enumerate(recipes):
+            try:
+                parsed = [(int(item['food_code']), float(item.get('grams') or 0)) for item in selected_list]
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                errors[position] = f"invalid recipe: {e}"
+                parsed = []
+            counts.append(len(parsed))
+            for code, g in parsed:
+                codes.append(code)
+                grams.append(g)
+
+        # 食品番号をまとめて行番号に変換し、存在しない食材を除いて行ポインタを作る
+        rows = self.index.rows(codes)
+        found = rows >= 0
+        recipe_of = np.repeat(np.arange(len(counts)), counts)
+        indptr = np.zeros(len(counts) + 1, dtype=np.intp)
+        np.cumsum(np.bincount(recipe_of[found], minlength=len(counts)), out=indptr[1:])
+        return indptr, rows[found], np.array(grams, dtype=np.float64)[found], errors
+
+    def top_k(self, nutrient, k=5, exclude=()):
+        """栄養素の値が正の食材を値の大きい順に最大 k 件返す（exclude の行番号は除く）"""
+        j = NUTRIENT_POSITION[nutrient]
+        column = self.matrix[:, j]
+        result = []
+        for row in self.ranking[j, :k + len(exclude)].tolist():
+            if column[row] <= 0 or len(result) == k:
+                break
+            if row not in exclude:
+                result.append(row)
+        return result
+
+    def totals(self, rows, grams):
+        """行番号とグラム数から栄養素の合計ベクトルを計算する"""
+        return (grams / 100) @ self.matrix[rows]
+
+    def batch_totals(self, indptr, rows, grams):
+        """CSR 形式のレシピ×食材グラム行列と栄養素行列の積 (レシピ数, 栄養素数) を計算する"""
+        totals = np.zeros((len(indptr) - 1, len(NUTRIENT_KEYS)))
+        nonempty = np.flatnonzero(np.diff(indptr))
+        if len(nonempty):
+            contributions = self.matrix[rows] * (grams / 100)[:, np.newaxis]
+            totals[nonempty] = np.add.reduceat(contributions, indptr[nonempty], axis=0)
+        return totals
+
+
+ingredient_store = None
+
+def load_ingredient_store():
+    """データベースからストアを構築し、グローバル変数を差し替える"""
+    global ingredient_store
+    ingredient_store = IngredientStore.from_database()
+    return ingredient_store
+
+def get_ingredient_store():
+    """ストアを返す（未構築の場合はスナップショットかデータベースから構築する）"""
+    global ingredient_store
+    if ingredient_store is None:
+        snapshot = read_snapshot()
+        if snapshot is None:
+            return load_ingredient_store()
+        ingredient_store = store_from_snapshot(*snapshot)
+    return ingredient_store
+
+# 基準値の元ファイルの更新を確認する間隔（秒）
+STANDARDS_RELOAD_INTERVAL = 2.0
+
+class StandardsRegistry:
+    """
+    基準値の元ファイル（standards_sources）から作った CompiledStandards を保持し、
+    ファイルの更新時刻・サイズが変わっていれば読み込み直す。
+    読み込み直した基準値は新しいオブジェクトとして参照ごと差し替える（コピーオンライト）ので、
+    処理中のリクエストは最初に取得した基準値を最後まで使い続けられる。
+    """
+
+    def __init__(self):
+        self._compiled = None
+        self._signature = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def signature():
+        """元ファイルの (パス, 更新時刻, サイズ) の組"""
+        signature = []
+        for path in standards_sources():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def install(self, compiled, signature=None):
+        """コンパイル済みの基準値に差し替える"""
+        self._signature = self.signature() if signature is None else signature
+        self._checked_at = time.monotonic()
+        self._compiled = compiled
+        return compiled
+
+    def reload(self):
+        """
+        元ファイルから読み込み直す。書き込み途中などで読めなかった場合は
+        今の基準値を使い続け、次の確認時にもう一度読み込む。
+        """
+        with self._lock:
+            signature = self.signature()
+            if self._compiled is not None and signature == self._signature:
+                return self._compiled  # 別のスレッドが読み込み直した
+            try:
+                standards = load_aafco_standards([path for path, _, _ in signature])
+            except Exception as e:
+                print(f"AAFCO基準値を読み込めませんでした: {e}")
+                if self._compiled is not None:
+                    self._checked_at = time.monotonic()
+                    return self._compiled
+                standards = {}
+            return self.install(CompiledStandards(standards), signature)
+
+    def current(self):
+        """現在の基準値（STANDARDS_RELOAD_INTERVAL ごとに元ファイルの更新を確認する）"""
+        compiled = self._compiled
+        if compiled is None:
+            return self.reload()
+        if time.monotonic() - self._checked_at >= STANDARDS_RELOAD_INTERVAL:
+            self._checked_at = time.monotonic()
+            if self.signature() != self._signature:
+                return self.reload()
+        return compiled
+
+
+standards_registry = StandardsRegistry()
+
+def get_compiled_standards():
+    """
+    現在の基準値を返す。1 つのリクエストの中では最初に取得したものを使い回すこと
+    （途中で読み込み直されても判定と表示がずれないように）。
+    """
+    return standards_registry.current()
+
+def suggestion_standard(standards, requested=None):
+    """
+    提案食材の計算に使う基準タイプ。requested、app.config['DEFAULT_STANDARD'] の順に
+    standards にあるものを使い、どちらもなければ先頭の基準タイプにする。
+    """
+    for standard_type in (requested, app.config['DEFAULT_STANDARD']):
+        if standard_type in standards.types:
+            return standard_type
+    return standards.types[0] if standards.types else None
+
+# 計算結果キャッシュの件数と有効期間（秒）
+EVALUATION_CACHE_SIZE = 4096
+EVALUATION_CACHE_TTL = 600
+
+evaluation_cache = LRUCache(EVALUATION_CACHE_SIZE, ttl=EVALUATION_CACHE_TTL)
+
+def recipe_fingerprint(selected_list):
+    """(食品番号, グラム数) の組をソートした正規形のハッシュ（食材の並び順によらない）"""
+    pairs = sorted((int(item['food_code']), float(item.get('grams') or 0)) for item in selected_list)
+    return hashlib.sha1(orjson.dumps(pairs)).hexdigest()
+
+def evaluate_recipe(selected_list, basis=DEFAULT_BASIS, standard=None, standards=None):
+    """
+    selected_list の basis での栄養素合計・判定・standard の基準での提案食材を計算する
+    （standard は suggestion_standard で決める）。
+    レシピの正規形・basis・提案の基準タイプ・食材データのバージョン・基準値のバージョンをキーにキャッシュし、
+    {"fingerprint", "total_vector", "total_grams", "codes", "results", "deficiencies", "excesses", "standard", "suggestions"} を返す
+    （共有されるので変更しないこと）。
+    """
+    if basis not in BASES:
+        raise ValueError(f"unknown basis: {basis}")
+    store = get_ingredient_store()
+    standards = standards or get_compiled_standards()
+    standard = suggestion_standard(standards, standard)
+    try:
+        fingerprint = recipe_fingerprint(selected_list)
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        # 解釈できないレシピはバッチ計算（lookup_many）と同じメッセージで知らせる
+        raise ValueError(f"invalid recipe: {e}")
+    key = (fingerprint, basis, standard, store.version, standards.version)
+    evaluation = evaluation_cache.get(key)
+    if evaluation is not None:
+        return evaluation
+
+    with timed_phase('compute'):
+        values, total_grams, codes, errors = evaluate_recipes(store, standards, [selected_list], basis)
+        if errors:
+            raise ValueError(errors[0])
+        total_vector, total_grams, codes = values[0], float(total_grams[0]), codes[0]
+        total_vector.setflags(write=False)
+        codes.setflags(write=False)
+        deficiencies = standards.nutrients_with(codes, STATUS_DEFICIENT)
+        excesses = standards.nutrients_with(codes, STATUS_EXCESS)
+        results = standards.verdicts(codes)
+    with timed_phase('suggest'):
+        suggestions = suggest_ingredients_for_deficiencies(store, deficiencies.get(standard, []))
+    evaluation = {
+        "fingerprint": fingerprint,
+        "total_vector": total_vector,
+        "total_grams": total_grams,
+        "codes": codes,
+        "results": results,
+        "deficiencies": deficiencies,
+        "excesses": excesses,
+        "standard": standard,
+        "suggestions": suggestions,
+    }
+    evaluation_cache.put(key, evaluation)
+    return evaluation
+
+# スナップショットファイルの形式
+SNAPSHOT_MAGIC = b'DOGSNAP\x00'
+SNAPSHOT_FORMAT = 4
+SNAPSHOT_ALIGN = 64
+
+def _align(offset):
+    return -(-offset // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+
+def snapshot_path():
+    """スナップショットの保存先（database.db と同じ instance フォルダ）"""
+    return os.path.join(app.instance_path, 'snapshot.bin')
+
+def snapshot_sources():
+    """スナップショットの元になる食材データと基準値のファイルの内容ハッシュ"""
+    base = os.path.dirname(__file__)
+    paths = [os.path.join(base, 'ingredients.xlsx')] + standards_sources()
+    return {
+        os.path.relpath(path, base): file_sha256(path)
+        for path in paths
+        if os.path.exists(path)
+    }
+
+def _pack_postings(postings):
+    """{キー: 行番号の配列} を (キーのリスト, 区切り位置, 連結した行番号) にする"""
+    keys = list(postings)
+    offsets = np.zeros(len(keys) + 1, dtype=np.intp)
+    np.cumsum([len(postings[key]) for key in keys], out=offsets[1:])
+    rows = np.concatenate([postings[key] for key in keys]).astype(np.intp) if keys else np.empty(0, dtype=np.intp)
+    return keys, offsets, rows
+
+def _unpack_postings(keys, offsets, rows):
+    """_pack_postings の逆（行番号の配列はメモリマップしたファイルを指すビューのまま）"""
+    rows = np.asarray(rows)
+    bounds = offsets.tolist()
+    return {key: rows[bounds[i]:bounds[i + 1]] for i, key in enumerate(keys)}
+
+def write_snapshot(store, compiled, path=None):
+    """
+    ストアとコンパイル済みの基準値、検索インデックスと代替食材の索引をバイナリのスナップショットに書き出す。
+    形式: マジック (8 バイト) + ヘッダー長 (8 バイト) + JSON ヘッダー + 64 バイト境界に揃えた配列。
+    """
+    path = path or snapshot_path()
+    search = store.search_index
+    substitutes = store.substitute_index
+    arrays = {
+        "food_codes": store.food_codes,
+        "code_order": store.index.order,
+        "matrix": store.matrix,
+        "ranking": store.ranking,
+        "standards_minimum": compiled.minimum,
+        "standards_maximum": compiled.maximum,
+        "standards_defined": compiled.defined,
+        "substitute_vectors": substitutes.vectors,
+        "substitute_neighbors": substitutes.neighbors,
+        "substitute_similarity": substitutes.similarity,
+    }
+    search_keys = {}
+    for name in ("unigrams", "bigrams", "ranked_digits"):
+        search_keys[name], arrays[f"search_{name}_offsets"], arrays[f"search_{name}_rows"] = _pack_postings(getattr(search, name))
+    header = {
+        "format": SNAPSHOT_FORMAT,
+        "version": store.version,
+        "sources": snapshot_sources(),
+        "nutrient_keys": list(NUTRIENT_KEYS),
+        "names": list(store.names),
+        "categories": list(store.categories),
+        "standards": compiled.source,
+        "search": dict(search_keys, names=search.names, code_prefix_length=SEARCH_CODE_PREFIX_LENGTH),
+        "substitute_table_size": SUBSTITUTE_TABLE_SIZE,
+        "arrays": {},
+    }
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _align(offset + array.nbytes)
+    body = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    data_start = _align(16 + len(body))
+
+    # 書き込み途中のファイルを読まれないよう、一時ファイルから置き換える
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(len(body).to_bytes(8, 'little'))
+        f.write(body)
+        for name, array in arrays.items():
+            f.seek(data_start + header["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(temporary, path)
+    return path
+
+def read_snapshot(path=None):
+    """
+    スナップショットを読み込み (ヘッダー, 配列の辞書) を返す。
+    配列はファイルをメモリマップしたもので、コピーは行わない。
+    ファイルがない・形式や索引の設定が違う・元の Excel が更新されている場合は None を返す。
+    """
+    path = path or snapshot_path()
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        if f.read(8) != SNAPSHOT_MAGIC:
+            return None
+        length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(length).decode('utf-8'))
+    if header.get("format") != SNAPSHOT_FORMAT or tuple(header["nutrient_keys"]) != NUTRIENT_KEYS:
+        return None
+    if header["search"]["code_prefix_length"] != SEARCH_CODE_PREFIX_LENGTH \
+            or header["substitute_table_size"] != SUBSTITUTE_TABLE_SIZE:
+        return None
+    if header["sources"] != snapshot_sources():
+        return None
+
+    data_start = _align(16 + length)
+    arrays = {
+        name: np.memmap(path, dtype=spec["dtype"], mode='r', offset=data_start + spec["offset"], shape=tuple(spec["shape"]))
+        for name, spec in header["arrays"].items()
+    }
+    return header, arrays
+
+def store_from_snapshot(header, arrays):
+    """スナップショットからストアを構築する（検索インデックスと代替食材の索引も作り直さずに読む）"""
+    store = IngredientStore(
+        food_codes=arrays["food_codes"],
+        names=header["names"],
+        categories=header["categories"],
+        matrix=arrays["matrix"],
+        ranking=arrays["ranking"],
+        code_order=arrays["code_order"],
+        version=header["version"],
+    )
+    search = header["search"]
+    postings = {
+        name: _unpack_postings(search[name], arrays[f"search_{name}_offsets"], arrays[f"search_{name}_rows"])
+        for name in ("unigrams", "bigrams", "ranked_digits")
+    }
+    postings["names"] = search["names"]
+    store.search_index = SearchIndex(store.food_codes.tolist(), store.names, postings)
+    store.substitute_index = SubstituteIndex(store.matrix, store.categories, tables=(
+        np.asarray(arrays["substitute_vectors"]),
+        np.asarray(arrays["substitute_neighbors"]),
+        np.asarray(arrays["substitute_similarity"]),
+    ))
+    return store
+
+def initialize_data():
+    """
+    起動時に食材データと AAFCO 基準値を読み込む。
+    元ファイルが更新されていなければスナップショットをメモリマップするだけで済ませ、
+    pandas / openpyxl は読み込まず、検索インデックスと代替食材の索引も作り直さない。
+    """
+    global ingredient_store
+    create_tables()
+    process_excel()  # データベース初期化（変更がなければスキップ）
+
+    # スナップショットと照合する前に、基準値の元ファイルの状態を記録しておく
+    signature = standards_registry.signature()
+    snapshot = read_snapshot()
+    if snapshot is None:
+        # スナップショットが古い場合は Excel とデータベースから作り直し、
+        # 書き出したファイルをメモリマップし直してフォーク後のワーカーとページを共有する
+        load_ingredient_store()
+        compiled = standards_registry.reload()  # 判定用の配列に変換
         try:
-            db.session.add(ingredient)
-            db.session.commit()
-        except Exception as e:
-            print(f"行 {index} でエラーが発生しました: {e}")
-            db.session.rollback()
-
-# nutrient_labels をグローバル変数として定義
-nutrient_labels = {
-    'WATER': ('水分', 'g'),
-    'ENERC_KCAL': ('エネルギー', 'kcal'),
-    'PROT': ('タンパク質', 'g'),
-    'ARG': ('アルギニン', 'g'),
-    'HIS': ('ヒスチジン', 'g'),
-    'ILE': ('イソロイシン', 'g'),
-    'LEU': ('ロイシン', 'g'),
-    'LYS': ('リジン', 'g'),
-    'MET': ('メチオニン', 'g'),
-    'CYS': ('シスチン', 'g'),
-    'PHE': ('フェニルアラニン', 'g'),
-    'TYR': ('チロシン', 'g'),
-    'THR': ('スレオニン', 'g'),
-    'TRP': ('トリプトファン', 'g'),
-    'VAL': ('バリン', 'g'),
-    'F18D2N6': ('リノール酸', 'g'),
-    'F18D3N3': ('αリノレン酸', 'g'),
-    'F20D5N3': ('エイコサペンタエン酸', 'g'),
-    'F22D6N3': ('ドコサヘキサエン酸', 'g'),
-    'FAT': ('脂肪', 'g'),
-    'CA': ('カルシウム', 'g'),
-    'P': ('リン', 'g'),
-    'K': ('カリウム', 'g'),
-    'NAT': ('ナトリウム', 'g'),
-    'MG': ('マグネシウム', 'g'),
-    'FE': ('鉄', 'mg'),
-    'CU': ('銅', 'mg'),
-    'MN': ('マンガン', 'mg'),
-    'ZN': ('亜鉛', 'mg'),
-    'YO': ('ヨウ素', 'mg'),
-    'SE': ('セレン', 'mg'),
-    'RETOL': ('ビタミンA', 'μg'),
-    'VITD': ('ビタミンD', 'μg'),
-    'TOCPHA': ('ビタミンE', 'μg'),
-    'THIA': ('ビタミンB1', 'mg'),
-    'RIBF': ('ビタミンB2', 'mg'),
-    'PANTAC': ('パントテン酸', 'mg'),
-    'NIA': ('ナイアシン', 'mg'),
-    'VITB6A': ('ビタミンB6', 'mg'),
-    'FOL': ('葉酸', 'mg'),
-    'VITB12': ('ビタミンB12', 'mg'),
-}
+            write_snapshot(ingredient_store, compiled)
+            snapshot = read_snapshot()
+        except OSError as e:
+            print(f"スナップショットを書き出せませんでした: {e}")
+    if snapshot is not None:
+        header, arrays = snapshot
+        ingredient_store = store_from_snapshot(header, arrays)
+        standards_registry.install(CompiledStandards.from_arrays(
+            header["standards"],
+            arrays["standards_minimum"],
+            arrays["standards_maximum"],
+            arrays["standards_defined"],
+        ), signature)
+
+    # 既定の食材一覧レスポンスもフォーク前に作っておく（スナップショットがない場合は索引もここで作る）
+    ingredient_store.search_index
+    ingredient_store.substitute_index
+    catalog_body(ingredient_store)
+
+@app.cli.command('build-snapshot')
+def build_snapshot_command():
+    """Excel ファイルを取り込み、スナップショットを作り直す"""
+    create_tables()
+    process_excel()
+    store = load_ingredient_store()
+    compiled = standards_registry.install(CompiledStandards(load_aafco_standards()))
+    path = write_snapshot(store, compiled)
+    print(f"スナップショットを書き出しました: {path} (version {store.version})")
+
+def create_app():
+    """
+    アプリケーションファクトリ。食材データと基準値のレジストリを読み込んだ app を返す
+    （gunicorn からは "app:create_app()" で読み込む）。
+    """
+    with app.app_context():
+        initialize_data()
+
+        # テンプレートもフォーク前にコンパイルしておく
+        for name in app.jinja_env.list_templates(extensions=['html']):
+            app.jinja_env.get_template(name)
 
-# 共通ユーティリティ関数
-def calculate_nutrients(selected_list):
+        # SQLite の接続はフォーク後のワーカーに引き継がない
+        dispose_engines()
+    return app
+
+# プロセス内に保持する保存済みレシピの件数
+RECIPE_CACHE_SIZE = 1024
+
+class RecipeState:
     """
-    栄養素の合計を計算する関数
+    保存済みレシピ 1 件と、その計算結果のキャッシュ。
+    内容が変わると version が変わり、別のインスタンスに置き換わる。
     """
-    nutrient_totals = {nutrient: 0 for nutrient in aafco_standards.keys()}
-    for item in selected_list:
-        ingredient = Ingredient.query.filter_by(food_code=item['food_code']).first()
-        if ingredient:
-            for nutrient in aafco_standards.keys():
-                value = getattr(ingredient, nutrient, 0) or 0
-                nutrient_totals[nutrient] += value * (item['grams'] / 100)
-        else:
-            print(f"Warning: Ingredient with food_code {item['food_code']} not found")
-    return nutrient_totals
+
+    def __init__(self, recipe_id, version, selected_list, suggestions=None):
+        self.id = recipe_id
+        self.version = version
+        self.selected_list = selected_list
+        self.suggestions = suggestions or {}
+        self._evaluation = None
+
+    def evaluate(self, store, standards):
+        """
+        同じ食品番号のグラム数を足し合わせてストアの行順に並べたレシピについて、
+        {"selected_ingredients", "rows", "grams", "total_vector", "codes"} を返す。
+        合計は /calculate と同じく計算コアの recipe_totals で計算する。
+        食材データや基準値が変わった時だけ計算し直す。
+        """
+        evaluation = self._evaluation
+        if evaluation is not None and evaluation["store_version"] == store.version \
+                and evaluation["standards"] is standards:
+            return evaluation
+
+        grams_by_row = {}
+        for item in self.selected_list:
+            row = store.index.get(int(item['food_code']))
+            if row is None:
+                continue
+            if row in grams_by_row:
+                grams_by_row[row] = float(grams_by_row[row] or 0) + float(item.get('grams') or 0)
+            else:
+                grams_by_row[row] = item.get('grams')
+        rows = sorted(grams_by_row)
+        selected_ingredients = [
+            {'food_code': int(store.food_codes[row]), 'grams': grams_by_row[row], 'name': store.names[row]}
+            for row in rows
+        ]
+        rows = np.array(rows, dtype=np.intp)
+        grams = np.array([float(item['grams'] or 0) for item in selected_ingredients], dtype=np.float64)
+        totals, _, errors = recipe_totals(store, [self.selected_list])
+        if errors:
+            raise ValueError(errors[0])
+        total_vector = totals[0]
+
+        evaluation = {
+            "store_version": store.version,
+            "standards": standards,
+            "selected_ingredients": selected_ingredients,
+            "rows": rows,
+            "grams": grams,
+            "total_vector": total_vector,
+            "codes": standards.evaluate(total_vector)[0],
+        }
+        self._evaluation = evaluation
+        return evaluation
+
+    def seed(self, evaluation):
+        """差分更新などで計算済みの結果をキャッシュに入れる"""
+        self._evaluation = evaluation
+
+recipe_cache = LRUCache(RECIPE_CACHE_SIZE)
+
+class RecipeEvents:
+    """
+    レシピごとの更新通知。
+    同じプロセス内の更新は notify で待機中の購読者をすぐに起こし、
+    他のワーカーでの更新は購読者がバージョンをポーリングして検出する。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}  # {レシピ ID: [Condition, 購読数, 通知回数]}
+
+    def notify(self, recipe_id):
+        with self._lock:
+            channel = self._channels.get(recipe_id)
+        if channel is not None:
+            with channel[0]:
+                channel[2] += 1
+                channel[0].notify_all()
+
+    def subscribe(self, recipe_id):
+        with self._lock:
+            channel = self._channels.setdefault(recipe_id, [threading.Condition(), 0, 0])
+            channel[1] += 1
+        return channel
+
+    def unsubscribe(self, recipe_id):
+        with self._lock:
+            channel = self._channels.get(recipe_id)
+            if channel is not None:
+                channel[1] -= 1
+                if channel[1] <= 0:
+                    del self._channels[recipe_id]
+
+    @staticmethod
+    def wait(channel, seen, timeout):
+        """通知回数が seen から増えるか timeout 秒経つまで待ち、現在の通知回数を返す"""
+        with channel[0]:
+            channel[0].wait_for(lambda: channel[2] != seen, timeout)
+            return channel[2]
+
+recipe_events = RecipeEvents()
+
+def _recipe_state(recipe):
+    return RecipeState(
+        recipe.id,
+        recipe.version,
+        orjson.loads(recipe.selected_list),
+        orjson.loads(recipe.suggestions) if recipe.suggestions else {},
+    )
+
+def create_recipe(selected_list, suggestions=None):
+    """レシピを保存して RecipeState を返す"""
+    recipe_id = secrets.token_urlsafe(8)
+    while db.session.get(Recipe, recipe_id) is not None:
+        recipe_id = secrets.token_urlsafe(8)
+    recipe = Recipe(
+        id=recipe_id,
+        version=1,
+        selected_list=orjson.dumps(selected_list).decode(),
+        suggestions=orjson.dumps(suggestions or {}).decode(),
+        updated_at=datetime.now(timezone.utc),
+    )
+    db.session.add(recipe)
+    db.session.commit()
+    state = _recipe_state(recipe)
+    recipe_cache.put(recipe_id, state)
+    return state
+
+def get_recipe(recipe_id):
+    """
+    保存済みレシピを返す（存在しない場合は None）。
+    他のワーカーが更新している可能性があるため、キャッシュはバージョンを確認してから使う。
+    """
+    if not recipe_id:
+        return None
+    with read_engine().connect() as connection:
+        version = connection.execute(select(Recipe.version).where(Recipe.id == recipe_id)).scalar()
+        if version is None:
+            return None
+        state = recipe_cache.get(recipe_id)
+        if state is not None and state.version == version:
+            return state
+
+        # ORM オブジェクトを作らず、必要な列だけを読む
+        row = connection.execute(
+            select(Recipe.version, Recipe.selected_list, Recipe.suggestions).where(Recipe.id == recipe_id)
+        ).one_or_none()
+    if row is None:
+        return None
+    state = RecipeState(
+        recipe_id,
+        row.version,
+        orjson.loads(row.selected_list),
+        orjson.loads(row.suggestions) if row.suggestions else {},
+    )
+    recipe_cache.put(recipe_id, state)
+    return state
+
+def update_recipe(recipe_id, selected_list, suggestions=None, expected_version=None):
+    """
+    レシピの内容を置き換えてバージョンを上げ、新しい RecipeState を返す。
+    存在しない場合と、expected_version を指定して現在のバージョンと異なる場合は None を返す。
+    """
+    values = {
+        Recipe.selected_list: orjson.dumps(selected_list).decode(),
+        Recipe.version: Recipe.version + 1,
+        Recipe.updated_at: datetime.now(timezone.utc),
+    }
+    if suggestions is not None:
+        values[Recipe.suggestions] = orjson.dumps(suggestions).decode()
+    query = db.session.query(Recipe).filter(Recipe.id == recipe_id)
+    if expected_version is not None:
+        query = query.filter(Recipe.version == expected_version)
+    updated = query.update(values, synchronize_session=False)
+    db.session.commit()
+    if not updated:
+        return None
+    recipe_events.notify(recipe_id)
+
+    # バージョンを指定した更新では、書き込んだ内容から新しい状態を作って読み直しを省く
+    previous = recipe_cache.get(recipe_id)
+    if expected_version is not None and previous is not None and previous.version == expected_version:
+        state = RecipeState(
+            recipe_id, expected_version + 1, selected_list,
+            previous.suggestions if suggestions is None else suggestions,
+        )
+        recipe_cache.put(recipe_id, state)
+        return state
+    return get_recipe(recipe_id)
+
+# 描画済みの部分テンプレートのキャッシュ件数と、バージョン付きの URL で配る静的ファイルの有効期間（秒）
+FRAGMENT_CACHE_SIZE = 512
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+fragment_cache = LRUCache(FRAGMENT_CACHE_SIZE)
+
+def render_fragment(template, key, **context):
+    """
+    部分テンプレートを描画する。key（レシピの指紋と食材データ・基準値のバージョンなど）が
+    同じ間は描画済みの HTML を使い回す。
+    """
+    key = (template,) + tuple(key)
+    html = fragment_cache.get(key)
+    if html is None:
+        html = Markup(render_template(template, **context))
+        fragment_cache.put(key, html)
+    return html
+
+@app.template_filter('script_json')
+def script_json(value):
+    """<script> に埋め込む JSON（orjson で変換し、タグとして解釈される文字をエスケープする）"""
+    text = orjson.dumps(value).decode()
+    return Markup(text.replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026'))
+
+_asset_versions = {}
+
+@app.template_global()
+def asset_url(filename):
+    """static/ のファイルの URL（内容のハッシュを ?v= に付けて長期間キャッシュさせる）"""
+    path = os.path.join(app.static_folder, filename)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _asset_versions.get(filename)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, file_sha256(path)[:12])
+        _asset_versions[filename] = cached
+    return url_for('static', filename=filename, v=cached[1])
+
+reference_assets = LRUCache(8)
+
+def reference_asset(standards):
+    """
+    栄養素の表示名・単位と基準値をまとめたスクリプト（window.DOGFOOD_REFERENCE を定義する）。
+    基準値のバージョンごとに (バージョン, 本文) を作って使い回す。
+    """
+    default = suggestion_standard(standards)
+    key = (standards.version, default)
+    asset = reference_assets.get(key)
+    if asset is None:
+        payload = {
+            "nutrient_keys": list(NUTRIENT_KEYS),
+            "nutrient_labels": nutrient_labels,
+            "standard_types": list(standards.types),
+            "standard_labels": standards.labels,
+            "standards": standards.source,
+            "default_standard": default,
+        }
+        body = b"window.DOGFOOD_REFERENCE = " + orjson.dumps(payload) + b";\n"
+        asset = (hashlib.sha1(body).hexdigest()[:12], body)
+        reference_assets.put(key, asset)
+    return asset
+
+@app.template_global()
+def reference_url():
+    """現在の基準値に対応する /reference.js の URL"""
+    version, _ = reference_asset(get_compiled_standards())
+    return url_for('reference_data', v=version)
+
+@app.route('/reference.js', methods=['GET'])
+def reference_data():
+    """
+    栄養素の表示名・単位と基準値を返すエンドポイント（ページごとに埋め込まず、1 回だけ読み込ませる）。
+    ?v= が現在のバージョンと一致すれば長期間キャッシュさせ、それ以外は ETag で確認させる。
+    """
+    version, body = reference_asset(get_compiled_standards())
+    if request.args.get('v') == version:
+        headers = {"Cache-Control": f"public, max-age={ASSET_MAX_AGE}, immutable"}
+    else:
+        headers = {"Cache-Control": "public, no-cache"}
+    if request.if_none_match.contains(version):
+        response = Response(status=304, headers=headers)
+    else:
+        response = Response(body, mimetype='text/javascript', headers=headers)
+    response.set_etag(version)
+    return response
+
+@app.after_request
+def cache_versioned_assets(response):
+    """?v= 付きの静的ファイルは内容が変わると URL も変わるので、長期間キャッシュさせる"""
+    if request.endpoint == 'static' and request.args.get('v') and response.status_code == 200:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = ASSET_MAX_AGE
+        response.cache_control.immutable = True
+    return response
 
 # エンドポイントの定義
 @app.route('/')
 def index():
-    # `index.html` に食材リストを表示
-    ingredients = Ingredient.query.all()
-    return render_template('index.html', ingredients=ingredients)
+    # 食材リストは index.html から /ingredients を取得して表示する
+    return render_template('index.html')
 
 @app.route('/calculate', methods=['POST'])
 def calculate():
@@ -289,268 +1853,1368 @@ def calculate():
 
         # JSON データの取得
         data = request.get_json()
-
-        # 新しいデータをセッションに保存
         selected_list = data.get('selected_list', [])
-        session['selected_list'] = selected_list
-
-        # 食材コードリストの作成
-        selected_food_codes = [int(item['food_code']) for item in selected_list]
-
-        # データベースから選択された食材を取得
-        selected_ingredients = Ingredient.query.filter(Ingredient.food_code.in_(selected_food_codes)).all()
-
-        # 栄養素の合計を計算
-        totals = {nutrient: 0 for nutrient in next(iter(aafco_standards.values())).keys()}
-        total_grams = 0
-        selected_list_tuples = []
-
-        for item in selected_list:
-            food_code = int(item['food_code'])
-            grams = float(item['grams'])
-
-            # 対応する食材を取得
-            ingredient = next((ing for ing in selected_ingredients if ing.food_code == food_code), None)
-            if ingredient:
-                selected_list_tuples.append((food_code, grams, ingredient.name))
-                total_grams += grams
-                for nutrient in totals.keys():
-                    nutrient_value = getattr(ingredient, nutrient.upper(), 0) or 0  # 大文字対応
-                    totals[nutrient] += nutrient_value * (grams / 100)
-
-        # 判定ロジック（成犬用と幼犬用の両方）
-        adult_deficiencies = [
-            nutrient for nutrient, total in totals.items()
-            if total < aafco_standards.get('adult_dog', {}).get(nutrient, {}).get('minimum', 0)
-        ]
-        adult_excesses = [
-            nutrient for nutrient, total in totals.items()
-            if aafco_standards.get('adult_dog', {}).get(nutrient, {}).get('maximum') is not None
-            and total > aafco_standards['adult_dog'][nutrient]['maximum']
-        ]
 
-        puppy_deficiencies = [
-            nutrient for nutrient, total in totals.items()
-            if total < aafco_standards.get('puppy', {}).get(nutrient, {}).get('minimum', 0)
-        ]
-        puppy_excesses = [
-            nutrient for nutrient, total in totals.items()
-            if aafco_standards.get('puppy', {}).get(nutrient, {}).get('maximum') is not None
-            and total > aafco_standards['puppy'][nutrient]['maximum']
+        # ストアから選択された食材の行を取得（表示は送信された順）
+        store = get_ingredient_store()
+        rows, grams = store.lookup(selected_list)
+        total_grams = float(grams.sum())
+        selected_list_tuples = [
+            (int(store.food_codes[row]), float(g), store.names[row]) for row, g in zip(rows, grams)
         ]
 
-        # 提案食材は幼犬基準で計算
-        puppy_suggestions = suggest_ingredients_for_deficiencies(puppy_deficiencies, puppy_excesses)
+        # 栄養素の合計・全基準タイプの判定・提案食材（同じレシピの結果はキャッシュから）
+        standards = get_compiled_standards()
+        evaluation = evaluate_recipe(selected_list, standard=data.get('standard'), standards=standards)
+        totals = dict(zip(NUTRIENT_KEYS, evaluation["total_vector"].tolist()))
+        deficiencies = evaluation["deficiencies"]
+        excesses = evaluation["excesses"]
+        suggestions = evaluation["suggestions"]
 
-        # 提案食材をセッションに保存（不足項目のみ）
+        # レシピと提案食材（不足項目のみ）をサーバー側に保存し、セッションには ID だけを持たせる
         simplified_suggestions = {
             nutrient: [{"food_code": item["food_code"], "name": item["name"]} for item in items]
-            for nutrient, items in puppy_suggestions.items()
+            for nutrient, items in suggestions.items()
         }
-        session['suggestions'] = simplified_suggestions  # 提案食材を保存
+        recipe = create_recipe(selected_list, simplified_suggestions)
+        session['recipe_id'] = recipe.id
+
+        # 合計・判定の表と提案食材は、同じ内容のレシピなら描画済みのものを使う
+        versions = (store.version, standards.version)
+        nutrient_table = render_fragment(
+            '_nutrient_table.html',
+            (evaluation["fingerprint"],) + versions,
+            totals=totals,
+            results=evaluation["results"],
+            nutrient_labels=nutrient_labels,
+            aafco_standards=standards.source,
+            standard_labels=standards.labels,
+        )
+        suggestion_list = render_fragment(
+            '_suggestion_list.html',
+            (evaluation["fingerprint"], evaluation["standard"]) + versions,
+            suggestions=suggestions,
+            nutrient_labels=nutrient_labels,
+        )
 
         # 結果をテンプレートに渡す
         return render_template(
             'calculate.html',
-            totals=totals,
             selected_list=selected_list_tuples,
             total_grams=total_grams,
-            deficiencies={'adult_dog': adult_deficiencies, 'puppy': puppy_deficiencies},
-            excesses={'adult_dog': adult_excesses, 'puppy': puppy_excesses},
-            suggestions=puppy_suggestions,
-            nutrient_labels=nutrient_labels,
-            aafco_standards=aafco_standards
+            recipe_id=recipe.id,
+            nutrient_table=nutrient_table,
+            suggestion_list=suggestion_list
         )
     except Exception as e:
         print(f"Unhandled Exception in /calculate: {e}")
         return jsonify({"error": str(e)}), 500
 
-def suggest_best_ingredients(deficiencies):
-    """
-    不足している複数の栄養素を部分的にでも補える食材を提案する
-    """
-    best_suggestions = []
-
-    # すべての食材を取得
-    all_ingredients = Ingredient.query.all()
-
-    for ingredient in all_ingredients:
-        total_score = 0
-        partial_score = 0
-        covered_nutrients = []
-
-        for nutrient in deficiencies:
-            nutrient_value = getattr(ingredient, nutrient, 0) or 0
-            standard_value = aafco_standards.get(nutrient, 0)
-
-            if standard_value > 0 and nutrient_value > 0:
-                partial_score = min(nutrient_value / standard_value, 1.0)  # カバー率を1.0で最大化
-                total_score += partial_score
-                covered_nutrients.append(nutrient)
-
-        # スコアがゼロでない食材を提案候補に追加
-        if total_score > 0:
-            best_suggestions.append({
-                "food_code": ingredient.food_code,
-                "name": ingredient.name,
-                "score": round(total_score, 2),
-                "covered_nutrients": covered_nutrients
-            })
+# 単体法の数値許容誤差と、グラム数の丸めで最大値を超えた時に解き直す回数
+SIMPLEX_EPS = 1e-9
+SOLVER_ROUNDING_RETRIES = 3
 
-    # スコア順に並べて上位5つを返す
-    return sorted(best_suggestions, key=lambda x: x['score'], reverse=True)[:5]
+# 食材数の上限で基準を満たせない時に、残る不足（不足量で正規化）1 単位に付ける罰則（候補食材の最大コストの倍数）
+SOLVER_SHORTFALL_PENALTY = 1000
 
-
-def calculate_nutrients(selected_list):
-    nutrient_totals = {nutrient: 0 for nutrient in aafco_standards.keys()}
-    for item in selected_list:
-        ingredient = Ingredient.query.filter_by(food_code=item['food_code']).first()
-        if ingredient:
-            for nutrient in aafco_standards.keys():
-                value = getattr(ingredient, nutrient, 0) or 0
-                nutrient_totals[nutrient] += value * (item['grams'] / 100)
+def _simplex(tableau, basis, cost, allowed, max_iter=2000):
+    """
+    正準形のタブロー (行数, 列数 + 1) を基底 basis から主単体法で最小化する。
+    cost は列ごとのコスト、allowed は基底に入れてよい列のマスク。
+    tableau と basis はその場で更新し、最終的な被約費用を返す（反復上限に達した場合は None）。
+    """
+    degenerate = 0
+    for _ in range(max_iter):
+        reduced = cost - cost[basis] @ tableau[:, :-1]
+        reduced[~allowed] = 0
+        if degenerate > 50:
+            # 退化が続く場合は Bland の規則で巡回を防ぐ
+            entering = np.flatnonzero(reduced < -SIMPLEX_EPS)
+            if not len(entering):
+                return reduced
+            enter = entering[0]
         else:
-            print(f"Warning: Ingredient with food_code {item['food_code']} not found")
-    return nutrient_totals
+            enter = int(np.argmin(reduced))
+            if reduced[enter] >= -SIMPLEX_EPS:
+                return reduced
+
+        column = tableau[:, enter]
+        positive = column > SIMPLEX_EPS
+        if not positive.any():
+            return None
+        ratios = np.full(len(column), np.inf)
+        ratios[positive] = tableau[positive, -1] / column[positive]
+        leave = int(np.argmin(ratios))
+        degenerate = degenerate + 1 if ratios[leave] <= SIMPLEX_EPS else 0
+
+        pivot_row = tableau[leave] / column[leave]
+        tableau -= np.outer(column, pivot_row)
+        tableau[leave] = pivot_row
+        np.maximum(tableau[:, -1], 0, out=tableau[:, -1])
+        basis[leave] = enter
+    return None
+
+def _solve_completion_lp(lower, upper, upper_rhs, cost):
+    """
+    追加量 y >= 0 について
+        lower @ y >= 1, upper @ y <= upper_rhs
+    の下で cost @ y を最小化する（二段階単体法）。
+    (y, 双対変数) を返し、実行不能な場合は (None, None) を返す。
+    """
+    n_lower, n = lower.shape
+    n_upper = upper.shape[0]
+    m = n_lower + n_upper
+
+    # 列の並び: [y | 余剰変数 (下限行) | スラック変数 (上限行) | 人工変数 (下限行)]
+    surplus = n
+    slack = surplus + n_lower
+    artificial = slack + n_upper
+    width = artificial + n_lower
+    tableau = np.zeros((m, width + 1))
+    tableau[:n_lower, :n] = lower
+    tableau[:n_lower, surplus:slack] = -np.eye(n_lower)
+    tableau[:n_lower, artificial:width] = np.eye(n_lower)
+    tableau[:n_lower, -1] = 1
+    tableau[n_lower:, :n] = upper
+    tableau[n_lower:, slack:artificial] = np.eye(n_upper)
+    tableau[n_lower:, -1] = upper_rhs
+    basis = np.concatenate([np.arange(artificial, width), np.arange(slack, artificial)])
+
+    # 第 1 段階: 人工変数の和を最小化して実行可能基底を求める
+    phase_one = np.zeros(width)
+    phase_one[artificial:] = 1
+    if _simplex(tableau, basis, phase_one, np.ones(width, dtype=bool)) is None:
+        return None, None
+    if tableau[basis >= artificial, -1].sum() > 1e-7:
+        return None, None
+
+    # 値 0 で基底に残った人工変数を追い出す
+    for r in np.flatnonzero(basis >= artificial):
+        candidates = np.flatnonzero(np.abs(tableau[r, :artificial]) > SIMPLEX_EPS)
+        if len(candidates):
+            enter = candidates[0]
+            pivot_row = tableau[r] / tableau[r, enter]
+            tableau -= np.outer(tableau[:, enter], pivot_row)
+            tableau[r] = pivot_row
+            basis[r] = enter
+
+    # 第 2 段階: 追加量のコストを最小化
+    phase_two = np.zeros(width)
+    phase_two[:n] = cost
+    allowed = np.ones(width, dtype=bool)
+    allowed[artificial:] = False
+    reduced = _simplex(tableau, basis, phase_two, allowed)
+    if reduced is None:
+        return None, None
+
+    values = np.zeros(width)
+    values[basis] = tableau[:, -1]
+
+    # 余剰・スラック変数の被約費用から双対変数を復元する
+    duals = np.concatenate([reduced[surplus:slack], -reduced[slack:artificial]])
+    return values[:n], duals
+
+def solve_recipe_completion(selected_list, standard_type, categories=None, exclude_categories=None,
+                            max_ingredients=None, warm_start=None):
+    """
+    selected_list に食材を追加して standard_type の基準値をすべて満たすための、
+    追加グラム数の合計が最小となる組み合わせを線形計画法で求める。
+
+    候補列は各不足栄養素のランキング上位と warm_start の食品番号から始め、
+    被約費用が負の食材だけを追加していく列生成法で解く。
+    max_ingredients の食材数では満たせない場合も、不足をできるだけ減らした組み合わせを
+    status "partial" で返し、満たせない栄養素は "unmet" に入れる。
+    """
+    store = get_ingredient_store()
+    standards = get_compiled_standards()
+    if standard_type not in standards.types:
+        raise ValueError(f"unknown standard: {standard_type}")
+    s = standards.types.index(standard_type)
+    defined = standards.defined[s]
+    minimum = np.where(defined, standards.minimum[s], 0)
+    maximum = np.where(defined, standards.maximum[s], np.inf)
+
+    totals, _, errors = recipe_totals(store, [selected_list])
+    if errors:
+        raise ValueError(errors[0])
+    current = totals[0]
+
+    # すでに最大値を超えている栄養素は食材の追加では解消できない
+    deficit = minimum - current
+    room = maximum - current
+    unfixable = np.isfinite(maximum) & (room < 0)
+    lower_nutrients = np.flatnonzero(deficit > SIMPLEX_EPS * np.maximum(minimum, 1))
+    upper_nutrients = np.flatnonzero(np.isfinite(maximum) & ~unfixable)
+
+    # カテゴリで候補食材を絞り込む
+    candidates = np.arange(len(store))
+    if categories:
+        allowed_categories = {str(category) for category in categories}
+        candidates = candidates[[store.categories[row] in allowed_categories for row in candidates]]
+    if exclude_categories:
+        denied_categories = {str(category) for category in exclude_categories}
+        candidates = candidates[[store.categories[row] not in denied_categories for row in candidates]]
+
+    # 1g あたりの寄与を不足量・最大値で正規化した制約行列
+    per_gram = store.matrix[candidates] / 100
+    lower = (per_gram[:, lower_nutrients] / deficit[lower_nutrients]).T
+    upper = (per_gram[:, upper_nutrients] / maximum[upper_nutrients]).T
+    upper_rhs = room[upper_nutrients] / maximum[upper_nutrients]
+
+    # 不足を補えない食材は候補から外し、列を最大値 1 にスケーリングする
+    scale = lower.max(axis=0) if len(lower_nutrients) else np.zeros(len(candidates))
+    useful = scale > 0
+    candidates, lower, upper, scale = candidates[useful], lower[:, useful], upper[:, useful], scale[useful]
+    lower /= scale
+    upper /= scale
+    cost = 1 / scale
+
+    def solve(rhs):
+        """最大値の右辺を rhs にした LP を解き、(スケーリングされた追加量, 状態) を返す"""
+        added = np.zeros(len(candidates))
+        status = "optimal"
+        if not len(lower_nutrients):
+            return added, status
+        # 初期の列: 各不足栄養素の上位食材と前回の解
+        position = {row: k for k, row in enumerate(candidates.tolist())}
+        seed = set()
+        for j in lower_nutrients:
+            seed.update(position[row] for row in store.top_k(NUTRIENT_KEYS[j], 10, ()) if row in position)
+        for code in warm_start or []:
+            row = store.index.get(int(code))
+            if row in position:
+                seed.add(position[row])
+        active = np.array(sorted(seed), dtype=np.intp)
+
+        while True:
+            y, duals = _solve_completion_lp(lower[:, active], upper[:, active], rhs, cost[active])
+            if y is None:
+                if len(active) == len(candidates):
+                    status = "infeasible"
+                    break
+                # 部分問題が実行不能なら全候補で解き直す
+                active = np.arange(len(candidates))
+                continue
+            # 被約費用が負の食材を列に追加する
+            reduced = cost - duals @ np.vstack([lower, upper])
+            reduced[active] = 0
+            entering = np.flatnonzero(reduced < -SIMPLEX_EPS * cost)
+            if not len(entering):
+                added[active] = y
+                break
+            entering = entering[np.argsort(reduced[entering])[:20]]
+            active = np.union1d(active, entering)
+
+        # 食材数の上限を超える場合は寄与の大きい食材だけで解き直す。
+        # それらの食材だけでは満たせない場合は、不足の残りに罰則を付けた LP で不足をできるだけ減らす
+        if status == "optimal" and max_ingredients is not None and np.count_nonzero(added > SIMPLEX_EPS) > max_ingredients:
+            active = np.sort(np.argsort(-added)[:max_ingredients])
+            truncated = added[active]
+            y, _ = _solve_completion_lp(lower[:, active], upper[:, active], rhs, cost[active])
+            if y is None:
+                status = "partial"
+                n_lower = len(lower_nutrients)
+                penalty = np.full(n_lower, SOLVER_SHORTFALL_PENALTY * cost[active].max())
+                y, _ = _solve_completion_lp(
+                    np.hstack([lower[:, active], np.eye(n_lower)]),
+                    np.hstack([upper[:, active], np.zeros((len(upper_nutrients), n_lower))]),
+                    rhs,
+                    np.concatenate([cost[active], penalty]),
+                )
+                y = truncated if y is None else y[:len(active)]
+            added = np.zeros(len(candidates))
+            added[active] = y
+        return added, status
+
+    # スケーリングを戻してグラム数にし、0.01g 単位で切り上げる。
+    # 切り上げで最大値を超えた場合は、超えた分だけ最大値の右辺を厳しくして解き直す
+    added, status = solve(upper_rhs)
+    margin = np.zeros(len(upper_nutrients))
+    for _ in range(SOLVER_ROUNDING_RETRIES):
+        added_grams = np.ceil(np.where(added > SIMPLEX_EPS, added, 0) / scale * 100) / 100
+        final = current + (added_grams / 100) @ store.matrix[candidates]
+        overshoot = (final[upper_nutrients] - maximum[upper_nutrients]) / maximum[upper_nutrients]
+        if status != "optimal" or not (overshoot > 0).any():
+            break
+        margin += np.maximum(overshoot, 0) * 2
+        retry, retry_status = solve(upper_rhs - margin)
+        if retry_status != "optimal":
+            break
+        added = retry
+    added_grams = np.ceil(added / scale * 100) / 100
+    chosen = np.flatnonzero(added > SIMPLEX_EPS)
+    chosen = chosen[np.argsort(-added_grams[chosen], kind='stable')]
+    chosen_rows = candidates[chosen]
+
+    final = current + (added_grams[chosen] / 100) @ store.matrix[chosen_rows]
+    codes = standards.evaluate(final)[0]
+
+    # 丸めた後のグラム数で判定し、基準を満たさない栄養素が残る場合は optimal としない
+    if status == "optimal" and (unfixable.any() or ((codes[s] != STATUS_OK) & defined).any()):
+        status = "partial"
+
+    return {
+        "standard": standard_type,
+        "status": status,
+        "additions": [
+            {"food_code": int(store.food_codes[row]), "name": store.names[row], "grams": float(g)}
+            for row, g in zip(chosen_rows, added_grams[chosen])
+        ],
+        "total_added_grams": round(float(added_grams[chosen].sum()), 2),
+        "nutrient_totals": dict(zip(NUTRIENT_KEYS, final.tolist())),
+        "results": standards.verdicts(codes)[standard_type],
+        "unfixable": [NUTRIENT_KEYS[j] for j in np.flatnonzero(unfixable)],
+        "unmet": [NUTRIENT_KEYS[j] for j in np.flatnonzero((codes[s] != STATUS_OK) & defined)],
+        "warm_start": [int(store.food_codes[row]) for row in chosen_rows],
+    }
 
 
 @app.route('/adjust', methods=['GET', 'POST'])
 def adjust():
     if request.method == 'GET':
         try:
-            # セッションからデータを取得
-            selected_list = session.get('selected_list', [])
-            suggestions = session.get('suggestions', {})  # 提案食材もセッションから取得
-
-            # 選択されたリストを整形
-            selected_food_codes = [item['food_code'] for item in selected_list]
-            ingredients = Ingredient.query.filter(Ingredient.food_code.in_(selected_food_codes)).all()
-            
-            # 初期選択された食材のリストを作成
-            selected_list = [
-                {
-                    'food_code': ing.food_code,
-                    'grams': next((item['grams'] for item in selected_list if str(item['food_code']) == str(ing.food_code)), 100),
-                    'name': ing.name
-                }
-                for ing in ingredients
-            ]
-
-            # 初期の栄養素合計値を計算
-            nutrient_totals = {nutrient: 0 for nutrient in nutrient_labels.keys()}
-            for item in selected_list:
-                food_code = item['food_code']
-                grams = item['grams']
-                ingredient = next((ing for ing in ingredients if ing.food_code == food_code), None)
-                if ingredient:
-                    for nutrient in nutrient_totals.keys():
-                        nutrient_value = getattr(ingredient, nutrient.upper(), 0) or 0
-                        nutrient_totals[nutrient] += nutrient_value * (grams / 100)
-
-            # 判定ロジック（成犬用と幼犬用の両方）
-            adult_deficiencies = [
-                nutrient for nutrient, total in nutrient_totals.items()
-                if total < aafco_standards.get('adult_dog', {}).get(nutrient, {}).get('minimum', 0)
-            ]
-            adult_excesses = [
-                nutrient for nutrient, total in nutrient_totals.items()
-                if aafco_standards.get('adult_dog', {}).get(nutrient, {}).get('maximum') is not None
-                and total > aafco_standards['adult_dog'][nutrient]['maximum']
-            ]
-
-            puppy_deficiencies = [
-                nutrient for nutrient, total in nutrient_totals.items()
-                if total < aafco_standards.get('puppy', {}).get(nutrient, {}).get('minimum', 0)
-            ]
-            puppy_excesses = [
-                nutrient for nutrient, total in nutrient_totals.items()
-                if aafco_standards.get('puppy', {}).get(nutrient, {}).get('maximum') is not None
-                and total > aafco_standards['puppy'][nutrient]['maximum']
-            ]
-
-            # 提案食材を計算
-            puppy_suggestions = suggest_ingredients_for_deficiencies(puppy_deficiencies, [])
-
-
-            # テンプレート用データ
-            response_data = {
-                "nutrient_totals": nutrient_totals,
+            # セッションのレシピ ID（または ?recipe=）から保存済みレシピを取得
+            recipe = get_recipe(request.args.get('recipe') or session.get('recipe_id'))
+            if recipe is None:
+                recipe = RecipeState(None, 0, [])
+
+            # 同じ食品番号をまとめた食材リストと、その合計・判定（レシピのキャッシュを使う）
+            store = get_ingredient_store()
+            standards = get_compiled_standards()
+            with timed_phase('compute'):
+                evaluation = recipe.evaluate(store, standards)
+                selected_list = evaluation["selected_ingredients"]
+                nutrient_totals = dict(zip(NUTRIENT_KEYS, evaluation["total_vector"].tolist()))
+                codes = evaluation["codes"]
+                deficiencies = standards.nutrients_with(codes, STATUS_DEFICIENT)
+                excesses = standards.nutrients_with(codes, STATUS_EXCESS)
+
+            # 提案食材を計算（?standard= がなければ既定の基準タイプ）
+            standard = suggestion_standard(standards, request.args.get('standard'))
+            with timed_phase('suggest'):
+                suggestions = suggest_ingredients_for_deficiencies(store, deficiencies.get(standard, []))
+
+
+            # レシピごとのデータだけをページに埋め込む（栄養素の表示名と基準値は /reference.js から読む）
+            page = {
+                "recipe_id": recipe.id,
+                "recipe_version": recipe.version,
+                "live_events": app.config['LIVE_EVENTS'],
+                "standard": standard,
                 "selected_ingredients": selected_list,
-                "deficiencies": {
-                    "adult_dog": adult_deficiencies,
-                    "puppy": puppy_deficiencies
-                },
-                "excesses": {
-                    "adult_dog": adult_excesses,
-                    "puppy": puppy_excesses
-                },
-                "suggestions": puppy_suggestions,
-                "total_grams": sum(item['grams'] for item in selected_list),
-                "nutrient_labels": nutrient_labels,
-                "aafco_standards": aafco_standards,
+                "nutrient_totals": nutrient_totals,
+                "results": standards.verdicts(codes),
+                "deficiencies": deficiencies.get(standard, []),
+                "excesses": excesses.get(standard, []),
+                "suggestions": suggestions,
+                "total_grams": sum(float(item['grams'] or 0) for item in selected_list),
             }
+            fixed_list = render_fragment(
+                '_fixed_ingredients.html',
+                (recipe_fingerprint(selected_list), store.version),
+                selected_ingredients=selected_list,
+            )
 
-            return render_template('adjust.html', data=response_data)
+            return render_template('adjust.html', page=page, fixed_list=fixed_list)
 
         except Exception as e:
             print(f"Error in GET /adjust: {e}")
-            return render_template('adjust.html', data={})
+            return render_template('adjust.html', page={}, fixed_list='')
 
     if request.method == 'POST':
         try:
             data = request.json
-            session['selected_list'] = data.get('selected_ingredients', [])
-            return jsonify({"message": "Data updated successfully"})
+            selected_list = data.get('selected_ingredients', [])
+            recipe = update_recipe(data.get('recipe_id') or session.get('recipe_id'), selected_list)
+            if recipe is None:
+                recipe = create_recipe(selected_list)
+            session['recipe_id'] = recipe.id
+            return jsonify({"message": "Data updated successfully", "recipe_id": recipe.id, "version": recipe.version})
         except Exception as e:
             print(f"Error in POST /adjust: {e}")
             return jsonify({"error": str(e)}), 500
 
 
+# 1 食材あたりに受け付けるグラム数の上限
+MAX_INGREDIENT_GRAMS = 100000
+
+@app.route('/recipe-delta', methods=['POST'])
+def recipe_delta():
+    """
+    保存済みレシピのグラム数の変更を差分で反映するエンドポイント。
+    {"recipe_id", "version", "food_code", "new_grams"}（複数の場合は "changes": [{"food_code", "new_grams"}, ...]）を受け取り、
+    変更された食材の栄養素ベクトルの差分だけをキャッシュ済みの合計に足して、値が変わった栄養素の合計と判定だけを返す。
+    new_grams が null の食材はレシピから外し、レシピにない食材は追加する。
+    new_grams が有限でない場合や MAX_INGREDIENT_GRAMS を超える場合は 400 を返す。
+    version が現在のバージョンと異なる場合は 409 を返す。グラム数が変わらない場合は保存も通知もしない。
+    """
+    data = request.get_json(silent=True) or {}
+    recipe = get_recipe(data.get('recipe_id') or session.get('recipe_id'))
+    if recipe is None:
+        return jsonify({"error": "recipe not found"}), 404
+    version = data.get('version')
+    if version is not None and version != recipe.version:
+        return jsonify({"error": "version conflict", "version": recipe.version}), 409
+
+    changes = data.get('changes')
+    if changes is None:
+        changes = [{"food_code": data.get('food_code'), "new_grams": data.get('new_grams')}]
+
+    store = get_ingredient_store()
+    standards = get_compiled_standards()
+    evaluation = recipe.evaluate(store, standards)
+
+    # 食材ごとのグラム数の変化量を集める
+    items = dict(zip(evaluation["rows"].tolist(), evaluation["selected_ingredients"]))
+    weights = {}
+    try:
+        for change in changes:
+            code = int(change['food_code'])
+            new_grams = change.get('new_grams')
+            new_grams = None if new_grams is None else float(new_grams)
+            if new_grams is not None and not (np.isfinite(new_grams) and 0 <= new_grams <= MAX_INGREDIENT_GRAMS):
+                raise ValueError(f"grams out of range for food_code {code}: {new_grams!r}")
+            row = store.index.get(code)
+            if row is None:
+                raise ValueError(f"unknown food_code: {code}")
+
+            old_grams = float(items[row]['grams'] or 0) if row in items else 0.0
+            weights[row] = weights.get(row, 0.0) + (new_grams or 0.0) - old_grams
+            if new_grams is None:
+                items.pop(row, None)
+            else:
+                items[row] = {'food_code': code, 'grams': new_grams, 'name': store.names[row]}
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        return jsonify({"error": f"invalid change: {e}"}), 400
+
+    # 同じグラム数や差し引きゼロの変更では、バージョンを上げず保存もしない
+    if not any(weights.values()) and items.keys() == set(evaluation["rows"].tolist()):
+        return jsonify({
+            "recipe_id": recipe.id,
+            "version": recipe.version,
+            "nutrient_totals": {},
+            "results": {standard_type: {} for standard_type in standards.types},
+            "total_grams": sum(float(item['grams'] or 0) for item in evaluation["selected_ingredients"]),
+        })
+
+    # 変化した食材が含む栄養素の列だけを、レシピの全食材から計算し直して判定し直す。
+    # 差分を足し込むと丸め誤差が積み重なり、基準値ちょうどの栄養素の判定が変わることがあるため
+    rows = sorted(items)
+    selected_ingredients = [items[row] for row in rows]
+    grams = np.array([float(item['grams'] or 0) for item in selected_ingredients], dtype=np.float64)
+    changed_rows = np.array([row for row, weight in weights.items() if weight], dtype=np.intp)
+    columns = np.flatnonzero((store.matrix[changed_rows] != 0).any(axis=0))
+    total_vector = evaluation["total_vector"].copy()
+    total_vector[columns] = (store.matrix[rows][:, columns] * (grams / 100)[:, np.newaxis]).sum(axis=0)
+    codes = evaluation["codes"].copy()
+    codes[:, columns] = standards.evaluate_columns(total_vector, columns)
+
+    updated = update_recipe(
+        recipe.id,
+        [{'food_code': item['food_code'], 'grams': item['grams']} for item in selected_ingredients],
+        expected_version=recipe.version,
+    )
+    if updated is None:
+        current = get_recipe(recipe.id)
+        if current is None:
+            return jsonify({"error": "recipe not found"}), 404
+        return jsonify({"error": "version conflict", "version": current.version}), 409
+    if updated.version == recipe.version + 1:
+        updated.seed({
+            "store_version": store.version,
+            "standards": standards,
+            "selected_ingredients": selected_ingredients,
+            "rows": np.array(rows, dtype=np.intp),
+            "grams": grams,
+            "total_vector": total_vector,
+            "codes": codes,
+        })
+
+    labels = np.array(STATUS_LABELS, dtype=object)
+    values = total_vector[columns].tolist()
+    return jsonify({
+        "recipe_id": updated.id,
+        "version": updated.version,
+        "nutrient_totals": {NUTRIENT_KEYS[j]: value for j, value in zip(columns, values)},
+        "results": {
+            standard_type: {
+                NUTRIENT_KEYS[j]: labels[codes[i, j]] for j in columns if standards.defined[i, j]
+            }
+            for i, standard_type in enumerate(standards.types)
+        },
+        "total_grams": sum(float(item['grams'] or 0) for item in selected_ingredients),
+    })
+
+# ライブ評価チャネルで編集をまとめる待ち時間、他のワーカーの更新を確認する間隔、keep-alive の間隔（秒）
+RECIPE_EVENTS_DEBOUNCE = 0.15
+RECIPE_EVENTS_POLL = 1.0
+RECIPE_EVENTS_KEEPALIVE = 15.0
+
+def recipe_evaluation(recipe, standard=None):
+    """レシピの栄養素合計・判定・standard の基準での提案食材をまとめる（ライブ評価チャネルで送る内容）"""
+    store = get_ingredient_store()
+    standards = get_compiled_standards()
+    evaluation = recipe.evaluate(store, standards)
+    codes = evaluation["codes"]
+    deficiencies = standards.nutrients_with(codes, STATUS_DEFICIENT)
+    excesses = standards.nutrients_with(codes, STATUS_EXCESS)
+    standard = suggestion_standard(standards, standard)
+    return {
+        "recipe_id": recipe.id,
+        "version": recipe.version,
+        "nutrient_totals": dict(zip(NUTRIENT_KEYS, evaluation["total_vector"].tolist())),
+        "results": standards.verdicts(codes),
+        "deficiencies": deficiencies,
+        "excesses": excesses,
+        "standard": standard,
+        "suggestions": suggest_ingredients_for_deficiencies(store, deficiencies.get(standard, [])),
+        "total_grams": float(evaluation["grams"].sum()),
+    }
+
+@app.route('/recipe-events', methods=['GET'])
+def recipe_events_stream():
+    """
+    保存済みレシピのライブ評価を Server-Sent Events で配信するエンドポイント。
+    レシピが更新されると、RECIPE_EVENTS_DEBOUNCE 秒以内に続いた更新をまとめてから最新の状態だけを評価し、
+    evaluation イベント（栄養素合計・判定・提案食材）を送る。
+    多数の接続を保持する場合は gevent などの非同期ワーカーで動かす。
+    ライブ評価が無効な場合は 204 を返す（EventSource は再接続しない）。
+    """
+    if not app.config['LIVE_EVENTS']:
+        return Response(status=204)
+    recipe_id = request.args.get('recipe_id') or session.get('recipe_id')
+    if get_recipe(recipe_id) is None:
+        return jsonify({"error": "recipe not found"}), 404
+    standard = request.args.get('standard')
+
+    # 再接続時は送信済みのバージョンを飛ばす
+    try:
+        sent_version = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        sent_version = None
+
+    def generate():
+        channel = recipe_events.subscribe(recipe_id)
+        try:
+            seen = channel[2]
+            last_sent = time.monotonic()
+            version = sent_version
+            while True:
+                recipe = get_recipe(recipe_id)
+                db.session.remove()  # 待機中はデータベース接続を持たない
+                if recipe is None:
+                    yield "event: deleted\ndata: {}\n\n"
+                    return
+
+                if recipe.version != version:
+                    # 続けて届く編集が落ち着くまで待ってから、最新の状態だけを評価する
+                    if version is not None:
+                        while True:
+                            latest = RecipeEvents.wait(channel, seen, RECIPE_EVENTS_DEBOUNCE)
+                            if latest == seen:
+                                break
+                            seen = latest
+                        recipe = get_recipe(recipe_id) or recipe
+                    payload = orjson.dumps(recipe_evaluation(recipe, standard)).decode()
+                    db.session.remove()
+                    version = recipe.version
+                    last_sent = time.monotonic()
+                    yield f"id: {version}\nevent: evaluation\ndata: {payload}\n\n"
+                    continue
+
+                seen = RecipeEvents.wait(channel, seen, RECIPE_EVENTS_POLL)
+                if time.monotonic() - last_sent >= RECIPE_EVENTS_KEEPALIVE:
+                    last_sent = time.monotonic()
+                    yield ": keep-alive\n\n"
+        finally:
+            recipe_events.unsubscribe(recipe_id)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.route('/calculate-nutrients', methods=['POST'])
 def calculate_nutrients_endpoint():
     try:
         data = request.json
         selected_ingredients = data.get('selected_ingredients', [])
+        basis = data.get('basis', DEFAULT_BASIS)
+        if basis not in BASES:
+            return jsonify({"error": f"unknown basis: {basis}"}), 400
 
-        # 栄養素合計の初期化
-        nutrient_totals = {nutrient: 0 for nutrient in aafco_standards["adult_dog"].keys()}
+        # basis での栄養素の合計と基準ごとの判定（同じレシピの結果はキャッシュから）
+        evaluation = evaluate_recipe(selected_ingredients, basis)
 
-        # 各食材の栄養素を合計
-        for item in selected_ingredients:
-            food_code = item.get('food_code')
-            grams = item.get('grams', 0)
+        return jsonify({
+            "nutrient_totals": nutrient_totals_dict(evaluation["total_vector"]),
+            "results": evaluation["results"],
+            "basis": basis,
+        })
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-            # 食材データを取得 (仮: データベースやリストから)
-            ingredient = Ingredient.query.filter_by(food_code=food_code).first()
-            if not ingredient:
-                continue
 
-            for nutrient in nutrient_totals.keys():
-                value_per_100g = getattr(ingredient, nutrient, 0) or 0
-                nutrient_totals[nutrient] += value_per_100g * (grams / 100)
-
-        # 判定結果を基準ごとに作成
-        results = {}
-        for standard_type, standards in aafco_standards.items():
-            results[standard_type] = {}
-            for nutrient, values in standards.items():
-                total = nutrient_totals.get(nutrient, 0)
-                minimum = values["minimum"]
-                maximum = values["maximum"]
-
-                if total < minimum:
-                    results[standard_type][nutrient] = "不足"
-                elif maximum is not None and total > maximum:
-                    results[standard_type][nutrient] = "過剰"
+# バッチ計算で一度に処理するレシピ数
+BATCH_CHUNK_SIZE = 1000
+
+@app.route('/calculate-nutrients/batch', methods=['POST'])
+def calculate_nutrients_batch():
+    """
+    複数レシピの栄養素合計と判定をまとめて計算するエンドポイント。
+    {"recipes": [{"id": ..., "selected_ingredients": [...]}, ...]} を受け取り、
+    1 レシピ 1 行の NDJSON をストリーミングで返す。
+    "bases" に basis のリスト（または "all"）を指定すると、各行の "bases" に
+    {basis: {"nutrient_totals", "results"}} を 1 回の計算でまとめて返す。
+    """
+    # 大きなリクエストボディは orjson で直接パースする
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError as e:
+        return jsonify({"error": f"invalid JSON: {e}"}), 400
+    recipes = data.get('recipes') if isinstance(data, dict) else None
+    if not isinstance(recipes, list):
+        return jsonify({"error": "recipes must be a list"}), 400
+    bases = data.get('bases')
+    if bases == "all":
+        bases = list(BASES)
+    if bases is not None and (not isinstance(bases, list) or any(basis not in BASES for basis in bases)):
+        return jsonify({"error": f"bases must be a list of {', '.join(BASES)} or \"all\""}), 400
+
+    store = get_ingredient_store()
+    standards = get_compiled_standards()
+
+    def generate():
+        for start in range(0, len(recipes), BATCH_CHUNK_SIZE):
+            chunk = recipes[start:start + BATCH_CHUNK_SIZE]
+            ids = [recipe.get('id') if isinstance(recipe, dict) else None for recipe in chunk]
+            selected_lists = [
+                recipe.get('selected_ingredients', []) if isinstance(recipe, dict) else recipe
+                for recipe in chunk
+            ]
+
+            # レシピ×食材の疎行列と栄養素行列の積で合計を計算し、一括判定
+            totals, total_grams, errors = recipe_totals(store, selected_lists)
+
+            if bases is None:
+                total_rows = totals.tolist()
+                results = standards.verdicts_many(standards.evaluate(totals))
+                per_basis = None
+            else:
+                # basis ごとに合計行列全体を一度に換算・判定する
+                per_basis = []
+                for basis in bases:
+                    normalized = normalize_totals(totals, total_grams, basis)
+                    per_basis.append((basis, normalized.tolist(), standards.verdicts_many(standards.evaluate(normalized, basis))))
+
+            lines = []
+            for offset in range(len(chunk)):
+                line = {"index": start + offset, "id": ids[offset]}
+                if offset in errors:
+                    line["error"] = errors[offset]
+                elif per_basis is None:
+                    line["nutrient_totals"] = dict(zip(NUTRIENT_KEYS, total_rows[offset]))
+                    line["results"] = results[offset]
                 else:
-                    results[standard_type][nutrient] = "適合"
+                    line["bases"] = {
+                        basis: {"nutrient_totals": dict(zip(NUTRIENT_KEYS, values[offset])), "results": verdicts[offset]}
+                        for basis, values, verdicts in per_basis
+                    }
+                lines.append(orjson.dumps(line))
+            yield b"\n".join(lines) + b"\n"
 
-        return jsonify({
-            "nutrient_totals": nutrient_totals,
-            "results": results
-        })
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+# 献立の評価で平均をとる日数（既定）と上限、一度に処理する献立の数
+MEAL_PLAN_WINDOWS = (7, 30)
+MEAL_PLAN_MAX_WINDOW = 366
+MEAL_PLAN_CHUNK_SIZE = 200
+
+def parse_meal_plan(plan, shared_recipes, recipe_lists, recipe_rows, scope):
+    """
+    献立 {"days": [[食事, ...], ...], "recipes": {名前: selected_list}} を読み、
+    食事ごとのレシピ番号（recipe_lists の位置）と日ごとの食事数を返す。
+    食事は selected_list か、献立または共通の "recipes" に登録したレシピの名前で指定する。
+    名前で指定したレシピは recipe_rows に登録して一度だけ計算する。
+    """
+    days = plan.get('days') if isinstance(plan, dict) else None
+    if not isinstance(days, list):
+        raise ValueError("days must be a list")
+    local_recipes = plan.get('recipes') or {}
+    if not isinstance(local_recipes, dict):
+        raise ValueError("recipes must be an object")
+
+    meals, day_sizes = [], []
+    for day in days:
+        if not isinstance(day, list):
+            raise ValueError("each day must be a list of meals")
+        for meal in day:
+            if isinstance(meal, str):
+                if meal in local_recipes:
+                    key, selected_list = (scope, meal), local_recipes[meal]
+                elif meal in shared_recipes:
+                    key, selected_list = (None, meal), shared_recipes[meal]
+                else:
+                    raise ValueError(f"unknown recipe: {meal}")
+                if key not in recipe_rows:
+                    recipe_rows[key] = len(recipe_lists)
+                    recipe_lists.append(selected_list)
+                meals.append(recipe_rows[key])
+            elif isinstance(meal, list):
+                meals.append(len(recipe_lists))
+                recipe_lists.append(meal)
+            else:
+                raise ValueError("each meal must be a selected_list or a recipe name")
+        day_sizes.append(len(day))
+    return meals, day_sizes
+
+def rolling_window_sums(cumulative, starts, lengths, window):
+    """
+    献立ごとに連続した日の累積和 cumulative (日数 + 1, 列数) から、各献立の中で window 日分そろう
+    全ての期間の合計を計算し、(期間の合計, 期間の最終日の通し番号, 期間の献立番号) を返す。
+    """
+    counts = np.maximum(lengths - window + 1, 0)
+    plan_of = np.repeat(np.arange(len(lengths)), counts)
+    first = np.repeat(starts + window - 1 - np.cumsum(counts) + counts, counts)
+    ends = first + np.arange(counts.sum())
+    return cumulative[ends + 1] - cumulative[ends + 1 - window], ends, plan_of
+
+@app.route('/meal-plan', methods=['POST'])
+def meal_plan():
+    """
+    複数日の献立（ローテーション）を移動平均で評価するエンドポイント。
+    {"plans": [{"id": ..., "days": [[食事, ...], ...], "recipes": {...}}, ...], "recipes": {...},
+     "windows": [7, 30], "basis": "as_fed"} を受け取り、1 献立 1 行の NDJSON をストリーミングで返す。
+    各行の "windows" には日数ごとに期間の数・基準タイプごとの適合した期間の数と、
+    基準を満たさない期間を判定が同じものが続く範囲にまとめた
+    {"end_days": [最初の期間の最終日, 最後の期間の最終日], "deficient": [...], "excess": [...]} のリストを入れる。
+    日は 0 から数え、献立の日数より長い期間は評価しない。
+    """
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError as e:
+        return jsonify({"error": f"invalid JSON: {e}"}), 400
+    plans = data.get('plans') if isinstance(data, dict) else None
+    if not isinstance(plans, list):
+        return jsonify({"error": "plans must be a list"}), 400
+    shared_recipes = data.get('recipes') or {}
+    if not isinstance(shared_recipes, dict):
+        return jsonify({"error": "recipes must be an object"}), 400
+    windows = data.get('windows', list(MEAL_PLAN_WINDOWS))
+    if not isinstance(windows, list) or not windows or any(
+            not isinstance(window, int) or isinstance(window, bool) or not 1 <= window <= MEAL_PLAN_MAX_WINDOW
+            for window in windows):
+        return jsonify({"error": f"windows must be a list of integers between 1 and {MEAL_PLAN_MAX_WINDOW}"}), 400
+    basis = data.get('basis', DEFAULT_BASIS)
+    if basis not in BASES:
+        return jsonify({"error": f"unknown basis: {basis}"}), 400
+
+    store = get_ingredient_store()
+    standards = get_compiled_standards()
+    nutrients = len(NUTRIENT_KEYS)
+
+    def generate():
+        for start in range(0, len(plans), MEAL_PLAN_CHUNK_SIZE):
+            chunk = plans[start:start + MEAL_PLAN_CHUNK_SIZE]
+            recipe_lists, recipe_rows, errors = [], {}, {}
+            meals, day_sizes, lengths = [], [], []
+            for offset, plan in enumerate(chunk):
+                try:
+                    plan_meals, plan_days = parse_meal_plan(plan, shared_recipes, recipe_lists, recipe_rows, offset)
+                except (TypeError, ValueError) as e:
+                    errors[offset] = f"invalid plan: {e}"
+                    plan_meals, plan_days = [], []
+                meals.append(plan_meals)
+                day_sizes.extend(plan_days)
+                lengths.append(len(plan_days))
+
+            # レシピごとの栄養素合計と合計グラム数を一括で計算する
+            totals, total_grams, recipe_errors = recipe_totals(store, recipe_lists)
+            recipe_values = np.column_stack([totals, total_grams])
+            for offset, plan_meals in enumerate(meals):
+                failed = next((recipe for recipe in plan_meals if recipe in recipe_errors), None)
+                if failed is not None and offset not in errors:
+                    errors[offset] = recipe_errors[failed]
+
+            # 日×レシピの疎行列とレシピの合計の積で日ごとの合計を求め、累積和から全ての期間の合計を取り出す
+            meal_recipes = np.fromiter((recipe for plan_meals in meals for recipe in plan_meals), dtype=np.intp)
+            day_indptr = np.zeros(len(day_sizes) + 1, dtype=np.intp)
+            np.cumsum(day_sizes, out=day_indptr[1:])
+            daily = np.zeros((len(day_sizes), nutrients + 1))
+            nonempty = np.flatnonzero(np.diff(day_indptr))
+            if len(nonempty):
+                daily[nonempty] = np.add.reduceat(recipe_values[meal_recipes], day_indptr[nonempty], axis=0)
+            cumulative = np.zeros((len(day_sizes) + 1, nutrients + 1))
+            np.cumsum(daily, axis=0, out=cumulative[1:])
+            lengths = np.array(lengths, dtype=np.intp)
+            starts = np.zeros(len(lengths), dtype=np.intp)
+            np.cumsum(lengths[:-1], out=starts[1:])
+
+            summaries = [{} for _ in chunk]
+            for window in windows:
+                sums, ends, plan_of = rolling_window_sums(cumulative, starts, lengths, window)
+                averages = sums / window
+                normalized = normalize_totals(averages[:, :nutrients], averages[:, nutrients], basis)
+                codes = standards.evaluate(normalized, basis) * standards.defined
+                failing = codes.any(axis=2)
+
+                # 同じ献立の中で判定が前の期間と変わる所を区切りにして、基準を満たさない範囲をまとめる
+                changed = np.ones(codes.shape[:2], dtype=bool)
+                changed[1:] = (codes[1:] != codes[:-1]).any(axis=2) | (plan_of[1:] != plan_of[:-1])[:, np.newaxis]
+                window_counts = np.bincount(plan_of, minlength=len(chunk))
+                compliant = np.zeros((len(chunk), len(standards.types)), dtype=np.intp)
+                np.add.at(compliant, plan_of, ~failing)
+                for offset in range(len(chunk)):
+                    summaries[offset][str(window)] = {
+                        "count": int(window_counts[offset]),
+                        "compliant": dict(zip(standards.types, compliant[offset].tolist())),
+                        "out_of_compliance": {standard_type: [] for standard_type in standards.types},
+                    }
+                day_of = ends - starts[plan_of]
+                for s, standard_type in enumerate(standards.types):
+                    boundaries = np.flatnonzero(changed[:, s])
+                    last = np.append(boundaries[1:], len(codes)) - 1
+                    keep = failing[boundaries, s]
+                    boundaries, last = boundaries[keep], last[keep]
+                    # 判定の組み合わせは限られるので、不足・過剰の栄養素のリストは組み合わせごとに一度だけ作る
+                    run_codes = np.ascontiguousarray(codes[boundaries, s], dtype=np.int8)
+                    keys = run_codes.view(np.dtype((np.void, nutrients))).reshape(-1)
+                    _, pattern_rows, pattern_of = np.unique(keys, return_index=True, return_inverse=True)
+                    nutrient_lists = [
+                        ([NUTRIENT_KEYS[j] for j in np.flatnonzero(run_codes[row] == STATUS_DEFICIENT)],
+                         [NUTRIENT_KEYS[j] for j in np.flatnonzero(run_codes[row] == STATUS_EXCESS)])
+                        for row in pattern_rows.tolist()
+                    ]
+                    for offset, first_day, last_day, pattern in zip(plan_of[boundaries].tolist(), day_of[boundaries].tolist(),
+                                                                    day_of[last].tolist(), pattern_of.reshape(-1).tolist()):
+                        deficient, excess = nutrient_lists[pattern]
+                        summaries[offset][str(window)]["out_of_compliance"][standard_type].append(
+                            {"end_days": [first_day, last_day], "deficient": deficient, "excess": excess})
+
+            lines = []
+            for offset, plan in enumerate(chunk):
+                line = {"index": start + offset, "id": plan.get('id') if isinstance(plan, dict) else None}
+                if offset in errors:
+                    line["error"] = errors[offset]
+                else:
+                    line.update({"days": int(lengths[offset]), "basis": basis, "windows": summaries[offset]})
+                lines.append(orjson.dumps(line))
+            yield b"\n".join(lines) + b"\n"
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+# エクスポートの形式と、ファイルから送り出す時の 1 回あたりのバイト数
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "parquet": "application/vnd.apache.parquet",
+}
+EXPORT_FIXED_COLUMNS = ("recipe_id", "row_type", "standard", "food_code", "name", "grams")
+EXPORT_DECIMALS = 6  # 食品成分表の値は小数 3 桁以下なので、寄与は小数 6 桁に丸めて出力を短くする
+EXPORT_STREAM_BLOCK = 1 << 16
+
+def export_columns():
+    """エクスポートの列名（栄養素は「名前 (単位)」）"""
+    return list(EXPORT_FIXED_COLUMNS) + [f"{label} ({unit})" for label, unit in nutrient_labels.values()]
+
+def export_chunks(recipes):
+    """
+    エクスポートする行を BATCH_CHUNK_SIZE レシピずつ作って返すジェネレーター。
+    先頭に基準タイプごとの最小値・最大値の行を出し、その後にレシピごとの食材別の寄与（ingredient）と合計（total）の行を出す。
+    recipes は (レシピ ID, selected_list) のリスト。
+    """
+    store = get_ingredient_store()
+    standards = get_compiled_standards()
+
+    limit_rows = []
+    for i, standard_type in enumerate(standards.types):
+        for row_type, limits in (("minimum", standards.minimum[i]), ("maximum", standards.maximum[i])):
+            values = [
+                float(value) if defined and np.isfinite(value) else None
+                for value, defined in zip(limits.tolist(), standards.defined[i].tolist())
+            ]
+            limit_rows.append([None, row_type, standard_type, None, None, None] + values)
+    yield limit_rows
+
+    empty = [None] * len(NUTRIENT_KEYS)
+    for start in range(0, len(recipes), BATCH_CHUNK_SIZE):
+        chunk = recipes[start:start + BATCH_CHUNK_SIZE]
+        indptr, rows, grams, errors = store.lookup_many([selected_list for _, selected_list in chunk])
+
+        # 食材ごとの寄与と、その CSR 行ごとの合計
+        contributions = store.matrix[rows] * (grams / 100)[:, np.newaxis]
+        totals = np.zeros((len(chunk), len(NUTRIENT_KEYS)))
+        counts = np.diff(indptr)
+        nonempty = np.flatnonzero(counts)
+        if len(nonempty):
+            totals[nonempty] = np.add.reduceat(contributions, indptr[nonempty], axis=0)
+        total_grams = np.bincount(np.repeat(np.arange(len(chunk)), counts), weights=grams, minlength=len(chunk))
+
+        codes = store.food_codes[rows].tolist()
+        row_list = rows.tolist()
+        gram_list = grams.tolist()
+        contribution_rows = np.round(contributions, EXPORT_DECIMALS).tolist()
+        total_rows = np.round(totals, EXPORT_DECIMALS).tolist()
+        total_gram_list = total_grams.tolist()
+
+        out = []
+        for offset, (recipe_id, _) in enumerate(chunk):
+            if offset in errors:
+                out.append([recipe_id, "error", None, None, errors[offset], None] + empty)
+                continue
+            for k in range(indptr[offset], indptr[offset + 1]):
+                out.append([recipe_id, "ingredient", None, codes[k], store.names[row_list[k]], gram_list[k]] + contribution_rows[k])
+            out.append([recipe_id, "total", None, None, None, total_gram_list[offset]] + total_rows[offset])
+        yield out
+
+def _export_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')  # Excel で文字化けしないよう BOM を付ける
+    writer.writerow(export_columns())
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+def _stream_file(f):
+    f.seek(0)
+    while True:
+        block = f.read(EXPORT_STREAM_BLOCK)
+        if not block:
+            return
+        yield block
+
+def _export_xlsx(chunks):
+    # write_only のワークブックは行を一時ファイルに書き出すので、メモリに全行を持たない
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('nutrients')
+    sheet.append(export_columns())
+    for rows in chunks:
+        for row in rows:
+            sheet.append(row)
+    with tempfile.TemporaryFile() as f:
+        workbook.save(f)
+        yield from _stream_file(f)
+
+def _export_parquet(chunks):
+    # チャンクごとに 1 つの row group として書き出す
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    types = [pa.string(), pa.string(), pa.string(), pa.int64(), pa.string(), pa.float64()]
+    types += [pa.float64()] * len(NUTRIENT_KEYS)
+    schema = pa.schema(list(zip(export_columns(), types)))
+    with tempfile.TemporaryFile() as f:
+        with pq.ParquetWriter(f, schema) as writer:
+            for rows in chunks:
+                columns = [list(column) for column in zip(*rows)]
+                columns[0] = [None if value is None else str(value) for value in columns[0]]
+                arrays = [pa.array(column, type=field.type) for column, field in zip(columns, schema)]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        yield from _stream_file(f)
+
+@app.route('/export', methods=['POST'])
+def export_nutrients():
+    """
+    レシピの食材別の栄養素寄与・合計・AAFCO 基準値をエクスポートするエンドポイント（?format=csv|xlsx|parquet、既定は csv）。
+    {"recipe_id": ...}（保存済みレシピ）、{"selected_ingredients": [...]}、
+    または {"recipes": [{"id": ..., "selected_ingredients": [...]}, ...]} を受け取る。
+    本文がない場合はセッションのレシピを出力する。
+    行は BATCH_CHUNK_SIZE レシピずつ作って書き出すので、大量のレシピでもメモリ使用量は一定に保たれる。
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    if export_format == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return jsonify({"error": "parquet export requires pyarrow"}), 501
 
+    body = request.get_data()
+    try:
+        data = orjson.loads(body) if body and request.is_json else {}
+    except orjson.JSONDecodeError as e:
+        return jsonify({"error": f"invalid JSON: {e}"}), 400
+    if not isinstance(data, dict):
+        return jsonify({"error": "request body must be an object"}), 400
+
+    if isinstance(data.get('recipes'), list):
+        recipes = [
+            (recipe.get('id', index) if isinstance(recipe, dict) else index,
+             recipe.get('selected_ingredients', []) if isinstance(recipe, dict) else recipe)
+            for index, recipe in enumerate(data['recipes'])
+        ]
+    elif 'selected_ingredients' in data:
+        recipes = [(data.get('id', 0), data['selected_ingredients'])]
+    else:
+        recipe = get_recipe(data.get('recipe_id') or session.get('recipe_id'))
+        if recipe is None:
+            return jsonify({"error": "recipe not found"}), 404
+        recipes = [(recipe.id, recipe.selected_list)]
+
+    writers = {"csv": _export_csv, "xlsx": _export_xlsx, "parquet": _export_parquet}
+    filename = f"nutrients-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{export_format}"
+    return Response(
+        writers[export_format](export_chunks(recipes)),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+# バックグラウンドジョブ
+# Web ワーカーはジョブを job テーブルに登録するだけで、処理は別プロセスの `flask run-jobs` が行う。
+# ワーカーはレシピを JOB_BATCH_SIZE 件ずつ読み、JOB_SHARD_SIZE 件ずつプロセスプールで一括判定して、
+# 結果と進捗（チェックポイント）を 1 つのトランザクションで書き込む。途中で止まっても続きから再開できる。
+JOB_KINDS = ("reevaluate",)
+JOB_BATCH_SIZE = 5000
+JOB_SHARD_SIZE = 1000
+JOB_POLL_INTERVAL = 2.0  # 待機中に新しいジョブを確認する間隔（秒）
+JOB_STALE_AFTER = 300  # 進捗がこの秒数より長く書き込まれていない running のジョブは止まったとみなして引き継ぐ
+JOB_RESULTS_MAX_LIMIT = 1000
+
+def job_dict(job):
+    """ジョブの状態を JSON 用の辞書にする"""
+    def timestamp(value):
+        return value.isoformat() if value else None
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "params": orjson.loads(job.params),
+        "total": job.total,
+        "processed": job.processed,
+        "progress": job.processed / job.total if job.total else (1.0 if job.status == 'done' else 0.0),
+        "summary": orjson.loads(job.summary) if job.summary else None,
+        "error": job.error,
+        "created_at": timestamp(job.created_at),
+        "started_at": timestamp(job.started_at),
+        "finished_at": timestamp(job.finished_at),
+    }
+
+def enqueue_job(kind, params):
+    """ジョブを登録する（処理は flask run-jobs のワーカーが行う）"""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"unknown job kind: {kind}")
+    job_id = secrets.token_urlsafe(8)
+    while db.session.get(Job, job_id) is not None:
+        job_id = secrets.token_urlsafe(8)
+    job = Job(
+        id=job_id,
+        kind=kind,
+        status='queued',
+        params=orjson.dumps(params).decode(),
+        created_at=datetime.now(timezone.utc),
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def claim_job():
+    """
+    待機中のジョブ（または進捗が止まった running のジョブ）を 1 件取得して running にする。
+    複数のワーカーが同時に取得しないよう、状態を条件にした UPDATE の件数で確認する。
+    """
+    now = datetime.now(timezone.utc)
+    stale = now.timestamp() - JOB_STALE_AFTER
+    candidates = (
+        db.session.query(Job.id, Job.status, Job.heartbeat_at)
+        .filter(Job.status.in_(('queued', 'running')))
+        .order_by(Job.created_at)
+        .all()
+    )
+    for job_id, status, heartbeat_at in candidates:
+        if status == 'running' and heartbeat_at is not None \
+                and heartbeat_at.replace(tzinfo=timezone.utc).timestamp() > stale:
+            continue
+        unchanged = Job.heartbeat_at.is_(None) if heartbeat_at is None else Job.heartbeat_at == heartbeat_at
+        claimed = (
+            db.session.query(Job)
+            .filter(Job.id == job_id, Job.status == status, unchanged)
+            .update({"status": 'running', "heartbeat_at": now}, synchronize_session=False)
+        )
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+    return None
+
+def _reevaluate_shard(selected_lists, standard, basis):
+    """
+    プロセスプールで実行する: JSON 文字列の selected_list をまとめて判定し、
+    レシピごとに (不足の栄養素, 過剰の栄養素, エラー) を返す。
+    同じ食品番号のグラム数は /calculate・/adjust と同じく足し合わせる。
+    standard は (基準タイプ, 基準値の辞書, 最小値, 最大値, 定義済み) で、親プロセスで固定したものを使う。
+    """
+    with app.app_context():
+        store = get_ingredient_store()
+    standard_type, source, minimum, maximum, defined = standard
+    standards = CompiledStandards.from_arrays({standard_type: source}, minimum, maximum, defined)
+
+    recipes, errors = [], {}
+    for position, text in enumerate(selected_lists):
+        try:
+            recipes.append(orjson.loads(text))
+        except ValueError as e:
+            errors[position] = f"invalid recipe: {e}"
+            recipes.append([])
+
+    _, _, codes, lookup_errors = evaluate_recipes(store, standards, recipes, basis)
+    errors.update(lookup_errors)
+    codes = codes[:, 0, :]
+
+    results = []
+    for position in range(len(recipes)):
+        if position in errors:
+            results.append(([], [], errors[position]))
+            continue
+        results.append((
+            [NUTRIENT_KEYS[j] for j in np.flatnonzero(codes[position] == STATUS_DEFICIENT)],
+            [NUTRIENT_KEYS[j] for j in np.flatnonzero(codes[position] == STATUS_EXCESS)],
+            None,
+        ))
+    return results
+
+def shard_standard(standards, standard_type):
+    """_reevaluate_shard に渡す 1 基準タイプ分の (基準タイプ, 基準値の辞書, 最小値, 最大値, 定義済み)"""
+    if standard_type not in standards.types:
+        raise ValueError(f"unknown standard: {standard_type}")
+    s = standards.types.index(standard_type)
+    return (
+        standard_type,
+        standards.source[standard_type],
+        np.array(standards.minimum[s:s + 1]),
+        np.array(standards.maximum[s:s + 1]),
+        np.array(standards.defined[s:s + 1]),
+    )
+
+def run_reevaluation(job, pool):
+    """保存済みレシピをすべて params の基準タイプ・basis で判定し直す"""
+    params = orjson.loads(job.params)
+    standards = get_compiled_standards()
+    standard_type = params["standard"]
+    standard = shard_standard(standards, standard_type)
+    basis = params.get("basis", DEFAULT_BASIS)
+
+    if job.summary:
+        summary = orjson.loads(job.summary)
+    else:
+        job.total = db.session.query(Recipe).count()
+        summary = {
+            "ok": 0, "fail": 0, "error": 0,
+            "deficiencies": {}, "excesses": {},
+            "store_version": get_ingredient_store().version,
+            "standards_version": standards.version,
+        }
+
+    statement = sqlite_insert(JobResult.__table__).on_conflict_do_nothing()
+    while True:
+        # キャンセルされていれば次のバッチに進まない
+        db.session.refresh(job)
+        if job.status != 'running':
+            return
+        query = db.session.query(Recipe.id, Recipe.selected_list).order_by(Recipe.id)
+        if job.checkpoint is not None:
+            query = query.filter(Recipe.id > job.checkpoint)
+        batch = query.limit(JOB_BATCH_SIZE).all()
+        if not batch:
+            break
+
+        shards = [batch[start:start + JOB_SHARD_SIZE] for start in range(0, len(batch), JOB_SHARD_SIZE)]
+        outputs = pool.map(
+            _reevaluate_shard,
+            [[selected_list for _, selected_list in shard] for shard in shards],
+            [standard] * len(shards),
+            [basis] * len(shards),
+        )
+
+        records = []
+        for shard, results in zip(shards, outputs):
+            for (recipe_id, _), (deficiencies, excesses, error) in zip(shard, results):
+                status = 'error' if error else ('fail' if deficiencies or excesses else 'ok')
+                summary[status] += 1
+                for nutrient in deficiencies:
+                    summary["deficiencies"][nutrient] = summary["deficiencies"].get(nutrient, 0) + 1
+                for nutrient in excesses:
+                    summary["excesses"][nutrient] = summary["excesses"].get(nutrient, 0) + 1
+                records.append({
+                    "job_id": job.id,
+                    "recipe_id": recipe_id,
+                    "status": status,
+                    "deficiencies": orjson.dumps(deficiencies).decode(),
+                    "excesses": orjson.dumps(excesses).decode(),
+                    "error": error,
+                })
+
+        # 結果とチェックポイントを同じトランザクションで書き込む
+        db.session.execute(statement, records)
+        job.processed += len(batch)
+        job.total = max(job.total, job.processed)
+        job.checkpoint = batch[-1][0]
+        job.summary = orjson.dumps(summary).decode()
+        job.heartbeat_at = datetime.now(timezone.utc)
+        db.session.commit()
+
+    job.status = 'done'
+    job.finished_at = datetime.now(timezone.utc)
+    db.session.commit()
+
+JOB_RUNNERS = {"reevaluate": run_reevaluation}
+
+def run_job(job, pool):
+    """ジョブを 1 件処理する（失敗した場合はエラーを記録する）"""
+    if job.started_at is None:
+        job.started_at = datetime.now(timezone.utc)
+        db.session.commit()
+    print(f"ジョブ {job.id} ({job.kind}) を開始します")
+    try:
+        JOB_RUNNERS[job.kind](job, pool)
     except Exception as e:
+        db.session.rollback()
+        print(f"ジョブ {job.id} が失敗しました: {e}")
+        job.status = 'failed'
+        job.error = str(e)
+        job.finished_at = datetime.now(timezone.utc)
+        db.session.commit()
+        if isinstance(e, BrokenProcessPool):
+            raise
+        return
+    print(f"ジョブ {job.id} が終了しました: {job.status} ({job.processed}/{job.total})")
+
+@app.cli.command('run-jobs')
+@click.option('--processes', type=int, default=None, help="判定に使うプロセス数（既定は CPU コア数）")
+@click.option('--once', is_flag=True, help="待機中のジョブを処理したら終了する")
+def run_jobs_command(processes, once):
+    """バックグラウンドジョブのワーカー（Web サーバーとは別のプロセスで動かす）"""
+    create_tables()
+    get_ingredient_store()  # プロセスプールにフォークする前に読み込んでおく
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        while True:
+            job = claim_job()
+            if job is not None:
+                run_job(job, pool)
+                continue
+            db.session.remove()
+            if once:
+                break
+            time.sleep(JOB_POLL_INTERVAL)
+
+@app.route('/jobs', methods=['GET', 'POST'])
+def jobs():
+    """
+    GET: 最近のジョブの一覧（?limit=、既定 50 件）。
+    POST: ジョブを登録する。{"kind": "reevaluate", "standard": ..., "basis": ...} で
+    保存済みレシピをすべて指定の基準タイプで判定し直す（standard を省略すると既定の基準タイプ）。
+    """
+    if request.method == 'GET':
+        limit = min(max(request.args.get('limit', 50, type=int), 1), JOB_RESULTS_MAX_LIMIT)
+        recent = db.session.query(Job).order_by(Job.created_at.desc()).limit(limit).all()
+        return jsonify({"jobs": [job_dict(job) for job in recent]})
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "request body must be an object"}), 400
+    kind = data.get('kind', 'reevaluate')
+    if kind not in JOB_KINDS:
+        return jsonify({"error": f"kind must be one of {', '.join(JOB_KINDS)}"}), 400
+    standards = get_compiled_standards()
+    standard = data.get('standard')
+    if standard is not None and standard not in standards.types:
+        return jsonify({"error": f"unknown standard: {standard}"}), 400
+    basis = data.get('basis', DEFAULT_BASIS)
+    if basis not in BASES:
+        return jsonify({"error": f"unknown basis: {basis}"}), 400
+
+    job = enqueue_job(kind, {"standard": suggestion_standard(standards, standard), "basis": basis})
+    return jsonify(job_dict(job)), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """ジョブの状態と進捗・集計を返すエンドポイント"""
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job_dict(job))
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """待機中・実行中のジョブを取り消す（実行中のジョブは処理中のバッチが終わったところで止まる）"""
+    cancelled = (
+        db.session.query(Job)
+        .filter(Job.id == job_id, Job.status.in_(('queued', 'running')))
+        .update({"status": 'cancelled', "finished_at": datetime.now(timezone.utc)}, synchronize_session=False)
+    )
+    db.session.commit()
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    if not cancelled:
+        return jsonify({"error": f"job is already {job.status}"}), 409
+    return jsonify(job_dict(job))
+
+@app.route('/jobs/<job_id>/results', methods=['GET'])
+def job_results(job_id):
+    """
+    ジョブのレシピごとの結果をレシピ ID 順に返すエンドポイント。
+    ?status=ok|fail|error で絞り込み、?cursor=（前のページの next_cursor）と ?limit= でページを送る。
+    """
+    limit = min(max(request.args.get('limit', 100, type=int), 1), JOB_RESULTS_MAX_LIMIT)
+    query = (
+        select(JobResult.recipe_id, JobResult.status, JobResult.deficiencies, JobResult.excesses, JobResult.error)
+        .where(JobResult.job_id == job_id)
+        .order_by(JobResult.recipe_id)
+    )
+    if request.args.get('status'):
+        query = query.where(JobResult.status == request.args['status'])
+    if request.args.get('cursor'):
+        query = query.where(JobResult.recipe_id > request.args['cursor'])
+    with read_engine().connect() as connection:
+        if connection.execute(select(Job.id).where(Job.id == job_id)).scalar() is None:
+            return jsonify({"error": "job not found"}), 404
+        rows = connection.execute(query.limit(limit + 1)).all()
+    return jsonify({
+        "results": [
+            {
+                "recipe_id": row.recipe_id,
+                "status": row.status,
+                "deficiencies": orjson.loads(row.deficiencies or '[]'),
+                "excesses": orjson.loads(row.excesses or '[]'),
+                "error": row.error,
+            }
+            for row in rows[:limit]
+        ],
+        "next_cursor": rows[limit - 1].recipe_id if len(rows) > limit else None,
+    })
+
+
+@app.route('/solve-recipe', methods=['POST'])
+def solve_recipe():
+    """
+    基準値を満たすために追加すべき食材とグラム数を計算するエンドポイント。
+    adjust.html から再計算する場合は、前回の応答の warm_start をそのまま渡す。
+    """
+    try:
+        data = request.json
+        max_ingredients = data.get('max_ingredients')
+        with timed_phase('compute'):
+            result = solve_recipe_completion(
+                data.get('selected_ingredients', []),
+                data.get('standard') or app.config['DEFAULT_STANDARD'],
+                categories=data.get('categories'),
+                exclude_categories=data.get('exclude_categories'),
+                max_ingredients=int(max_ingredients) if max_ingredients is not None else None,
+                warm_start=data.get('warm_start'),
+            )
+        return jsonify(result)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error in POST /solve-recipe: {e}")
         return jsonify({"error": str(e)}), 500
 
 
@@ -564,61 +3228,580 @@ def recalculate():
         if not all(isinstance(item, dict) and 'food_code' in item and 'grams' in item for item in selected_list):
             raise ValueError("Invalid data format for selected_ingredients")
 
-        # 栄養素の合計を計算
-        nutrient_totals = calculate_totals(selected_list)
-
-        # 不足栄養素の判定
-        deficiencies = [
-            nutrient for nutrient, total in nutrient_totals.items()
-            if total < aafco_standards.get(nutrient, 0)
-        ]
-
-        # 提案食材の再生成
-        suggestions = suggest_ingredients_for_deficiencies(deficiencies)
+        # 栄養素の合計・提案に使う基準タイプでの不足栄養素・提案食材（/calculate と同じ計算）
+        evaluation = evaluate_recipe(selected_list, standard=data.get('standard'))
+        standard = evaluation["standard"]
 
         return jsonify({
-            "nutrient_totals": nutrient_totals,
-            "deficiencies": deficiencies,
-            "suggestions": suggestions
+            "nutrient_totals": nutrient_totals_dict(evaluation["total_vector"]),
+            "deficiencies": evaluation["deficiencies"].get(standard, []),
+            "standard": standard,
+            "suggestions": evaluation["suggestions"]
         })
 
     except Exception as e:
         print(f"Error in POST /recalculate: {e}")
         return jsonify({"error": str(e)}), 500
 
+# /ingredients で返せる項目と既定の項目
+CATALOG_FIELDS = ("food_code", "name", "category", "nutrients")
+CATALOG_DEFAULT_FIELDS = ("food_code", "name")
+CATALOG_MAX_LIMIT = 1000
+CATALOG_CACHE_SIZE = 256
+
+# エンコード済みの一覧レスポンス {(バージョン, 条件): (ETag, JSON, gzip 済み JSON)}
+catalog_bodies = LRUCache(CATALOG_CACHE_SIZE)
+
+def catalog_body(store, categories=(), fields=CATALOG_DEFAULT_FIELDS, cursor=None, limit=None):
+    """
+    食材一覧の 1 ページを JSON と gzip にエンコードしてキャッシュする。
+    cursor は前ページの最後の食品番号で、ストアの並び順でその次の食材から返す。
+    戻り値は (ETag, JSON, gzip 済み JSON)。cursor が見つからない時は ValueError を送出する。
+    """
+    key = (store.version, categories, fields, cursor, limit)
+    cached = catalog_bodies.get(key)
+    if cached is not None:
+        return cached
+
+    if categories:
+        rows = np.array([row for row, category in enumerate(store.categories) if category in categories], dtype=np.intp)
+    else:
+        rows = np.arange(len(store), dtype=np.intp)
+    start = 0
+    if cursor is not None:
+        cursor_row = store.index.get(cursor)
+        if cursor_row is None:
+            raise ValueError(f"unknown cursor: {cursor}")
+        start = int(np.searchsorted(rows, cursor_row, side='right'))
+    end = len(rows) if limit is None else min(start + limit, len(rows))
+    page = rows[start:end].tolist()
+
+    codes = store.food_codes[page].tolist()
+    columns = {
+        "food_code": lambda: codes,
+        "name": lambda: [store.names[row] for row in page],
+        "category": lambda: [store.categories[row] for row in page],
+        "nutrients": lambda: store.matrix[page].tolist(),
+    }
+    values = [columns[field]() for field in fields]
+    payload = {"ingredients": [dict(zip(fields, record)) for record in zip(*values)]}
+    if "nutrients" in fields:
+        payload["nutrient_keys"] = list(NUTRIENT_KEYS)
+    payload["next_cursor"] = str(codes[-1]) if end < len(rows) and codes else None
+    payload["version"] = store.version
+
+    body = orjson.dumps(payload)
+    etag = f"{store.version}-{hashlib.sha1(repr(key[1:]).encode()).hexdigest()[:12]}"
+    cached = (etag, body, gzip.compress(body, compresslevel=6))
+    catalog_bodies.put(key, cached)
+    return cached
+
 @app.route('/ingredients', methods=['GET'])
 def get_ingredients():
     """
-    全食材リストを取得するエンドポイント。
+    食材一覧を取得するエンドポイント。
+    パラメータを省略すると全食材の food_code と name を返します。
+      category: カテゴリ番号（カンマ区切りで複数指定可）
+      fields:   返す項目（food_code, name, category, nutrients。nutrients は 100g あたりの栄養素ベクトル）
+      limit:    1 ページの件数（省略時は全件）
+      cursor:   前ページの next_cursor
+    レスポンスはデータのバージョンごとにエンコード済みのものを使い回し、ETag で 304 を返します。
     """
     try:
-        ingredients = Ingredient.query.all()
-        results = [{"food_code": ing.food_code, "name": ing.name} for ing in ingredients]
-        return jsonify({"ingredients": results})
+        categories = tuple(sorted({c.strip() for c in request.args.get('category', '').split(',') if c.strip()}))
+        fields = tuple(f.strip() for f in request.args.get('fields', '').split(',') if f.strip()) or CATALOG_DEFAULT_FIELDS
+        unknown = [field for field in fields if field not in CATALOG_FIELDS]
+        if unknown:
+            return jsonify({"error": f"unknown fields: {', '.join(unknown)}"}), 400
+        fields = tuple(dict.fromkeys(fields))
+        try:
+            limit = request.args.get('limit')
+            limit = None if limit is None else min(max(int(limit), 1), CATALOG_MAX_LIMIT)
+            cursor = request.args.get('cursor') or None
+            cursor = None if cursor is None else int(cursor)
+        except ValueError:
+            return jsonify({"error": "limit and cursor must be integers"}), 400
+
+        store = get_ingredient_store()
+        try:
+            etag, body, gzipped = catalog_body(store, categories, fields, cursor, limit)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # gzip を受け付けるクライアントには圧縮済みの本文を返す（表現ごとに ETag を分ける）
+        use_gzip = request.accept_encodings['gzip'] > 0
+        if use_gzip:
+            etag += "-gz"
+        headers = {"Cache-Control": "public, no-cache", "Vary": "Accept-Encoding"}
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304, headers=headers)
+        else:
+            response = Response(gzipped if use_gzip else body, mimetype='application/json', headers=headers)
+            if use_gzip:
+                response.headers["Content-Encoding"] = "gzip"
+        response.set_etag(etag)
+        return response
     except Exception as e:
         print(f"全食材リスト取得エラー: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/standards', methods=['GET'])
+def standards_list():
+    """読み込まれている基準タイプと基準値、提案に使う既定の基準タイプを返すエンドポイント"""
+    standards = get_compiled_standards()
+    return jsonify({
+        "version": standards.version,
+        "default": suggestion_standard(standards),
+        "standards": [
+            {"type": standard_type, "label": standards.labels[standard_type], "nutrients": standards.source[standard_type]}
+            for standard_type in standards.types
+        ],
+    })
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    """プロセス内キャッシュの件数とヒット・ミス・追い出しの回数を返すエンドポイント"""
+    return jsonify({
+        "evaluation": evaluation_cache.stats(),
+        "recipes": recipe_cache.stats(),
+        "catalog": catalog_bodies.stats(),
+        "fragments": fragment_cache.stats(),
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus 形式のメトリクス（ルートごとの処理時間・フェーズ別時間・SQL 実行回数・キャッシュの状況）。
+    値はワーカープロセスごとに集計される。
+    """
+    caches = {
+        "evaluation": evaluation_cache.stats(),
+        "recipes": recipe_cache.stats(),
+        "catalog": catalog_bodies.stats(),
+        "fragments": fragment_cache.stats(),
+    }
+    return Response(request_metrics.render(caches), mimetype='text/plain; version=0.0.4')
+
+# 検索結果の 1 ページあたりの件数
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+
 @app.route('/search-ingredients', methods=['GET'])
 def search_ingredients():
     """
     食材検索エンドポイント。
-    クエリ文字列を使用して、食材名を部分一致で検索します。
+    食材名の部分一致（全角/半角・ひらがな/カタカナ・ローマ字を同一視）と食品番号の前方一致で検索し、
+    関連度の高い順に offset から limit 件を返します。
+    """
+    query = request.args.get('query', '')
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_DEFAULT_LIMIT)), 1), SEARCH_MAX_LIMIT)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+
+    store = get_ingredient_store()
+    rows, total = store.search_index.search(query, limit, offset)
+    results = [{"food_code": int(store.food_codes[row]), "name": store.names[row]} for row in rows]
+    return jsonify({"ingredients": results, "total": total, "offset": offset, "limit": limit})
+
+# 代替食材の件数（既定と最大）と、レシピの判定で並べ替える時に評価する候補の数
+SUBSTITUTE_DEFAULT_K = 10
+SUBSTITUTE_MAX_K = SUBSTITUTE_TABLE_SIZE
+SUBSTITUTE_RERANK_POOL = SUBSTITUTE_TABLE_SIZE
+
+@app.route('/substitutes', methods=['GET'])
+def substitutes():
+    """
+    代替食材を栄養素ベクトルの類似度の高い順に返すエンドポイント。
+      food_code:      代替したい食材の食品番号
+      k:              件数（既定 10、最大 50）
+      same_category:  1 なら同じ食品群の食材だけ
+      recipe_id:      保存済みレシピの ID。指定すると、レシピの中のこの食材を同じグラム数の候補に
+                      置き換えた時の判定（standard の基準タイプ）で、基準を満たさない栄養素の少ない順に並べ替える
+    """
+    try:
+        food_code = int(request.args.get('food_code', ''))
+        k = min(max(int(request.args.get('k', SUBSTITUTE_DEFAULT_K)), 1), SUBSTITUTE_MAX_K)
+    except ValueError:
+        return jsonify({"error": "food_code and k must be integers"}), 400
+    same_category = request.args.get('same_category') in ('1', 'true')
+
+    store = get_ingredient_store()
+    row = store.index.get(food_code)
+    if row is None:
+        return jsonify({"error": f"unknown food_code: {food_code}"}), 404
+    index = store.substitute_index
+
+    def describe(candidate, similarity):
+        return {
+            "food_code": int(store.food_codes[candidate]),
+            "name": store.names[candidate],
+            "category": store.categories[candidate],
+            "similarity": round(similarity, 6),
+        }
+
+    payload = {"food_code": food_code, "name": store.names[row], "category": store.categories[row]}
+    recipe_id = request.args.get('recipe_id')
+    if not recipe_id:
+        with timed_phase('compute'):
+            payload["substitutes"] = [describe(*item) for item in index.nearest(row, k, same_category)]
+        return jsonify(payload)
+
+    recipe = get_recipe(recipe_id)
+    if recipe is None:
+        return jsonify({"error": "recipe not found"}), 404
+    standards = get_compiled_standards()
+    standard = request.args.get('standard')
+    if standard is not None and standard not in standards.types:
+        return jsonify({"error": f"unknown standard: {standard}"}), 400
+    standard = suggestion_standard(standards, standard)
+    s = standards.types.index(standard)
+
+    with timed_phase('compute'):
+        evaluation = recipe.evaluate(store, standards)
+        position = np.flatnonzero(evaluation["rows"] == row)
+        if not len(position):
+            return jsonify({"error": f"food_code {food_code} is not in the recipe"}), 400
+        grams = float(evaluation["grams"][position[0]])
+
+        # レシピに入っている食材は候補から除き、置き換えた後の合計をまとめて判定する
+        pool = index.nearest(row, max(k, SUBSTITUTE_RERANK_POOL), same_category, set(evaluation["rows"].tolist()))
+        candidates = np.array([candidate for candidate, _ in pool], dtype=np.intp)
+        totals = evaluation["total_vector"] + (store.matrix[candidates] - store.matrix[row]) * (grams / 100)
+        codes = standards.evaluate(totals)[:, s, :] if len(candidates) else np.zeros((0, len(NUTRIENT_KEYS)), dtype=np.int8)
+        current = evaluation["codes"][s]
+        defined = standards.defined[s]
+        violations = ((codes != STATUS_OK) & defined).sum(axis=1)
+        order = sorted(range(len(pool)), key=lambda i: (violations[i], -pool[i][1]))[:k]
+
+        results = []
+        for i in order:
+            item = describe(*pool[i])
+            item["violations"] = int(violations[i])
+            item["resolved"] = [NUTRIENT_KEYS[j] for j in np.flatnonzero((current != STATUS_OK) & (codes[i] == STATUS_OK) & defined)]
+            item["introduced"] = [NUTRIENT_KEYS[j] for j in np.flatnonzero((current == STATUS_OK) & (codes[i] != STATUS_OK) & defined)]
+            results.append(item)
+
+    payload.update({
+        "recipe_id": recipe.id,
+        "grams": grams,
+        "standard": standard,
+        "violations": int(((current != STATUS_OK) & defined).sum()),
+        "substitutes": results,
+    })
+    return jsonify(payload)
+
+# 計算結果を確認するレシピのフィクスチャとゴールデン出力、許容する相対誤差
+GOLDEN_RECIPES = os.path.join('fixtures', 'recipes.json')
+GOLDEN_OUTPUT = os.path.join('fixtures', 'golden.json')
+GOLDEN_RTOL = 1e-9
+
+# /recipe-delta が 400 で拒否するべきグラム数
+GOLDEN_INVALID_GRAMS = ("NaN", "inf", "-inf", float('nan'), float('inf'), 1e308, -1)
+
+def golden_codes(standards, codes):
+    """1 レシピ分の判定コードを基準タイプごとの文字列（栄養素ごとに 0/1/2、基準にない栄養素は -）にする"""
+    return {
+        standard_type: ''.join(str(code) if defined else '-' for code, defined in zip(codes[i].tolist(), standards.defined[i].tolist()))
+        for i, standard_type in enumerate(standards.types)
+    }
+
+def golden_results_codes(standards, results):
+    """{基準タイプ: {栄養素: 適合/不足/過剰}} を golden_codes と同じ形式にする"""
+    return {
+        standard_type: ''.join(
+            str(STATUS_LABELS.index(results[standard_type][nutrient])) if nutrient in results[standard_type] else '-'
+            for nutrient in NUTRIENT_KEYS
+        )
+        for standard_type in standards.types
+    }
+
+def golden_totals(values):
+    return [value if value == value else None for value in np.asarray(values).tolist()]
+
+def golden_suggestions(suggestions):
+    return {nutrient: [item["food_code"] for item in items] for nutrient, items in suggestions.items()}
+
+def golden_outputs(store, standards, fixtures, standard):
+    """フィクスチャのレシピを計算コア（evaluate_recipes）でまとめて計算した出力"""
+    recipes = [fixture["selected_list"] for fixture in fixtures]
+    outputs = [{"name": fixture["name"]} for fixture in fixtures]
+    s = standards.types.index(standard)
+    for basis in BASES:
+        values, total_grams, codes, errors = evaluate_recipes(store, standards, recipes, basis)
+        for i, output in enumerate(outputs):
+            if i in errors:
+                output["error"] = errors[i]
+                continue
+            output.setdefault("bases", {})[basis] = {
+                "totals": golden_totals(values[i]),
+                "total_grams": float(total_grams[i]),
+                "codes": golden_codes(standards, codes[i]),
+            }
+            if basis == DEFAULT_BASIS:
+                deficient = [NUTRIENT_KEYS[j] for j in np.flatnonzero(codes[i, s] == STATUS_DEFICIENT)]
+                output["suggestions"] = golden_suggestions(suggest_ingredients_for_deficiencies(store, deficient))
+    return outputs
+
+def golden_invalid_deltas(fixtures):
     """
-    query = request.args.get('query', '').strip().lower()
-    if not query:
-        return jsonify({"ingredients": []})
+    /recipe-delta が有限でない・大きすぎるグラム数を 400 で拒否し、レシピを変えないか確認する。
+    {送ったグラム数: 問題} を返す（問題がなければ空）。
+    """
+    client = app.test_client()
+    selected_list = next(fixture["selected_list"] for fixture in fixtures if fixture["selected_list"])
+    recipe = create_recipe(selected_list)
+    problems = {}
+    try:
+        for new_grams in GOLDEN_INVALID_GRAMS:
+            response = client.post('/recipe-delta', json={
+                "recipe_id": recipe.id, "version": recipe.version,
+                "food_code": selected_list[0]["food_code"], "new_grams": new_grams,
+            })
+            current = get_recipe(recipe.id)
+            if response.status_code != 400:
+                problems[repr(new_grams)] = f"status {response.status_code}"
+            elif current.version != recipe.version:
+                problems[repr(new_grams)] = f"version {recipe.version} -> {current.version}"
+    finally:
+        db.session.query(Recipe).filter(Recipe.id == recipe.id).delete()
+        db.session.commit()
+    return problems
+
+# /calculate の判定のセルの class（判定コードの順）
+GOLDEN_VERDICT_CLASSES = ("match", "deficiency", "excess")
+
+def golden_adjust_page(client, standards):
+    """セッションのレシピの /adjust を開き、埋め込まれたページのデータと、ゴールデン出力と同じ形式の合計・判定を返す"""
+    html = client.get('/adjust').get_data(as_text=True)
+    page = orjson.loads(html.split('window.ADJUST_DATA = ', 1)[1].split(';</script>', 1)[0])
+    page["values"] = {
+        "totals": golden_totals([page["nutrient_totals"][nutrient] for nutrient in NUTRIENT_KEYS]),
+        "total_grams": page["total_grams"],
+        "codes": golden_results_codes(standards, page["results"]),
+    }
+    return page
+
+def golden_differences(expected, actual):
+    """ゴールデン出力 expected と、ある経路で計算した actual（その経路で得られる項目だけ）の違い"""
+    if "error" in expected or "error" in actual:
+        return [] if expected.get("error") == actual.get("error") else [f"error: {expected.get('error')!r} != {actual.get('error')!r}"]
+    differences = []
+    for basis, values in actual.get("bases", {}).items():
+        golden = expected["bases"][basis]
+        if "totals" in values:
+            want = np.array(golden["totals"], dtype=np.float64)
+            got = np.array(values["totals"], dtype=np.float64)
+            for j in np.flatnonzero(~np.isclose(got, want, rtol=GOLDEN_RTOL, atol=GOLDEN_RTOL, equal_nan=True)):
+                differences.append(f"{basis} {NUTRIENT_KEYS[j]}: {float(want[j])!r} != {float(got[j])!r}")
+        if "total_grams" in values and not np.isclose(values["total_grams"], golden["total_grams"], rtol=GOLDEN_RTOL):
+            differences.append(f"{basis} total_grams: {golden['total_grams']!r} != {values['total_grams']!r}")
+        for standard_type, codes in values.get("codes", {}).items():
+            if codes != golden["codes"][standard_type]:
+                differences.append(f"{basis} {standard_type}: {golden['codes'][standard_type]} != {codes}")
+    if "suggestions" in actual and actual["suggestions"] != expected["suggestions"]:
+        differences.append("suggestions differ")
+    return differences
+
+def golden_paths(store, standards, fixtures, standard):
+    """
+    フィクスチャを各経路（計算コア・evaluate_recipe・/calculate-nutrients・/calculate-nutrients/batch・/recalculate・
+    /calculate・/adjust・/recipe-delta・再判定ジョブのシャード）で計算し、
+    {経路名: ゴールデン出力と同じ形式の出力のリスト（比べないレシピは None）} を返す。結果のキャッシュは経路ごとに空にする。
+    """
+    client = app.test_client()
+    recipes = [fixture["selected_list"] for fixture in fixtures]
+    paths = {"evaluate_recipes": golden_outputs(store, standards, fixtures, standard)}
+
+    evaluation_cache.clear()
+    outputs = []
+    for selected_list in recipes:
+        output = {}
+        try:
+            for basis in BASES:
+                evaluation = evaluate_recipe(selected_list, basis, standard, standards)
+                output.setdefault("bases", {})[basis] = {
+                    "totals": golden_totals(evaluation["total_vector"]),
+                    "total_grams": evaluation["total_grams"],
+                    "codes": golden_codes(standards, evaluation["codes"]),
+                }
+                if basis == DEFAULT_BASIS:
+                    output["suggestions"] = golden_suggestions(evaluation["suggestions"])
+        except ValueError as e:
+            output = {"error": str(e)}
+        outputs.append(output)
+    paths["evaluate_recipe"] = outputs
+
+    evaluation_cache.clear()
+    outputs = []
+    for selected_list in recipes:
+        output = {}
+        for basis in BASES:
+            data = client.post('/calculate-nutrients', json={"selected_ingredients": selected_list, "basis": basis}).get_json()
+            if "error" in data:
+                output = {"error": data["error"]}
+                break
+            output.setdefault("bases", {})[basis] = {
+                "totals": golden_totals([data["nutrient_totals"][nutrient] for nutrient in NUTRIENT_KEYS]),
+                "codes": golden_results_codes(standards, data["results"]),
+            }
+        outputs.append(output)
+    paths["POST /calculate-nutrients"] = outputs
+
+    body = {"recipes": [{"selected_ingredients": selected_list} for selected_list in recipes], "bases": "all"}
+    lines = client.post('/calculate-nutrients/batch', data=orjson.dumps(body)).data.splitlines()
+    outputs = []
+    for line in map(orjson.loads, lines):
+        if "error" in line:
+            outputs.append({"error": line["error"]})
+            continue
+        outputs.append({"bases": {
+            basis: {
+                "totals": golden_totals([values["nutrient_totals"][nutrient] for nutrient in NUTRIENT_KEYS]),
+                "codes": golden_results_codes(standards, values["results"]),
+            }
+            for basis, values in line["bases"].items()
+        }})
+    paths["POST /calculate-nutrients/batch"] = outputs
+
+    evaluation_cache.clear()
+    outputs = []
+    for fixture, selected_list in zip(fixtures, recipes):
+        if not all(isinstance(item, dict) and 'food_code' in item and 'grams' in item for item in selected_list):
+            outputs.append(None)  # /recalculate は形式の正しくないレシピを受け付けないので比べない
+            continue
+        data = client.post('/recalculate', json={"selected_ingredients": selected_list, "standard": standard}).get_json()
+        if "error" in data:
+            outputs.append({"error": data["error"]})
+            continue
+        outputs.append({
+            "bases": {DEFAULT_BASIS: {"totals": golden_totals([data["nutrient_totals"][nutrient] for nutrient in NUTRIENT_KEYS])}},
+            "suggestions": golden_suggestions(data["suggestions"]),
+        })
+    paths["POST /recalculate"] = outputs
+
+    # /calculate でレシピを保存し、同じセッションの /adjust で保存済みレシピの合計・判定を読む。
+    # /recipe-delta は最初の食材のグラム数を変えて元に戻し、差分で更新した合計を /adjust で読む
+    evaluation_cache.clear()
+    calculate_outputs, adjust_outputs, delta_outputs, recipe_ids = [], [], [], []
+    for selected_list in recipes:
+        response = client.post('/calculate', json={"selected_list": selected_list, "standard": standard})
+        if response.status_code != 200:
+            # /calculate は解釈できないレシピを 500 で返すので比べない
+            calculate_outputs.append(None)
+            adjust_outputs.append(None)
+            delta_outputs.append(None)
+            continue
+        html = response.get_data(as_text=True)
+        cells = [cell.split('"', 1)[0] for cell in html.split('<td class="')[1:]]
+        verdicts = np.array([GOLDEN_VERDICT_CLASSES.index(cell) for cell in cells]).reshape(len(standards.types), -1)
+        calculate_outputs.append({"bases": {DEFAULT_BASIS: {"codes": golden_codes(standards, verdicts)}}})
+
+        page = golden_adjust_page(client, standards)
+        recipe_ids.append(page["recipe_id"])
+        adjust_outputs.append({"bases": {DEFAULT_BASIS: page["values"]}})
+        if not page["selected_ingredients"]:
+            delta_outputs.append(None)
+            continue
+        first = page["selected_ingredients"][0]
+        version = page["recipe_version"]
+        for new_grams in (float(first["grams"] or 0) + 10, float(first["grams"] or 0)):
+            data = client.post('/recipe-delta', json={
+                "recipe_id": page["recipe_id"], "version": version,
+                "food_code": first["food_code"], "new_grams": new_grams,
+            }).get_json()
+            version = data["version"]
+        values = golden_adjust_page(client, standards)["values"]
+        for nutrient, value in data["nutrient_totals"].items():
+            values["totals"][NUTRIENT_POSITION[nutrient]] = value
+        delta_outputs.append({"bases": {DEFAULT_BASIS: values}})
+    paths["POST /calculate"] = calculate_outputs
+    paths["GET /adjust"] = adjust_outputs
+    paths["POST /recipe-delta"] = delta_outputs
+    db.session.query(Recipe).filter(Recipe.id.in_(recipe_ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+    # 再判定ジョブのシャードは 1 基準タイプの不足・過剰だけを返すので、その基準タイプの判定を比べる
+    texts = [orjson.dumps(selected_list) for selected_list in recipes]
+    s = standards.types.index(standard)
+    outputs = [{} for _ in recipes]
+    for basis in BASES:
+        for output, (deficient, excess, error) in zip(outputs, _reevaluate_shard(texts, shard_standard(standards, standard), basis)):
+            if error is not None:
+                output["error"] = error
+                continue
+            codes = np.zeros((len(standards.types), len(NUTRIENT_KEYS)), dtype=np.int8)
+            codes[s, [NUTRIENT_POSITION[nutrient] for nutrient in deficient]] = STATUS_DEFICIENT
+            codes[s, [NUTRIENT_POSITION[nutrient] for nutrient in excess]] = STATUS_EXCESS
+            output.setdefault("bases", {})[basis] = {"codes": {standard: golden_codes(standards, codes)[standard]}}
+    paths["re-evaluation shard"] = outputs
+    return paths
+
+@app.cli.command('check-golden')
+@click.option('--update', is_flag=True, help="現在の計算結果でゴールデン出力を書き直す")
+def check_golden_command(update):
+    """フィクスチャのレシピを全ての計算経路で計算し、ゴールデン出力と一致するか確認する"""
+    base = os.path.dirname(__file__)
+    with open(os.path.join(base, GOLDEN_RECIPES), encoding='utf-8') as f:
+        fixtures = json.load(f)
+    store = get_ingredient_store()
+    standards = get_compiled_standards()
+    standard = suggestion_standard(standards)
+
+    output_path = os.path.join(base, GOLDEN_OUTPUT)
+    if update:
+        header = {
+            "store_version": store.version,
+            "standards_version": standards.version,
+            "standard": standard,
+            "nutrients": NUTRIENT_KEYS,
+            "standards": standards.types,
+        }
+        outputs = golden_outputs(store, standards, fixtures, standard)
+        with open(output_path, 'wb') as f:
+            f.write(orjson.dumps(header)[:-1] + b',"recipes":[\n')
+            f.write(b',\n'.join(orjson.dumps(output) for output in outputs))
+            f.write(b'\n]}\n')
+        print(f"ゴールデン出力を書き出しました: {output_path}（{len(outputs)} 件）")
+        return
+
+    with open(output_path, 'rb') as f:
+        golden = orjson.loads(f.read())
+    if (golden["store_version"], golden["standards_version"]) != (store.version, standards.version):
+        raise click.ClickException(
+            f"食材データか基準値が変わっています（{golden['store_version']}/{golden['standards_version']} → "
+            f"{store.version}/{standards.version}）。意図した変更なら --update で作り直してください"
+        )
+    if [fixture["name"] for fixture in fixtures] != [output["name"] for output in golden["recipes"]]:
+        raise click.ClickException("フィクスチャとゴールデン出力のレシピが一致しません。--update で作り直してください")
+
+    failed = 0
+    for path, outputs in golden_paths(store, standards, fixtures, golden["standard"]).items():
+        compared = mismatched = 0
+        for expected, actual in zip(golden["recipes"], outputs):
+            if actual is None:
+                continue
+            compared += 1
+            differences = golden_differences(expected, actual)
+            if differences:
+                mismatched += 1
+                print(f"{path}: {expected['name']}: " + "; ".join(differences[:5]))
+        print(f"{path}: {compared - mismatched}/{compared} 件一致")
+        failed += mismatched
+
+    problems = golden_invalid_deltas(fixtures)
+    for new_grams, problem in problems.items():
+        print(f"POST /recipe-delta: new_grams={new_grams}: {problem}")
+    print(f"POST /recipe-delta（不正なグラム数）: {len(GOLDEN_INVALID_GRAMS) - len(problems)}/{len(GOLDEN_INVALID_GRAMS)} 件拒否")
+    failed += len(problems)
+    if failed:
+        raise click.ClickException(f"ゴールデン出力と異なる結果が {failed} 件あります")
 
-    ingredients = Ingredient.query.filter(Ingredient.name.ilike(f"%{query}%")).all()
-    results = [{"food_code": ing.food_code, "name": ing.name} for ing in ingredients]
-    return jsonify({"ingredients": results})
 
 if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()
-        process_excel()  # データベース初期化
-        aafco_standards = load_aafco_standards()
+    create_app()  # データベース初期化と食材データ・AAFCO基準値の読み込み
 
     # アプリケーションの起動
     port = int(os.environ.get("PORT", 5000))
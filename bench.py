@@ -0,0 +1,236 @@
+"""
+栄養計算ルートのベンチマークと負荷試験。
+
+    python bench.py                              # マイクロベンチマークと負荷試験を実行して結果を表示
+    python bench.py --save-baseline base.json    # 結果を基準として保存
+    python bench.py --compare base.json          # 基準より遅くなっていたら終了コード 1
+
+マイクロベンチマーク（栄養素合計・AAFCO 判定・提案食材のランキング・検索）と、
+Flask のテストクライアントを使ったプロセス内の負荷試験を行う。
+負荷試験では 1〜50 食材のランダムなレシピと、--replay を指定した場合はその JSONL の
+リクエスト記録（{"method", "path", "json" または "query"} の行。それ以外の行は読み飛ばす）を
+/calculate・/calculate-nutrients・/adjust・/search-ingredients に送り、
+p50/p95/p99 の処理時間・SQL 実行回数・メモリ使用量を報告する。
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from app import (
+    app, db, Recipe, initialize_data, get_ingredient_store, get_compiled_standards,
+    suggest_ingredients_for_deficiencies, NUTRIENT_KEYS,
+)
+
+# 基準と比べる時に許容する遅れ（割合）と、誤差として無視する差（ミリ秒）
+DEFAULT_TOLERANCE = 0.25
+NOISE_FLOOR_MS = 0.05
+
+SEARCH_QUERIES = ("にんじん", "ニンジン", "ninjin", "鶏", "とり", "ささ身", "豚", "卵", "1", "110", "米", "a")
+
+
+def percentiles(samples_ms):
+    """処理時間（ミリ秒）の p50/p95/p99 と平均"""
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {"n": len(samples), "p50": p50, "p95": p95, "p99": p99, "mean": float(samples.mean())}
+
+
+def synthetic_recipes(store, count, rng):
+    """1〜50 食材、各 1〜500g のランダムなレシピ"""
+    codes = store.food_codes.tolist()
+    return [
+        [{"food_code": code, "grams": round(rng.uniform(1, 500), 1)} for code in rng.sample(codes, rng.randint(1, 50))]
+        for _ in range(count)
+    ]
+
+
+def replay_records(path):
+    """JSONL からリクエスト記録だけを読み出す（読み飛ばした行数も返す）"""
+    records, skipped = [], 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            if isinstance(record, dict) and isinstance(record.get('method'), str) and isinstance(record.get('path'), str):
+                records.append(record)
+            else:
+                skipped += 1
+    return records, skipped
+
+
+def measure(func, iterations):
+    """func を iterations 回実行した処理時間（ミリ秒）のリスト"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def run_micro(rng, iterations):
+    """データ構造を直接呼ぶマイクロベンチマーク"""
+    store = get_ingredient_store()
+    standards = get_compiled_standards()
+    recipes = synthetic_recipes(store, 1000, rng)
+    single = recipes[0]
+    rows, grams = store.lookup(single)
+    indptr, batch_rows, batch_grams, _ = store.lookup_many(recipes)
+    totals = store.batch_totals(indptr, batch_rows, batch_grams)
+    total_vector = totals[0]
+    deficient = list(NUTRIENT_KEYS)
+    queries = iter(SEARCH_QUERIES * (iterations // len(SEARCH_QUERIES) + 1))
+
+    benches = {
+        "totals": lambda: store.totals(rows, grams),
+        "totals_batch_1000": lambda: store.batch_totals(indptr, batch_rows, batch_grams),
+        "evaluate": lambda: standards.evaluate(total_vector),
+        "evaluate_batch_1000": lambda: standards.evaluate(totals),
+        "suggest_all_nutrients": lambda: suggest_ingredients_for_deficiencies(store, deficient),
+        "search": lambda: store.search_index.search(next(queries), 50, 0),
+    }
+    results = {}
+    for name, func in benches.items():
+        func()  # ウォームアップ
+        results[name] = percentiles(measure(func, iterations))
+    return results
+
+
+def run_load(rng, count, replay, track_memory):
+    """テストクライアントから各ルートにリクエストを送る負荷試験"""
+    client = app.test_client()
+    store = get_ingredient_store()
+    samples = {}
+
+    def send(name, method, path, **kwargs):
+        start = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        elapsed = (time.perf_counter() - start) * 1000
+        if response.status_code >= 500:
+            print(f"{method} {path} が {response.status_code} を返しました")
+        entry = samples.setdefault(name, {"ms": [], "sql": []})
+        entry["ms"].append(elapsed)
+        entry["sql"].append(int(response.headers.get('X-SQL-Statements', 0)))
+        return response
+
+    if track_memory:
+        tracemalloc.start()
+    for recipe in synthetic_recipes(store, count, rng):
+        send("POST /calculate-nutrients", 'POST', '/calculate-nutrients', json={"selected_ingredients": recipe})
+        send("POST /calculate", 'POST', '/calculate', json={"selected_list": recipe})
+        send("GET /adjust", 'GET', '/adjust')
+        send("GET /search-ingredients", 'GET', '/search-ingredients', query_string={"query": rng.choice(SEARCH_QUERIES)})
+    for record in replay:
+        send(f"replay {record['method'].upper()} {record['path']}", record['method'].upper(), record['path'],
+             json=record.get('json'), query_string=record.get('query'))
+    peak = None
+    if track_memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    results = {}
+    for name, entry in samples.items():
+        stats = percentiles(entry["ms"])
+        stats["sql_mean"] = float(np.mean(entry["sql"]))
+        stats["sql_max"] = int(max(entry["sql"]))
+        results[name] = stats
+    return results, peak
+
+
+def format_report(micro, load, memory):
+    lines = [f"{'benchmark':<36}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'SQL avg':>9}{'SQL max':>9}"]
+    for name, stats in list(micro.items()) + list(load.items()):
+        sql = f"{stats['sql_mean']:>9.1f}{stats['sql_max']:>9}" if 'sql_mean' in stats else ""
+        lines.append(f"{name:<36}{stats['n']:>7}{stats['p50']:>10.3f}{stats['p95']:>10.3f}{stats['p99']:>10.3f}{sql}")
+    lines.append(f"max RSS: {memory['max_rss_mb']:.1f} MB")
+    if memory.get('load_peak_mb') is not None:
+        lines.append(f"負荷試験中の Python ヒープのピーク: {memory['load_peak_mb']:.1f} MB")
+    return "\n".join(lines)
+
+
+def compare(results, baseline, tolerance):
+    """基準と比べて p95 が tolerance を超えて遅い、または SQL 実行回数が増えた項目を返す"""
+    regressions = []
+    for section in ("micro", "load"):
+        for name, stats in results[section].items():
+            before = baseline.get(section, {}).get(name)
+            if before is None:
+                continue
+            limit = before["p95"] * (1 + tolerance)
+            if stats["p95"] > limit and stats["p95"] - before["p95"] > NOISE_FLOOR_MS:
+                regressions.append(f"{name}: p95 {before['p95']:.3f} ms → {stats['p95']:.3f} ms")
+            if "sql_mean" in stats and stats["sql_mean"] > before.get("sql_mean", stats["sql_mean"]) + 0.5:
+                regressions.append(f"{name}: SQL {before['sql_mean']:.1f} → {stats['sql_mean']:.1f} 回/リクエスト")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--recipes', type=int, default=200, help="負荷試験で送るランダムなレシピの数")
+    parser.add_argument('--iterations', type=int, default=2000, help="マイクロベンチマークの繰り返し回数")
+    parser.add_argument('--replay', default=None, help="再生するリクエスト記録の JSONL（省略時は再生しない）")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--memory', action='store_true', help="負荷試験中の Python ヒープを tracemalloc で計測する（遅くなる）")
+    parser.add_argument('--output', help="結果の表を書き出すファイル")
+    parser.add_argument('--save-baseline', help="結果を JSON で保存する")
+    parser.add_argument('--compare', help="基準の JSON と比べ、遅くなっていれば終了コード 1 を返す")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help="許容する p95 の遅れ（割合）")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    replay, skipped = [], 0
+    if args.replay:
+        if not os.path.exists(args.replay):
+            parser.error(f"--replay: {args.replay} が見つかりません")
+        replay, skipped = replay_records(args.replay)
+        print(f"{args.replay}: リクエスト記録 {len(replay)} 件を再生します（{skipped} 行を読み飛ばしました）")
+
+    with app.app_context():
+        initialize_data()
+        existing = {row[0] for row in db.session.query(Recipe.id)}
+        try:
+            micro = run_micro(rng, args.iterations)
+            load, peak = run_load(rng, args.recipes, replay, args.memory)
+        finally:
+            # 負荷試験で保存されたレシピを消す
+            created = [row[0] for row in db.session.query(Recipe.id) if row[0] not in existing]
+            for start in range(0, len(created), 500):
+                db.session.query(Recipe).filter(Recipe.id.in_(created[start:start + 500])).delete(synchronize_session=False)
+            db.session.commit()
+
+    memory = {"max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, "load_peak_mb": peak}
+    results = {"micro": micro, "load": load, "memory": memory}
+    report = format_report(micro, load, memory)
+    print(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + "\n")
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("基準より遅くなった項目があります:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("基準との比較: 問題ありません")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,27 @@
+"""
+gunicorn の設定。
+
+アプリは "app:create_app()" で読み込む。preload_app によりマスタープロセスでフォーク前に
+食材データと AAFCO 基準値のスナップショットを作成してメモリマップし、
+各ワーカーはそのマッピングを引き継ぐため、ワーカーを増やしてもデータはコピーされない。
+基準値のファイルが更新された場合は、各ワーカーが再起動せずに読み込み直す。
+
+/recipe-events の SSE 接続はワーカーを占有するため、sync ワーカーではライブ評価を無効にし
+（DOGFOOD_LIVE_EVENTS=0）、編集画面は /recipe-delta の応答で更新する。
+ライブ評価を使う場合は GUNICORN_WORKER_CLASS=gevent で非同期ワーカーを使う。
+
+SQLite は本番向けの設定（DOGFOOD_SQLITE_PRODUCTION=1: WAL・mmap などのプラグマと、
+ワーカーごとの読み取り専用接続のプール）で開き、同時に来た読み取りがロックを待たないようにする。
+"""
+import os
+
+# アプリを読み込む前に設定する（無効にする場合は環境変数で 0 を指定する）
+os.environ.setdefault('DOGFOOD_SQLITE_PRODUCTION', '1')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+preload_app = True
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+os.environ.setdefault('DOGFOOD_LIVE_EVENTS', '0' if worker_class == 'sync' else '1')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
@@ -0,0 +1,261 @@
+"""
+栄養計算のコア。
+
+栄養素の定義・判定の基準（basis）・AAFCO 基準値の配列（CompiledStandards）と、
+レシピの栄養素合計・判定・提案食材を計算する関数をまとめる。
+各ルート・バックグラウンドジョブ・エクスポートの合計と判定は全てここの関数で計算し、
+fixtures/ のゴールデン出力（flask check-golden）で結果が変わっていないことを確認する。
+Flask やデータベースには依存せず、食材データは IngredientStore（app.py）を引数で受け取る。
+"""
+import hashlib
+
+import numpy as np
+import orjson
+
+# 栄養素のキー → (表示名, 単位)
+nutrient_labels = {
+    'WATER': ('水分', 'g'),
+    'ENERC_KCAL': ('エネルギー', 'kcal'),
+    'PROT': ('タンパク質', 'g'),
+    'ARG': ('アルギニン', 'g'),
+    'HIS': ('ヒスチジン', 'g'),
+    'ILE': ('イソロイシン', 'g'),
+    'LEU': ('ロイシン', 'g'),
+    'LYS': ('リジン', 'g'),
+    'MET': ('メチオニン', 'g'),
+    'CYS': ('シスチン', 'g'),
+    'PHE': ('フェニルアラニン', 'g'),
+    'TYR': ('チロシン', 'g'),
+    'THR': ('スレオニン', 'g'),
+    'TRP': ('トリプトファン', 'g'),
+    'VAL': ('バリン', 'g'),
+    'F18D2N6': ('リノール酸', 'g'),
+    'F18D3N3': ('αリノレン酸', 'g'),
+    'F20D5N3': ('エイコサペンタエン酸', 'g'),
+    'F22D6N3': ('ドコサヘキサエン酸', 'g'),
+    'FAT': ('脂肪', 'g'),
+    'CA': ('カルシウム', 'g'),
+    'P': ('リン', 'g'),
+    'K': ('カリウム', 'g'),
+    'NAT': ('ナトリウム', 'g'),
+    'MG': ('マグネシウム', 'g'),
+    'FE': ('鉄', 'mg'),
+    'CU': ('銅', 'mg'),
+    'MN': ('マンガン', 'mg'),
+    'ZN': ('亜鉛', 'mg'),
+    'YO': ('ヨウ素', 'mg'),
+    'SE': ('セレン', 'mg'),
+    'RETOL': ('ビタミンA', 'μg'),
+    'VITD': ('ビタミンD', 'μg'),
+    'TOCPHA': ('ビタミンE', 'μg'),
+    'THIA': ('ビタミンB1', 'mg'),
+    'RIBF': ('ビタミンB2', 'mg'),
+    'PANTAC': ('パントテン酸', 'mg'),
+    'NIA': ('ナイアシン', 'mg'),
+    'VITB6A': ('ビタミンB6', 'mg'),
+    'FOL': ('葉酸', 'mg'),
+    'VITB12': ('ビタミンB12', 'mg'),
+}
+
+# 栄養素の列順（ストアの行列の列はこの順に並ぶ）
+NUTRIENT_KEYS = tuple(nutrient_labels.keys())
+NUTRIENT_POSITION = {nutrient: j for j, nutrient in enumerate(NUTRIENT_KEYS)}
+
+# 判定コード（evaluate の戻り値）
+STATUS_OK = 0
+STATUS_DEFICIENT = 1
+STATUS_EXCESS = 2
+STATUS_LABELS = ("適合", "不足", "過剰")
+
+# 基準タイプの表示名（ない基準タイプは 'adult_cat' → 'Adult Cat' のように表示する）
+STANDARD_LABELS = {
+    "adult_dog": "成犬用",
+    "puppy": "幼犬用",
+    "growth_and_reproduction": "成長期・繁殖期用",
+    "adult_cat": "成猫用",
+    "kitten": "子猫用",
+}
+
+def standard_label(standard_type):
+    """基準タイプの表示名"""
+    return STANDARD_LABELS.get(standard_type) or standard_type.replace("_", " ").title()
+
+# 判定の基準（basis）
+#   as_fed:       レシピ全体の合計をそのまま基準値と比べる（従来どおり）
+#   dry_matter:   乾物 100g あたり（合計グラム数から WATER を引いた乾物量で割る）
+#   per_1000kcal: 1000kcal あたり（ENERC_KCAL で割る）
+# aafco_standards.xlsx の基準値は乾物 100g あたりなので、1000kcal あたりで判定する時は
+# AAFCO が想定するエネルギー密度（乾物 1kg あたり 4000kcal）で基準値を換算する。
+BASES = ("as_fed", "dry_matter", "per_1000kcal")
+DEFAULT_BASIS = "as_fed"
+AAFCO_KCAL_PER_100G_DM = 400
+BASIS_STANDARD_SCALE = {
+    "as_fed": 1.0,
+    "dry_matter": 1.0,
+    "per_1000kcal": 1000 / AAFCO_KCAL_PER_100G_DM,
+}
+
+def normalize_totals(totals, total_grams, basis):
+    """
+    栄養素合計 (レシピ数, 栄養素数) とレシピごとの合計グラム数から basis の値を計算する。
+    乾物量やエネルギーが 0 以下のレシピの値は NaN になる。
+    """
+    if basis not in BASES:
+        raise ValueError(f"unknown basis: {basis}")
+    if basis == "as_fed":
+        return totals
+    matrix = np.atleast_2d(totals)
+    if basis == "dry_matter":
+        amount = (np.asarray(total_grams, dtype=np.float64) - matrix[:, NUTRIENT_POSITION["WATER"]]) / 100
+    else:
+        amount = matrix[:, NUTRIENT_POSITION["ENERC_KCAL"]] / 1000
+    with np.errstate(divide='ignore'):
+        factor = np.where(amount > 0, 1 / amount, np.nan)
+    normalized = matrix * factor[:, np.newaxis]
+    return normalized.reshape(np.shape(totals))
+
+def nutrient_totals_dict(total_vector):
+    """栄養素合計のベクトルを {栄養素: 値} に変換する（NaN は JSON で扱えるよう None にする）"""
+    return {
+        nutrient: value if value == value else None
+        for nutrient, value in zip(NUTRIENT_KEYS, total_vector.tolist())
+    }
+
+class CompiledStandards:
+    """
+    基準値の辞書（load_aafco_standards の結果）を NUTRIENT_KEYS の列順に揃えた最小値・最大値の配列。
+    minimum[s, j] / maximum[s, j] は基準タイプ types[s] の栄養素 j の基準値で、
+    最大値がない栄養素は inf、基準に含まれない栄養素は defined[s, j] が False になる。
+    """
+
+    def __init__(self, standards):
+        self.source = standards
+        self.types = tuple(standards.keys())
+        shape = (len(self.types), len(NUTRIENT_KEYS))
+        self.minimum = np.zeros(shape)
+        self.maximum = np.full(shape, np.inf)
+        self.defined = np.zeros(shape, dtype=bool)
+
+        for i, standard_type in enumerate(self.types):
+            for nutrient, values in standards[standard_type].items():
+                j = NUTRIENT_POSITION.get(nutrient)
+                if j is None:
+                    continue
+                minimum = values.get("minimum")
+                maximum = values.get("maximum")
+                if minimum is not None and not np.isnan(minimum):
+                    self.minimum[i, j] = minimum
+                if maximum is not None and not np.isnan(maximum):
+                    self.maximum[i, j] = maximum
+                self.defined[i, j] = True
+
+        for array in (self.minimum, self.maximum, self.defined):
+            array.setflags(write=False)
+        self.labels = {standard_type: standard_label(standard_type) for standard_type in self.types}
+        self.version = self._version()
+
+    @classmethod
+    def from_arrays(cls, standards, minimum, maximum, defined):
+        """コンパイル済みの配列（スナップショットのメモリマップなど）から構築する"""
+        compiled = cls.__new__(cls)
+        compiled.source = standards
+        compiled.types = tuple(standards.keys())
+        compiled.minimum = minimum
+        compiled.maximum = maximum
+        compiled.defined = defined
+        compiled.labels = {standard_type: standard_label(standard_type) for standard_type in compiled.types}
+        compiled.version = compiled._version()
+        return compiled
+
+    def _version(self):
+        """基準タイプと基準値の配列から計算したバージョン"""
+        digest = hashlib.sha1(orjson.dumps(self.types))
+        for array in (self.minimum, self.maximum, self.defined):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()[:12]
+
+    def evaluate(self, totals, basis=DEFAULT_BASIS):
+        """
+        basis で表した栄養素合計 (レシピ数, 栄養素数) をまとめて判定し、
+        判定コードの配列 (レシピ数, 基準タイプ数, 栄養素数) を返す。
+        最小値と最大値の両方に反する場合は不足を優先し、NaN の値は適合とする。
+        """
+        scale = BASIS_STANDARD_SCALE[basis]
+        totals = np.atleast_2d(totals)[:, np.newaxis, :]
+        codes = np.zeros((totals.shape[0],) + self.minimum.shape, dtype=np.int8)
+        codes[totals > self.maximum * scale] = STATUS_EXCESS
+        codes[totals < self.minimum * scale] = STATUS_DEFICIENT
+        return codes
+
+    def evaluate_columns(self, totals, columns, basis=DEFAULT_BASIS):
+        """1 レシピ分の栄養素合計のうち columns の列だけを判定し、判定コード (基準タイプ数, 列数) を返す"""
+        scale = BASIS_STANDARD_SCALE[basis]
+        values = totals[columns]
+        codes = np.zeros((len(self.types), len(columns)), dtype=np.int8)
+        codes[values > self.maximum[:, columns] * scale] = STATUS_EXCESS
+        codes[values < self.minimum[:, columns] * scale] = STATUS_DEFICIENT
+        return codes
+
+    def nutrients_with(self, codes, status):
+        """1 レシピ分の判定コードから、指定した判定の栄養素を基準タイプごとに返す"""
+        return {
+            standard_type: [NUTRIENT_KEYS[j] for j in np.flatnonzero(codes[i] == status)]
+            for i, standard_type in enumerate(self.types)
+        }
+
+    def verdicts(self, codes):
+        """1 レシピ分の判定コードを {基準タイプ: {栄養素: 不足/過剰/適合}} に変換する"""
+        return self.verdicts_many(codes[np.newaxis])[0]
+
+    def verdicts_many(self, codes):
+        """複数レシピ分の判定コードを verdicts と同じ形式の辞書のリストに変換する"""
+        labels = np.array(STATUS_LABELS, dtype=object)
+        per_type = []
+        for i, standard_type in enumerate(self.types):
+            columns = np.flatnonzero(self.defined[i])
+            keys = [NUTRIENT_KEYS[j] for j in columns]
+            per_type.append((standard_type, keys, labels[codes[:, i, columns]].tolist()))
+        return [
+            {standard_type: dict(zip(keys, rows[r])) for standard_type, keys, rows in per_type}
+            for r in range(len(codes))
+        ]
+
+
+# 提案食材として栄養素ごとに返す件数
+SUGGESTION_COUNT = 5
+
+def recipe_totals(store, recipes):
+    """
+    複数の selected_list の栄養素合計 (レシピ数, 栄養素数) と合計グラム数をまとめて計算する。
+    レシピ×食材のグラム数の疎行列（store.lookup_many）と栄養素行列の積で求め、
+    (合計, 合計グラム数, errors) を返す。errors は解釈できなかったレシピの {レシピ番号: メッセージ}。
+    """
+    indptr, rows, grams, errors = store.lookup_many(recipes)
+    counts = np.diff(indptr)
+    total_grams = np.bincount(np.repeat(np.arange(len(counts)), counts), weights=grams, minlength=len(counts))
+    return store.batch_totals(indptr, rows, grams), total_grams, errors
+
+def evaluate_recipes(store, standards, recipes, basis=DEFAULT_BASIS):
+    """
+    複数の selected_list の basis での栄養素合計と、全基準タイプの判定コード (レシピ数, 基準タイプ数, 栄養素数) を
+    まとめて計算し、(値, 合計グラム数, 判定コード, errors) を返す。
+    """
+    totals, total_grams, errors = recipe_totals(store, recipes)
+    values = normalize_totals(totals, total_grams, basis)
+    return values, total_grams, standards.evaluate(values, basis), errors
+
+def suggest_ingredients_for_deficiencies(store, deficiencies, excluded_codes=()):
+    """不足している栄養素ごとに、その栄養素を多く含む食材を上位 SUGGESTION_COUNT 件返す（excluded_codes の食材は除く）"""
+    excluded = {store.index[code] for code in excluded_codes if code in store.index}
+    suggestions = {}
+    for nutrient in deficiencies:
+        j = NUTRIENT_POSITION[nutrient]
+        suggestions[nutrient] = [
+            {
+                "food_code": int(store.food_codes[row]),
+                "name": store.names[row],
+                "value": float(store.matrix[row, j])
+            }
+            for row in store.top_k(nutrient, SUGGESTION_COUNT, excluded)
+        ]
+    return suggestions
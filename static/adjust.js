@@ -0,0 +1,405 @@
+// 食材調整画面（adjust.html）のスクリプト
+// 栄養素の表示名・単位と基準値は /reference.js（window.DOGFOOD_REFERENCE）、
+// レシピごとのデータはページに埋め込まれた window.ADJUST_DATA から読む。
+const reference = window.DOGFOOD_REFERENCE;
+const page = window.ADJUST_DATA || {};
+let allIngredients = []; // 全食材リスト
+let selectedIngredients = page.selected_ingredients || [];
+const recipeId = page.recipe_id || null;
+let recipeVersion = page.recipe_version ?? null;
+let deltaQueue = Promise.resolve(); // 差分の送信を 1 件ずつ順番に行う
+const nutrientLabels = reference.nutrient_labels;
+const suggestionStandard = page.standard || null; // 提案食材の計算に使う基準タイプ
+
+// 評価結果はサーバーからのイベントで受け取る（編集が続いた場合は最新の状態だけが届く）。
+// サーバーが同期ワーカーでライブ評価を無効にしている場合は、/recipe-delta の応答で更新する
+let recipeEvents = null;
+if (recipeId && page.live_events && window.EventSource) {
+    const params = new URLSearchParams({ recipe_id: recipeId });
+    if (suggestionStandard) {
+        params.set('standard', suggestionStandard);
+    }
+    recipeEvents = new EventSource(`/recipe-events?${params}`);
+    recipeEvents.addEventListener('evaluation', event => {
+        const data = JSON.parse(event.data);
+        updateNutrientResults(data.nutrient_totals, data.results);
+        updateSuggestionTabs(data.suggestions, data.deficiencies[data.standard] || [], data.excesses[data.standard] || []);
+    });
+}
+
+// 全食材リストをロード
+fetch('/ingredients')
+    .then(response => response.json())
+    .then(data => {
+        allIngredients = data.ingredients;
+        updateIngredientList(''); // 空文字で全リストを表示
+    })
+    .catch(error => console.error("全食材取得エラー:", error));
+
+// 検索バーの入力で絞り込み
+document.getElementById('search-bar').addEventListener('input', function() {
+    const query = this.value.toLowerCase();
+    updateIngredientList(query);
+});
+
+const suggestionSearch = document.getElementById('suggestion-search');
+if (suggestionSearch) {
+    suggestionSearch.addEventListener('input', function() {
+        const query = this.value.toLowerCase();
+        document.querySelectorAll('.list-group-item').forEach(item => {
+            const text = item.innerText.toLowerCase();
+            item.style.display = text.includes(query) ? 'flex' : 'none';
+        });
+    });
+}
+
+function addFixedIngredient(foodCode, name, grams) {
+    // 重複チェック
+    if (selectedIngredients.some(item => item.food_code === foodCode)) {
+        alert("この食材はすでに選択されています。");
+        return;
+    }
+    // 選択されたリストに追加
+    selectedIngredients.push({ food_code: foodCode, name: name, grams: grams });
+
+    // UIを更新
+    updateSelectedIngredientsUI();
+
+    // 栄養素を再計算
+    sendRecipeDelta(foodCode, grams);
+}
+
+// 食材リストを更新
+function updateIngredientList(query) {
+    const resultsList = document.getElementById('all-ingredients');
+    resultsList.innerHTML = '';
+    const filteredIngredients = allIngredients.filter(ingredient =>
+        ingredient.name.toLowerCase().includes(query) ||
+        ingredient.food_code.toString().includes(query)
+    );
+    filteredIngredients.forEach(item => {
+        const listItem = document.createElement('li');
+        listItem.className = 'list-group-item';
+        listItem.innerHTML = `
+            ${item.food_code} - ${item.name}
+            <button class="btn btn-primary btn-sm" onclick="addProposedIngredient('${item.food_code}', '${item.name}', 100)">
+                追加
+            </button>`;
+        resultsList.appendChild(listItem);
+    });
+}
+
+// 提案食材や検索から選択リストに追加する共通関数
+function addProposedIngredient(foodCode, name, grams = 100) {
+    if (selectedIngredients.some(item => item.food_code === foodCode)) {
+        alert("この食材はすでに選択されています。");
+        return;
+    }
+    selectedIngredients.push({ food_code: foodCode, name: name, grams: grams });
+    updateSelectedIngredientsUI();
+    sendRecipeDelta(foodCode, grams);
+}
+
+// 選択リストのUIを更新
+function updateSelectedIngredientsUI() {
+    const list = document.getElementById('editable-selected-ingredients');
+    list.innerHTML = ''; // リストをクリア
+    selectedIngredients.forEach(item => {
+        const listItem = document.createElement('li');
+        listItem.className = 'list-group-item';
+
+        const itemName = document.createElement('span');
+        itemName.className = 'item-name';
+        itemName.textContent = `${item.food_code} - ${item.name}`;
+        
+        const controls = document.createElement('div');
+        controls.className = 'item-controls';
+
+        const input = document.createElement('input');
+        input.type = 'number';
+        input.className = 'form-control input-grams';
+        input.value = item.grams;
+        input.step = '0.1';
+        input.min = '0';
+        input.onchange = () => updateIngredientGrams(item.food_code, input.value);
+
+        const deleteButton = document.createElement('button');
+        deleteButton.className = 'btn btn-danger btn-sm';
+        deleteButton.textContent = '削除';
+        deleteButton.onclick = () => removeIngredient(item.food_code);
+
+        controls.appendChild(input);
+        controls.appendChild(document.createTextNode('g'));
+        controls.appendChild(deleteButton);
+
+        listItem.appendChild(itemName);
+        listItem.appendChild(controls);
+
+        list.appendChild(listItem);
+
+    });
+
+    updateTotalGrams(); // 合計グラム数を更新
+}
+
+
+// グラム数を更新
+function updateIngredientGrams(foodCode, grams) {
+    grams = parseFloat(grams) || 0;
+    if (grams < 0) grams = 0; // 負の値を防止
+
+    const ingredient = selectedIngredients.find(item => item.food_code == foodCode);
+    if (ingredient) {
+        ingredient.grams = grams;
+        updateTotalGrams();
+        sendRecipeDelta(foodCode, grams);
+    }
+}
+
+// 食材 1 件の変更を差分 API に送り、値が変わった栄養素だけを更新する（grams が null なら削除）
+function sendRecipeDelta(foodCode, grams) {
+    if (!recipeId) {
+        calculateNutrients();
+        return;
+    }
+    deltaQueue = deltaQueue.then(() => fetch('/recipe-delta', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ recipe_id: recipeId, version: recipeVersion, food_code: foodCode, new_grams: grams })
+    })
+    .then(response => {
+        // 他のタブなどで更新されていた場合は、画面の内容でレシピを上書きして全体を再計算する
+        if (response.status === 409) return resyncRecipe();
+        if (!response.ok) throw new Error('Failed to apply recipe delta');
+        return response.json().then(data => {
+            recipeVersion = data.version;
+            if (!recipeEvents) updateNutrientResults(data.nutrient_totals, data.results);
+        });
+    })
+    .catch(error => console.error("Error in sendRecipeDelta:", error)));
+}
+
+// 画面の食材リストでサーバー側のレシピを置き換える
+function resyncRecipe() {
+    return fetch('/adjust', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ recipe_id: recipeId, selected_ingredients: selectedIngredients })
+    })
+    .then(response => response.json())
+    .then(data => {
+        recipeVersion = data.version;
+        calculateNutrients();
+    });
+}
+
+// 合計グラム数を更新する関数
+function updateTotalGrams() {
+    const totalGrams = selectedIngredients.reduce((sum, item) => sum + item.grams, 0);
+    document.getElementById('total-grams').textContent = totalGrams.toFixed(2);
+}
+
+// 栄養素を計算
+function calculateNutrients() {
+    fetch('/calculate-nutrients', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ selected_ingredients: selectedIngredients })
+    })
+    .then(response => {
+        if (!response.ok) throw new Error('Failed to fetch nutrients data');
+        return response.json();
+    })
+    .then(data => {
+        updateNutrientResults(data.nutrient_totals, data.results);
+    })
+    .catch(error => console.error("Error in calculateNutrients:", error));
+}
+
+// 栄養素計算結果の表（見出し・基準値の行と、合計値・判定の空のセル）を作る
+function renderNutrientTable() {
+    const head = document.getElementById('nutrient-head');
+    const body = document.getElementById('nutrient-body');
+
+    const headerRow = document.createElement('tr');
+    headerRow.appendChild(tableCell('th', '項目'));
+    reference.nutrient_keys.forEach(nutrient => {
+        const [label, unit] = nutrientLabels[nutrient] || [nutrient, ''];
+        headerRow.appendChild(tableCell('th', `${label} (${unit})`)); // 栄養素名
+    });
+    head.appendChild(headerRow);
+
+    // 合計値の行
+    const totalRow = document.createElement('tr');
+    totalRow.appendChild(tableCell('td', '合計値'));
+    reference.nutrient_keys.forEach(nutrient => {
+        const cell = tableCell('td', '0');
+        cell.id = `total-${nutrient}`;
+        totalRow.appendChild(cell);
+    });
+    body.appendChild(totalRow);
+
+    // 基準タイプごとの基準値の行と判定の行
+    reference.standard_types.forEach(standard => {
+        const label = reference.standard_labels[standard];
+        const limits = reference.standards[standard] || {};
+        const standardRow = document.createElement('tr');
+        standardRow.appendChild(tableCell('td', `${label}基準値 (min - max)`));
+        const statusRow = document.createElement('tr');
+        statusRow.appendChild(tableCell('td', `${label}判定`));
+        reference.nutrient_keys.forEach(nutrient => {
+            const limit = limits[nutrient] || {};
+            const minimum = typeof limit.minimum === 'number' ? roundTo(limit.minimum, 4) : 0;
+            const maximum = typeof limit.maximum === 'number' ? roundTo(limit.maximum, 4) : 'なし';
+            standardRow.appendChild(tableCell('td', `${minimum} - ${maximum}`));
+            const statusCell = tableCell('td', '-');
+            statusCell.id = `status-${standard}-${nutrient}`;
+            statusRow.appendChild(statusCell);
+        });
+        body.append(standardRow, statusRow);
+    });
+}
+
+function tableCell(tag, text) {
+    const cell = document.createElement(tag);
+    cell.textContent = text;
+    return cell;
+}
+
+function roundTo(value, digits) {
+    const scale = 10 ** digits;
+    return Math.round(value * scale) / scale;
+}
+
+// 栄養素結果の更新（背景色も変更）
+function updateNutrientResults(nutrientTotals, results) {
+
+    Object.keys(nutrientTotals).forEach(nutrient => {
+        const totalCell = document.getElementById(`total-${nutrient}`);
+        const totalValue = nutrientTotals[nutrient] || 0;
+
+        // 合計値を更新
+        if (totalCell) {
+            totalCell.textContent = totalValue.toFixed(2);
+        }
+
+        // 基準タイプごとの判定を更新
+        Object.keys(results || {}).forEach(standard => {
+            const statusCell = document.getElementById(`status-${standard}-${nutrient}`);
+            if (statusCell && results[standard][nutrient] !== undefined) {
+                updateStatusCell(statusCell, results[standard][nutrient]);
+            }
+        });
+    });
+}
+
+// 提案食材のタブを描き直す
+function updateSuggestionTabs(suggestions, deficiencies, excesses) {
+    const tabs = document.getElementById('suggestionTabs');
+    const contents = document.getElementById('suggestionTabContent');
+    tabs.innerHTML = '';
+    contents.innerHTML = '';
+    Object.keys(suggestions).forEach((nutrient, index) => {
+        const [label, unit] = nutrientLabels[nutrient] || [nutrient, ''];
+
+        const tab = document.createElement('li');
+        tab.className = 'nav-item';
+        const link = document.createElement('a');
+        link.className = index === 0 ? 'nav-link active' : 'nav-link';
+        link.id = `tab-${nutrient}`;
+        link.setAttribute('data-toggle', 'tab');
+        link.href = `#content-${nutrient}`;
+        link.setAttribute('role', 'tab');
+        link.textContent = `${label}（${unit}）`;
+        tab.appendChild(link);
+        tabs.appendChild(tab);
+
+        const pane = document.createElement('div');
+        pane.className = index === 0 ? 'tab-pane fade show active' : 'tab-pane fade';
+        pane.id = `content-${nutrient}`;
+        pane.setAttribute('role', 'tabpanel');
+        const heading = document.createElement('h5');
+        heading.className = 'mt-3';
+        if (deficiencies.includes(nutrient)) {
+            heading.textContent = '不足のため提案';
+        } else if (excesses.includes(nutrient)) {
+            heading.textContent = '過剰のため提案';
+        }
+        pane.appendChild(heading);
+
+        const items = suggestions[nutrient];
+        if (items.length) {
+            const list = document.createElement('ul');
+            list.className = 'list-group';
+            items.forEach(item => {
+                const listItem = document.createElement('li');
+                listItem.className = 'list-group-item d-flex justify-content-between align-items-center';
+                const text = document.createElement('span');
+                const name = document.createElement('strong');
+                name.textContent = item.name;
+                const amount = document.createElement('small');
+                amount.textContent = `${item.value.toFixed(2)} ${unit} / 100g`;
+                text.append(name, ` (${item.food_code})`, document.createElement('br'), amount);
+                const button = document.createElement('button');
+                button.className = 'btn btn-primary btn-sm';
+                button.textContent = '追加';
+                button.onclick = () => addProposedIngredient(String(item.food_code), item.name, 100);
+                listItem.append(text, button);
+                list.appendChild(listItem);
+            });
+            pane.appendChild(list);
+        } else {
+            const empty = document.createElement('p');
+            empty.textContent = '提案食材はありません。';
+            pane.appendChild(empty);
+        }
+        contents.appendChild(pane);
+    });
+}
+
+// 判定セルの内容と背景色を更新
+function updateStatusCell(cell, result) {
+    if (result === "不足") {
+        cell.innerHTML = '<span class="text-danger">不足</span>';
+        cell.className = "cell-danger"; // 赤背景
+    } else if (result === "過剰") {
+        cell.innerHTML = '<span class="text-warning">過剰</span>';
+        cell.className = "cell-warning"; // 黄背景
+    } else {
+        cell.innerHTML = '<span class="text-success">適合</span>';
+        cell.className = "cell-success"; // 緑背景
+    }
+}
+
+// 削除処理の関数
+function removeIngredient(foodCode) {
+
+    // リストから削除
+    selectedIngredients = selectedIngredients.filter(item => String(item.food_code) !== String(foodCode));
+
+    // UIを更新
+    updateSelectedIngredientsUI();
+
+    // 栄養素を再計算
+    sendRecipeDelta(foodCode, null);
+}
+
+
+document.addEventListener('DOMContentLoaded', () => {
+    // 初期ロード時に表とUIを作成
+    renderNutrientTable();
+    updateSelectedIngredientsUI();
+
+    // 初期ロード時に栄養素結果を描画
+    updateNutrientResults(page.nutrient_totals || {}, page.results);
+
+    // 初期ロード時に提案食材を描画
+    updateSuggestionTabs(page.suggestions || {}, page.deficiencies || [], page.excesses || []);
+});
+
+function forceReflow() {
+    const list = document.getElementById('editable-selected-ingredients');
+    list.style.display = 'none';
+    list.offsetHeight; // Reflowを強制
+    list.style.display = '';
+}